@@ -1,23 +1,14 @@
-from aqt import mw
-from aqt.utils import showInfo
-from aqt.qt import *
-from anki.hooks import addHook
-
-#from aqt.toolbar import Toolbar
-from rememberberry.widget import RememberberryWidget
-import aqt.toolbar
-
-def _rememberberry_handler(editor):
-    widget = RememberberryWidget(editor)
-    mw.rememberberry = widget
-    widget.show()
-
-
-def add_rememberberry(buttons, editor):
-    editor._links['rememberberry'] = _rememberberry_handler
-    return buttons + [editor._addButton(
-        "iconname", # "/full/path/to/icon.png",
-        "rememberberry", # link name
-        "tooltip")]
-
-addHook("setupEditorButtons", add_rememberberry)
+"""
+Anki add-on entry point, the user interface and hooks are set up in addon.py
+
+The database, index and import modules don't need Anki, so the package can
+also be imported outside of it (see collection.py), e.g. by bench.py or to
+build rb.db in a batch job.
+"""
+try:
+    import aqt
+except ImportError:
+    aqt = None
+
+if aqt is not None and aqt.mw is not None:
+    from . import addon
@@ -0,0 +1,85 @@
+import os
+from aqt import mw
+from aqt.utils import tooltip
+from aqt.qt import *
+from anki.hooks import addHook
+
+#from aqt.toolbar import Toolbar
+from rememberberry.widget import RememberberryWidget, ConfigWidget, get_db_filename
+from rememberberry.index import KnowledgeIndex, index_filename, log_filename
+from rememberberry.service import get_database, find_database, close_database
+from rememberberry.updater import setup_hooks, update_queue
+
+def _rememberberry_handler(editor):
+    widget = RememberberryWidget(editor)
+    mw.rememberberry = widget
+    widget.show()
+
+
+def add_rememberberry(buttons, editor):
+    editor._links['rememberberry'] = _rememberberry_handler
+    return buttons + [editor._addButton(
+        "iconname", # "/full/path/to/icon.png",
+        "rememberberry", # link name
+        "tooltip")]
+
+addHook("setupEditorButtons", add_rememberberry)
+
+
+_reviewer_index = {'filename': None, 'mtime': None, 'index': None}
+
+def _get_index():
+    # Prefer the live index of an open widget, otherwise (re)load the saved
+    # one whenever it has been written since we last looked
+    db = find_database(get_db_filename())
+    if db is not None and db.index is not None:
+        return db.index
+    filename = index_filename(get_db_filename())
+    if not os.path.exists(filename):
+        return None
+    # Changes are appended to the log, see KnowledgeIndex.save_changes
+    mtime = tuple(os.path.getmtime(f) if os.path.exists(f) else None
+                  for f in (filename, log_filename(filename)))
+    if (_reviewer_index['filename'] != filename or
+            _reviewer_index['mtime'] != mtime):
+        _reviewer_index['index'] = KnowledgeIndex.load(filename)
+        _reviewer_index['filename'] = filename
+        _reviewer_index['mtime'] = mtime
+    return _reviewer_index['index']
+
+
+def show_sentence_count():
+    index = _get_index()
+    if index is None or mw.reviewer.card is None:
+        return
+    num = index.note_sentence_count(mw.reviewer.card.nid)
+    if num > 0:
+        tooltip('%i sentence%s available' % (num, 's' if num > 1 else ''))
+
+addHook("showQuestion", show_sentence_count)
+
+
+def _get_db():
+    # Background updates have nothing to do before the database is created
+    # from the widget, and shouldn't load the dictionary for it
+    filename = get_db_filename()
+    if not os.path.exists(filename):
+        return None
+    return get_database(filename)
+
+
+def _close_database():
+    # Queued notes are processed first, the flush registered by setup_hooks
+    # runs after this and would otherwise open the database again. The
+    # index is rewritten whole, instead of replaying its log on the next
+    # load, and the next profile gets a database of its own
+    update_queue.flush()
+    close_database(get_db_filename())
+
+addHook('unloadProfile', _close_database)
+
+
+def _get_word_decks():
+    return ConfigWidget.load_config().get('active_vocabulary_decks', [])
+
+setup_hooks(_get_db, _get_word_decks)
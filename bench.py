@@ -0,0 +1,330 @@
+"""
+Benchmarks, run outside of Anki with
+
+    python -m rememberberry.bench [--notes N] [--sentences N] [--output FILE]
+
+The database benchmarks run against synthetic collections with the tables and
+columns of an Anki collection, filled with sentences made up of random CEDICT
+words, so they scale to any size without a real Anki profile. Results are
+printed (or written to --output) as JSON, to compare between versions.
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from time import time
+from contextlib import redirect_stdout
+
+from .sqlutil import iter_chunked
+from .collection import SqliteCollection
+
+SENTENCE_DECK = 'bench::sentences'
+WORD_DECK = 'bench::words'
+SENTENCE_DID = 1000
+WORD_DID = 1001
+MODEL_ID = 2000
+CEDICT_FILE = os.path.join(os.path.dirname(__file__), 'corpus/sources/cedict_ts.u8')
+
+
+def _measure(fn, trace_memory=True):
+    if trace_memory:
+        tracemalloc.start()
+    t0 = time()
+    try:
+        rows = fn()
+        error = None
+    except sqlite3.Error as e:
+        rows, error = None, str(e)
+    t1 = time()
+    result = {'seconds': t1-t0, 'rows': rows}
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['peak_bytes'] = peak
+    if error is not None:
+        result['error'] = error
+    return result
+
+
+def bench_chunked_ids(num_notes=500000):
+    """Fetches the fields of every note in a synthetic deck of num_notes notes
+    by id, with an inlined IN (...) list, chunked bound parameters and a temp
+    table"""
+    conn = sqlite3.connect(':memory:')
+    c = conn.cursor()
+    c.execute('CREATE TABLE notes (id INTEGER PRIMARY KEY, flds TEXT)')
+    c.executemany('INSERT INTO notes VALUES (?, ?)',
+                  ((1500000000000+i, '我喜欢吃苹果\x1fwo xihuan chi pingguo\x1fI like apples')
+                   for i in range(num_notes)))
+    ids = [1500000000000+i for i in range(num_notes)]
+    random.shuffle(ids)
+
+    def _inline():
+        rows = c.execute('SELECT id, flds FROM notes WHERE id IN (%s)'
+                         % ', '.join(str(i) for i in ids)).fetchall()
+        return len(rows)
+
+    def _chunked():
+        query = 'SELECT id, flds FROM notes WHERE id IN ({ids})'
+        return sum(1 for _ in iter_chunked(conn.cursor(), query, ids))
+
+    def _temp_table():
+        c.execute('DROP TABLE IF EXISTS temp.bench_ids')
+        c.execute('CREATE TEMP TABLE bench_ids (id PRIMARY KEY)')
+        c.executemany('INSERT INTO temp.bench_ids VALUES (?)', ((i,) for i in ids))
+        return sum(1 for _ in conn.cursor().execute('''
+            SELECT id, flds FROM notes WHERE id IN (SELECT id FROM temp.bench_ids)
+        '''))
+
+    return {'num_notes': num_notes,
+            'inline': _measure(_inline),
+            'chunked': _measure(_chunked),
+            'temp_table': _measure(_temp_table)}
+
+
+def make_collection(filename, words, num_sentences, num_notes, seed=0):
+    """Creates a collection with num_sentences sentence notes, built from
+    2-8 random words each, and num_notes word notes with random review
+    counts. Returns the word notes as (nid, cid) pairs"""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(filename)
+    c = conn.cursor()
+    c.executescript('''
+        DROP TABLE IF EXISTS col;
+        DROP TABLE IF EXISTS notes;
+        DROP TABLE IF EXISTS cards;
+        DROP TABLE IF EXISTS revlog;
+        CREATE TABLE col (id integer primary key, crt integer, mod integer,
+            scm integer, ver integer, dty integer, usn integer, ls integer,
+            conf text, models text, decks text, dconf text, tags text);
+        CREATE TABLE notes (id integer primary key, guid text, mid integer,
+            mod integer, usn integer, tags text, flds text, sfld integer,
+            csum integer, flags integer, data text);
+        CREATE TABLE cards (id integer primary key, nid integer, did integer,
+            ord integer, mod integer, usn integer, type integer,
+            queue integer, due integer, ivl integer, factor integer,
+            reps integer, lapses integer, left integer, odue integer,
+            odid integer, flags integer, data text);
+        CREATE TABLE revlog (id integer primary key, cid integer, usn integer,
+            ease integer, ivl integer, lastIvl integer, factor integer,
+            time integer, type integer);
+        CREATE INDEX ix_notes_usn ON notes (usn);
+        CREATE INDEX ix_cards_usn ON cards (usn);
+        CREATE INDEX ix_cards_nid ON cards (nid);
+        CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+    ''')
+    decks = {str(SENTENCE_DID): {'id': SENTENCE_DID, 'name': SENTENCE_DECK},
+             str(WORD_DID): {'id': WORD_DID, 'name': WORD_DECK}}
+    models = {str(MODEL_ID): {'id': MODEL_ID, 'name': 'Chinese',
+                              'flds': [{'name': 'Hanzi'}, {'name': 'Pinyin'},
+                                       {'name': 'English'}]}}
+    c.execute('INSERT INTO col VALUES (1, 0, 0, 0, 11, 0, 0, 0, ?, ?, ?, ?, ?)',
+              ('{}', json.dumps(models), json.dumps(decks), '{}', '{}'))
+
+    def _notes():
+        nid = 1500000000000
+        for i in range(num_sentences):
+            nid += 1
+            hz = ''.join(rnd.choice(words) for _ in range(rnd.randint(2, 8)))
+            yield nid, SENTENCE_DID, hz, 0
+        for i in range(num_notes):
+            nid += 1
+            yield nid, WORD_DID, rnd.choice(words), rnd.randint(0, 12)
+
+    word_notes = []
+    now = int(time())
+    for nid, did, hz, reps in _notes():
+        flds = '\x1f'.join([hz, 'pinyin', 'translation'])
+        c.execute('''INSERT INTO notes VALUES
+                     (?, ?, ?, ?, -1, '', ?, ?, 0, 0, '')''',
+                  (nid, str(nid), MODEL_ID, now, flds, hz))
+        c.execute('''INSERT INTO cards VALUES
+                     (?, ?, ?, 0, ?, -1, 2, 2, 0, 1, 2500, ?, ?, 0, 0, 0, 0, '')''',
+                  (nid, nid, did, now, reps, rnd.randint(0, reps // 4)))
+        if did == WORD_DID:
+            word_notes.append((nid, nid))
+    conn.commit()
+    conn.close()
+    return word_notes
+
+
+def _review(filename, word_notes, num_reviews, seed=0):
+    # Answers num_reviews random word cards, the way Anki updates them
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(filename)
+    conn.executemany('UPDATE cards SET reps=reps+1, mod=? WHERE id=?',
+                     [(int(time()) + 1, cid) for _, cid in
+                      rnd.sample(word_notes, min(num_reviews, len(word_notes)))])
+    conn.commit()
+    conn.close()
+
+
+def bench_cedict(filename=CEDICT_FILE, processes=(1, 4)):
+    """Parses the CEDICT file, with one process and with a pool of workers,
+    reported in lines per second"""
+    from .cedict import iter_cedict
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        num_lines = sum(1 for _ in f)
+    results = {'num_lines': num_lines}
+    for num in processes:
+        result = _measure(lambda: sum(1 for _ in iter_cedict(filename, num)),
+                          trace_memory=False)
+        result['lines_per_second'] = num_lines / max(result['seconds'], 1e-9)
+        results['processes=%i' % num] = result
+    return results
+
+
+def bench_strength(num_reviews=1000000, reviews_per_card=10):
+    """Computes the strength of every card of a synthetic revlog, including
+    reading the cards and reviews, with numpy if available and in Python"""
+    from . import strength
+
+    rnd = random.Random(0)
+    now = int(time())
+    num_cards = num_reviews // reviews_per_card
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE cards (id INTEGER PRIMARY KEY, nid INTEGER, '
+                 'ivl INTEGER, reps INTEGER, mod INTEGER)')
+    conn.execute('CREATE TABLE revlog (id INTEGER PRIMARY KEY, cid INTEGER, ivl INTEGER)')
+    conn.executemany('INSERT INTO cards VALUES (?, ?, ?, ?, ?)',
+                     ((cid, cid // 2, rnd.randint(1, 365), reviews_per_card, now)
+                      for cid in range(num_cards)))
+    conn.executemany('INSERT INTO revlog VALUES (?, ?, ?)',
+                     ((i, rnd.randrange(num_cards), rnd.randint(-600, 365))
+                      for i in range(now * 1000 - num_reviews * 60000, now * 1000, 60000)))
+
+    def _run():
+        cards = conn.execute('SELECT id, nid, ivl, reps, mod FROM cards ORDER BY id').fetchall()
+        reviews = conn.execute('SELECT cid, id, ivl FROM revlog').fetchall()
+        return len(strength.note_scores(cards, reviews, now))
+
+    results = {'num_reviews': num_reviews, 'num_cards': num_cards}
+    if strength.np is not None:
+        results['numpy'] = _measure(_run, trace_memory=False)
+    np, strength.np = strength.np, None
+    try:
+        results['python'] = _measure(_run, trace_memory=False)
+    finally:
+        strength.np = np
+    conn.close()
+    return results
+
+
+def cedict_memory(store):
+    """Approximate size in bytes of the CedictStore and of the dict of tuples
+    it replaced"""
+    from .service import _deep_size
+    as_dict = {hz: tuple(word) for hz, word in store.items()}
+    return {'entries': len(store),
+            'store_bytes': _deep_size(store, set()),
+            'dict_bytes': _deep_size(as_dict, set())}
+
+
+def bench_database(num_notes=10000, num_sentences=10000, num_reviews=100,
+                   search_limits=(10, 100, -1)):
+    """Times loading, init, update and search on a synthetic collection"""
+    from .db import RememberberryDatabase, _load_cedict
+
+    results = {'num_notes': num_notes, 'num_sentences': num_sentences,
+               'num_reviews': num_reviews}
+    tmp_dir = tempfile.mkdtemp(prefix='rememberberry_bench_')
+    try:
+        col_filename = os.path.join(tmp_dir, 'collection.anki2')
+        rb_filename = os.path.join(tmp_dir, 'rb.db')
+        make_collection(col_filename, [], 0, 0)
+
+        # Cold start loads HSK and the cached CEDICT
+        t0 = time()
+        rbd = RememberberryDatabase(rb_filename, SqliteCollection(col_filename))
+        results['cold_start'] = {'seconds': time()-t0}
+        rbd.col.close()
+
+        results['load_cedict'] = _measure(
+            lambda: len(_load_cedict(CEDICT_FILE, rbd.hsk)), trace_memory=False)
+        results['cedict_memory'] = cedict_memory(rbd.cedict)
+
+        words = sorted(rbd.cedict)
+        word_notes = make_collection(col_filename, words, num_sentences, num_notes)
+        rbd = RememberberryDatabase(rb_filename, SqliteCollection(col_filename))
+
+        results['init'] = _measure(
+            lambda: rbd.init([WORD_DECK], [SENTENCE_DECK]), trace_memory=False)
+        results['db_bytes'] = os.path.getsize(rb_filename)
+        results['update_unchanged'] = _measure(
+            lambda: rbd.update([WORD_DECK]), trace_memory=False)
+        _review(col_filename, word_notes, num_reviews)
+        results['update_reviewed'] = _measure(
+            lambda: rbd.update([WORD_DECK]), trace_memory=False)
+
+        search = {}
+        filter_text = words[len(words) // 2][0]
+        for limit in search_limits:
+            for num_unknown in (-1, 1):
+                for text in (None, filter_text):
+                    key = 'limit=%i,num_unknown=%i,filter=%s' % (limit, num_unknown, text)
+                    # Versions are bumped so that every search misses the cache
+                    rbd.bump_version()
+                    search[key] = _measure(
+                        lambda: len(rbd.search(text, limit, num_unknown)),
+                        trace_memory=False)
+        results['search'] = search
+        results['find_sentences'] = _measure(
+            lambda: len(rbd.find_sentences(1)), trace_memory=False)
+
+        # Hanzi, numbered, toneless and prefix pinyin, and English
+        lookup = {}
+        for query in (words[len(words) // 2], 'zhong1 guo2', 'zhongguo', 'zh',
+                      'apple', 'to be'):
+            lookup[query] = _measure(lambda: len(rbd.lookup(query)), trace_memory=False)
+        results['lookup'] = lookup
+        rbd.col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def run_benchmarks(num_notes=500000, num_sentences=None, num_reviews=100,
+                   database=True):
+    results = {'python': platform.python_version(),
+               'sqlite': sqlite3.sqlite_version,
+               'time': int(time()),
+               'chunked_ids': bench_chunked_ids(num_notes),
+               'strength': bench_strength()}
+    if os.path.exists(CEDICT_FILE):
+        results['cedict'] = bench_cedict()
+    if database:
+        if num_sentences is None:
+            num_sentences = num_notes
+        results['database'] = bench_database(num_notes, num_sentences, num_reviews)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rememberberry benchmarks')
+    parser.add_argument('--notes', type=int, default=10000,
+                        help='number of word notes (and ids for chunked_ids)')
+    parser.add_argument('--sentences', type=int, default=None,
+                        help='number of sentence notes, same as --notes by default')
+    parser.add_argument('--reviews', type=int, default=100,
+                        help='number of cards reviewed before the timed update')
+    parser.add_argument('--no-database', action='store_true',
+                        help='skip the database benchmarks')
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+    # Keeps the JSON on stdout clean of the database's own prints
+    with redirect_stdout(sys.stderr):
+        results = run_benchmarks(args.notes, args.sentences, args.reviews,
+                                 not args.no_database)
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
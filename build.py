@@ -0,0 +1,41 @@
+"""
+Builds the dictionary layer of rb.db ahead of time, run outside of Anki with
+
+    python -m rememberberry.build [output]
+
+The CEDICT items, HSK levels, compound links and the words of the knowledge
+index are the same for every user, so instead of creating them on every
+machine, init() starts from a copy of this database when it is current (same
+BASE_VERSION and source files).
+"""
+import os
+import sys
+import sqlite3
+
+from .collection import SqliteCollection
+from .db import RememberberryDatabase, BASE_FILENAME
+
+
+def build_base(filename=BASE_FILENAME):
+    tmp_filename = filename + '.tmp'
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+
+    # The database is attached to a collection, an empty one will do
+    col = SqliteCollection(':memory:')
+    col.conn.execute('CREATE TABLE col (mod INTEGER, decks TEXT, models TEXT)')
+    col.conn.execute("INSERT INTO col VALUES (0, '{}', '{}')")
+    RememberberryDatabase(tmp_filename, col).build_base()
+    col.close()
+
+    # No free pages, it's copied as is. No query planner statistics either,
+    # they would describe the dictionary alone once user sentences are added
+    conn = sqlite3.connect(tmp_filename)
+    conn.execute('VACUUM')
+    conn.close()
+    os.replace(tmp_filename, filename)
+    return filename
+
+
+if __name__ == '__main__':
+    print(build_base(*sys.argv[1:2]))
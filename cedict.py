@@ -1,14 +1,192 @@
+"""
+CEDICT parser
+
+Lines of cedict_ts.u8 look like
+
+    傳說 传说 [chuan2 shuo1] /legend/folklore/to be rumored/it is said .../
+
+iter_cedict streams them as (traditional, simplified, pinyin, translation)
+tuples, where translation is the '/'-separated definitions without the
+cross-references (see SKIP_PREFIXES). The headword and pinyin strings are
+interned, so that the many repeated ones (and traditional forms equal to the
+simplified ones) share a single object. Chunks of lines can be parsed in a
+pool of worker processes.
+
+CedictStore holds the parsed words in memory in a compact form.
+"""
 import re
+import sys
+from array import array
+from itertools import islice
+from multiprocessing import Pool
+
+_LINE_RE = re.compile(r"(\S*) (\S*) \[(.*)\] \/(.*)\/")
+
+# Definitions which only refer to other entries
+SKIP_PREFIXES = ('see also ', 'variant of')
+
+
+def _parse_lines(lines, skip_prefixes=SKIP_PREFIXES):
+    records = []
+    match = _LINE_RE.match
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        m = match(line)
+        if m is None:
+            continue
+        tr, sm, py, transl = m.groups()
+        if skip_prefixes:
+            transl = '/'.join([t for t in transl.split('/')
+                               if not t.startswith(skip_prefixes)])
+        records.append((tr, sm, py, transl))
+    return records
+
+
+def _iter_chunks(f, chunk_lines):
+    while True:
+        lines = list(islice(f, chunk_lines))
+        if not lines:
+            return
+        yield lines
+
+
+def iter_cedict(filename, processes=1, chunk_lines=20000, skip_prefixes=SKIP_PREFIXES):
+    """Yields (traditional, simplified, pinyin, translation) for every entry of
+    a CEDICT file, in file order. With processes > 1 chunks of chunk_lines
+    lines are parsed in worker processes"""
+    intern = sys.intern
+    with open(filename, 'r', encoding='utf-8') as f:
+        chunks = _iter_chunks(f, chunk_lines)
+        if processes <= 1:
+            parsed = (_parse_lines(lines, skip_prefixes) for lines in chunks)
+            pool = None
+        else:
+            pool = Pool(processes)
+            parsed = pool.imap(_parse_chunk, ((lines, skip_prefixes) for lines in chunks))
+        try:
+            for records in parsed:
+                # Strings from workers are unpickled copies, so intern here
+                for tr, sm, py, transl in records:
+                    yield intern(tr), intern(sm), intern(py), transl
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+
+def _parse_chunk(args):
+    return _parse_lines(*args)
+
+
+def load_cedict(filename, processes=1):
+    """Returns the entries of a CEDICT file as a list, see iter_cedict"""
+    return list(iter_cedict(filename, processes))
+
+
+class CedictWord:
+    """View of one word of a CedictStore, also unpacks as the tuple
+    (simplified, entries, compound_parts) which the store replaces"""
+    __slots__ = ('store', 'i')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    @property
+    def simplified(self):
+        return self.store.strings[self.store.word_ids[self.i]]
+
+    @property
+    def entries(self):
+        """[(traditional, pinyin, translation), ...]"""
+        store = self.store
+        strings = store.strings
+        return [(strings[store.traditional[j]], strings[store.pinyin[j]],
+                 strings[store.translation[j]])
+                for j in range(store.entry_start[self.i], store.entry_start[self.i+1])]
+
+    @property
+    def compound_parts(self):
+        """[(part, start, end), ...] of the words making up a compound"""
+        store = self.store
+        strings = store.strings
+        return [(strings[store.part_word[j]], store.part_start[j], store.part_end[j])
+                for j in range(store.part_offset[self.i], store.part_offset[self.i+1])]
+
+    def __iter__(self):
+        return iter((self.simplified, self.entries, self.compound_parts))
+
+
+class CedictStore:
+    """CEDICT words in flat arrays of indices into a table of unique strings,
+    so repeated traditional forms, pinyin and compound parts are stored once.
+    Looks up like the dict {simplified: (simplified, entries, compound_parts)}
+    it replaces, returning CedictWord views"""
+    def __init__(self, words):
+        """words is an iterable of (simplified, entries, compound_parts)"""
+        self.strings = []
+        self.word_ids = array('I')
+        self.entry_start = array('I', [0])
+        self.traditional = array('I')
+        self.pinyin = array('I')
+        self.translation = array('I')
+        self.part_offset = array('I', [0])
+        self.part_word = array('I')
+        self.part_start = array('H')
+        self.part_end = array('H')
+
+        string_ids = {}
+        def _id(s):
+            i = string_ids.get(s)
+            if i is None:
+                i = string_ids[s] = len(self.strings)
+                self.strings.append(s)
+            return i
+
+        for sm, entries, parts in words:
+            self.word_ids.append(_id(sm))
+            for tr, py, transl in entries:
+                self.traditional.append(_id(tr))
+                self.pinyin.append(_id(py))
+                self.translation.append(_id(transl))
+            self.entry_start.append(len(self.traditional))
+            for part, start, end in parts:
+                self.part_word.append(_id(part))
+                self.part_start.append(start)
+                self.part_end.append(end)
+            self.part_offset.append(len(self.part_word))
+        self._build_index()
+
+    def _build_index(self):
+        strings = self.strings
+        self.index = {strings[wid]: i for i, wid in enumerate(self.word_ids)}
+
+    def __getstate__(self):
+        # The index is rebuilt on load, which is quicker than unpickling it
+        state = self.__dict__.copy()
+        del state['index']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_index()
+
+    def __len__(self):
+        return len(self.word_ids)
+
+    def __contains__(self, word):
+        return word in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, word):
+        return CedictWord(self, self.index[word])
 
-def load_cedict(filename):
-    cedict = []
-    with open(filename, 'r', encoding="utf-8") as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            trad, simpl, pi, trans = re.match(r"(\S*) (\S*) \[(.*)\] \/(.*)\/", line).groups()
-            trans = trans.split('/')
-            trans = [t for t in trans if not t.startswith('see also ')]
-            cedict.append((trad, simpl, pi, trans))
-    return cedict
+    def get(self, word, default=None):
+        i = self.index.get(word)
+        return default if i is None else CedictWord(self, i)
 
+    def items(self):
+        for word, i in self.index.items():
+            yield word, CedictWord(self, i)
@@ -0,0 +1,72 @@
+"""
+Compressed item payloads
+
+The data_traditional, data_pinyin and data_translation columns of rb.items are
+stored as raw deflate streams, compressed against a preset dictionary (zdict)
+of the most common words in the CEDICT payloads. The zdict is trained when
+the dictionary items are created and kept in the rb.zdict table, so it
+travels with the database (and the pre-built base database). Values which
+wouldn't get smaller, e.g. short pinyin, and all values of databases without
+a zdict are stored as text, so both kinds of values can be in the same
+column.
+
+Decoding is cheap, but is still left until a value is displayed.
+"""
+import re
+import zlib
+from collections import Counter
+
+# Small windows are much faster to set up per value, which dominates for
+# values of a few dozen bytes. The zdict has to fit in the window, of which
+# deflate only matches back all but the last 262 bytes (MIN_LOOKAHEAD)
+WBITS = -12
+ZDICT_SIZE = (1 << -WBITS) - 262
+# Shorter values hardly ever compress
+MIN_SIZE = 24
+
+_TOKEN_RE = re.compile(r'[^\s/"\[\],]+')
+
+
+def train_zdict(samples, size=ZDICT_SIZE):
+    """Builds a zdict of the tokens of samples which would save the most
+    bytes, the most frequent last since they are the closest to the data"""
+    counts = Counter()
+    for sample in samples:
+        counts.update(_TOKEN_RE.findall(sample))
+    scored = sorted(((n * len(token), token) for token, n in counts.items() if n > 1),
+                    reverse=True)
+    tokens = []
+    total = 0
+    for _, token in scored:
+        total += len(token.encode('utf-8')) + 1
+        if total > size:
+            break
+        tokens.append(token)
+    tokens.reverse()
+    return ' '.join(tokens).encode('utf-8')
+
+
+class PayloadCodec:
+    def __init__(self, zdict=None):
+        self.zdict = zdict
+
+    def encode(self, text):
+        """Returns text compressed as bytes, or unchanged if that is not
+        smaller"""
+        if text is None or self.zdict is None:
+            return text
+        raw = text.encode('utf-8')
+        if len(raw) < MIN_SIZE:
+            return text
+        compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS, 8,
+                                      zlib.Z_DEFAULT_STRATEGY, self.zdict)
+        data = compressor.compress(raw) + compressor.flush()
+        if len(data) >= len(raw):
+            return text
+        return data
+
+    def decode(self, value):
+        if not isinstance(value, bytes):
+            return value
+        decompressor = zlib.decompressobj(WBITS, self.zdict)
+        return (decompressor.decompress(value) + decompressor.flush()).decode('utf-8')
@@ -0,0 +1,86 @@
+"""
+Collection adapters
+
+RememberberryDatabase only needs a few things from an Anki collection: the
+sqlite3 connection (rb.db is attached to it), the decks and the field names of
+the note types. SqliteCollection reads those from a collection file with plain
+sqlite3, so that the database can be built, updated and searched without Anki,
+e.g. in tests, benchmarks or to pre-build rb.db offline. AnkiCollection wraps
+an open anki.Collection.
+"""
+import json
+import sqlite3
+
+
+class SqliteCollection:
+    """A collection file (or an open connection to one) without Anki"""
+    def __init__(self, filename_or_conn):
+        if isinstance(filename_or_conn, sqlite3.Connection):
+            self.conn = filename_or_conn
+        else:
+            self.conn = sqlite3.connect(filename_or_conn)
+        self._field_names = {}
+
+    def mod(self):
+        """Modification time of the collection, changes with the decks and
+        note types"""
+        return self.conn.execute('SELECT mod FROM col').fetchone()[0]
+
+    def refresh(self):
+        """Drops what was cached from the collection, e.g. after mod() changed"""
+        self._field_names.clear()
+
+    def decks(self):
+        return json.loads(self.conn.execute('SELECT decks FROM col').fetchone()[0])
+
+    def models(self):
+        return json.loads(self.conn.execute('SELECT models FROM col').fetchone()[0])
+
+    def field_names(self, mid):
+        names = self._field_names.get(mid)
+        if names is None:
+            names = [f['name'] for f in self.models()[str(mid)]['flds']]
+            self._field_names[mid] = names
+        return names
+
+    def close(self):
+        self.conn.close()
+
+
+class AnkiCollection(SqliteCollection):
+    """An open anki.Collection, or without one the collection Anki currently
+    has open, which changes when switching profiles"""
+    def __init__(self, col=None):
+        self._col = col
+        self._field_names = {}
+
+    @property
+    def col(self):
+        if self._col is not None:
+            return self._col
+        from aqt import mw
+        return mw.col
+
+    @property
+    def conn(self):
+        # Anki reopens the connection, e.g. around syncs
+        return self.col.db._db
+
+    def field_names(self, mid):
+        return [f['name'] for f in self.col.models.get(mid)['flds']]
+
+    def close(self):
+        self.col.close()
+
+
+def as_collection(col=None):
+    """Returns an adapter for col, which can be an adapter, an
+    anki.Collection or a filename. Without col, Anki's open collection is
+    used"""
+    if col is None:
+        return AnkiCollection()
+    if isinstance(col, SqliteCollection):
+        return col
+    if isinstance(col, str):
+        return SqliteCollection(col)
+    return AnkiCollection(col)
@@ -1,15 +1,10 @@
-import re
-
-cedict = {}
-with open('sources/cedict_ts.u8', 'r') as f:
-    i = 0
-    for line in f:
-        if line.startswith('#'):
-            continue
-        z = re.match(r"(\S*) (\S*) \[(.*)\] \/(.*)\/", line)
-        print(z.groups())
-        if i > 100:
-            break
-        i+=1
+import os
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from rememberberry.cedict import iter_cedict
 
+for i, entry in enumerate(iter_cedict('sources/cedict_ts.u8')):
+    print(entry)
+    if i > 100:
+        break
@@ -17,23 +17,89 @@ model which refers back to the sentence/word id
 """
 
 import os
-import re
 import json
 import hashlib
 import sqlite3
 import base64
+import shutil
 from time import time
 import pickle
 from functools import wraps
 
-from collections import defaultdict
-from aqt import mw
-from aqt.utils import showInfo
-
-from .han import filter_text_hanzi
+from collections import defaultdict, OrderedDict
+
+from .collection import as_collection
+from .han import filter_text_hanzi, has_hanzi, segment_cedict
+from .cedict import iter_cedict, CedictStore
+from .sqlutil import iter_chunked
+from .flatfile import write_corpus, iter_corpus
+from . import importer
+from .index import KnowledgeIndex, index_filename, log_filename
+from .profiling import Profiler
+from .codec import PayloadCodec, train_zdict
+from .strength import note_scores
+from .lookup import pinyin_keys, query_pinyin_key, gloss_words, query_gloss_words
+from .dedup import shingles, band_keys, DuplicateFinder
 import jieba
 
 
+# Item types which are searched as sentences
+SENTENCE_TYPES = ('user_sentence', importer.ITEM_TYPE)
+SENTENCE_TYPES_SQL = ', '.join("'%s'" % t for t in SENTENCE_TYPES)
+
+SOURCES_DIR = os.path.join(os.path.dirname(__file__), 'corpus/sources')
+
+# Pre-built dictionary layer, see build.py. Bump BASE_VERSION whenever the
+# dictionary tables or how they are filled change
+BASE_FILENAME = os.path.join(os.path.dirname(__file__), 'corpus/rb_base.db')
+BASE_VERSION = 6
+
+# Version of the user tables created by init(). Bump whenever they change,
+# databases of other versions then report as not initiated and are rebuilt
+SCHEMA_VERSION = 2
+
+# Word counts of sentences are stored per HSK level, so that the counts for
+# any completed HSK level come from an expression at query time, see
+# _hist_count. Words outside of HSK (level 9) count from the last byte
+HIST_LEVELS = 8
+# Counts saturate instead of carrying into the next level, the last byte
+# stops at 127 to keep the packed value a positive 64 bit integer
+_HIST_MAX = [255] * (HIST_LEVELS - 1) + [127]
+
+# Words are unknown, learning, memorizing or known by max_correct, or known if
+# they are at most at the completed HSK level. The counts in rb.items and the
+# bucket codes returned by search() are both defined by these, and agree with
+# index.correct_bucket, which also takes a NULL max_correct as unknown
+BUCKET_UNKNOWN, BUCKET_LEARNING, BUCKET_MEMORIZING, BUCKET_KNOWN = range(4)
+_MEMORIZING_SQL = 'max_correct BETWEEN 5 AND 8'
+_LEARNING_SQL = 'max_correct BETWEEN 1 AND 4'
+_UNKNOWN_SQL = 'IFNULL(max_correct, 0) <= 0'
+
+
+def _bucket_sql(completed_hsk_lvl):
+    return '''(CASE WHEN hsk_lvl <= %i OR max_correct > 8 THEN %i
+                  WHEN %s THEN %i WHEN %s THEN %i ELSE %i END)''' % (
+        completed_hsk_lvl, BUCKET_KNOWN, _MEMORIZING_SQL, BUCKET_MEMORIZING,
+        _LEARNING_SQL, BUCKET_LEARNING, BUCKET_UNKNOWN)
+
+
+def _buckets_differ_sql(a, b):
+    # Whether the scores a and b are in different buckets of the counts in
+    # rb.items, i.e. match different ones of the conditions above. NULL is
+    # unknown, like 0, rather than different from everything
+    a, b = 'IFNULL(%s, 0)' % a, 'IFNULL(%s, 0)' % b
+    return ' OR '.join('(%s) IS NOT (%s)' % (cond.replace('max_correct', a),
+                                             cond.replace('max_correct', b))
+                       for cond in (_MEMORIZING_SQL, _LEARNING_SQL, _UNKNOWN_SQL))
+
+
+# Entries in rb.hash_updates older than this are purged by update()
+HASH_UPDATES_MAX_AGE_DAYS = 365
+
+# How words are scored, see set_scoring
+SCORINGS = ('reps', 'strength')
+
+
 def _get_content_hash(json_content):
     content = json.dumps(json_content)
     m = hashlib.sha256()
@@ -42,17 +108,36 @@ def _get_content_hash(json_content):
     return str(h[:16], 'utf-8')
 
 
-def _load_cedict(filename, hsk=None):
+def _hist_sum(condition):
+    # Aggregate packing the number of linked words matching condition with
+    # hsk_lvl > k into byte k, see _hist_count
+    return ' | '.join('(MIN(SUM(hsk_lvl > %i AND %s), %i) << %i)' % (
+        k, condition, _HIST_MAX[k], 8 * k) for k in range(HIST_LEVELS))
+
+
+def _hist_count(column, completed_hsk_lvl, table='rb.items'):
+    # The *_hist columns pack, in byte k, the number of words with
+    # hsk_lvl > k (at most _HIST_MAX[k]), so the count for a completed level
+    # is a shift and a mask
+    return '((%s.%s >> %i) & 255)' % (
+        table, column, 8 * min(completed_hsk_lvl, HIST_LEVELS - 1))
+
+
+def _get_sources_digest():
+    # Identifies the CEDICT and HSK files a base database was built from
+    m = hashlib.sha256()
+    for name in ['cedict_ts.u8'] + ['HSK%i.txt' % lvl for lvl in range(1, 7)]:
+        filename = os.path.join(SOURCES_DIR, name)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                m.update(f.read())
+    return m.hexdigest()
+
+
+def _load_cedict(filename, hsk=None, compact=True):
     cedict = defaultdict(list)
-    with open(filename, 'r', encoding="utf-8") as f:
-        for line in f:
-            if line.startswith('#'):
-                continue
-            tr, sm, py, transl = re.match(r"(\S*) (\S*) \[(.*)\] \/(.*)\/", line).groups()
-            transl = transl.split('/')
-            transl = '/'.join([t for t in transl if not t.startswith('see also ')
-                               and not t.startswith('variant of')])
-            cedict[sm].append((tr, py, transl))
+    for tr, sm, py, transl in iter_cedict(filename):
+        cedict[sm].append((tr, py, transl))
 
     # Find compounds with jieba
     num = 0
@@ -65,8 +150,52 @@ def _load_cedict(filename, hsk=None):
 
     # Join multiple sound characters (多音字)
     cedict = {sm: (sm, entries, compound_parts[sm]) for sm, entries in cedict.items()}
+    if compact:
+        cedict = CedictStore(cedict.values())
     return cedict
 
+# Loaded once per process, and shared by all databases
+_dictionary = {}
+
+def load_dictionary():
+    """Returns (hsk, cedict), where hsk maps levels to the sets of words and
+    characters of each level"""
+    if 'cedict' in _dictionary:
+        return _dictionary['hsk'], _dictionary['cedict']
+
+    # Load HSK files and cedict
+    hsk = {}
+    for lvl in range(1, 7):
+        hsk_file = os.path.join(SOURCES_DIR, 'HSK%i.txt' % lvl)
+        with open(hsk_file, 'r', encoding='utf-8') as f:
+            lvl_words = set(f.read().splitlines())
+        # Split up words and add individual characters
+        chars = set()
+        for word in lvl_words:
+            chars.update(word)
+        hsk[lvl] = lvl_words | chars
+
+    # Load the cedict file
+    cedict_file = os.path.join(SOURCES_DIR, 'cedict_ts.u8')
+    user_files = os.path.join(os.path.dirname(__file__), 'user_files')
+    cedict_cache_file = os.path.join(user_files, 'cedict_cache.pickle')
+    cedict = None
+    if os.path.exists(cedict_cache_file):
+        with open(cedict_cache_file, 'rb') as f:
+            cedict = pickle.load(f)
+    # Caches written before CedictStore hold a plain dict
+    if not isinstance(cedict, CedictStore):
+        cedict = _load_cedict(cedict_file, hsk)
+        # user_files isn't in a fresh checkout, e.g. when running build.py
+        os.makedirs(user_files, exist_ok=True)
+        with open(cedict_cache_file, 'wb') as f:
+            pickle.dump(cedict, f)
+
+    _dictionary['hsk'] = hsk
+    _dictionary['cedict'] = cedict
+    return hsk, cedict
+
+
 def attach_detach(method):
     @wraps(method)
     def _impl(self, *args, **kwargs):
@@ -82,84 +211,132 @@ def attach_detach(method):
 class RememberberryDatabase:
     def __init__(self, filename, col=None, completed_hsk_lvl=0):
         self.db_filename = filename
-        self.col = col if col is not None else mw.col
+        self.col = as_collection(col)
         self.completed_hsk_lvl = completed_hsk_lvl
+        # Disabled until turned on, e.g. from the debug tab
+        self.profiler = Profiler()
+
+        # Search results are cached per version of the knowledge state, which
+        # is bumped whenever scores, note links or marks change
+        self.version = 0
+        self.search_cache = OrderedDict()
+        self.search_cache_size = 64
+
+        self.index_filename = index_filename(filename)
+        self.index = KnowledgeIndex.load(self.index_filename)
+        self.index_dirty = False
+        self.cedict_hashes = None
+        self.codec = None
+
+        # Re-read when the collection changes, see _refresh_collection_info
+        self.col_mod = None
+        self.decks = None
+        self.models = None
+        self._refresh_collection_info()
+
+    # The dictionary is only loaded once something needs it, e.g. not for
+    # updates without new notes to segment
+    @property
+    def hsk(self):
+        return load_dictionary()[0]
 
-        c = self._get_cursor()
-        self.decks = json.loads(c.execute("select decks from col").fetchall()[0][0])
-        self.models = json.loads(c.execute("select models from col").fetchall()[0][0])
-
-        self._load_hsk_cedict()
+    @property
+    def cedict(self):
+        return load_dictionary()[1]
 
     @property
     @attach_detach
     def initiated(self):
+        """Whether init() has completed with the current SCHEMA_VERSION"""
         if not os.path.exists(self.db_filename):
             return False
-        c = self._get_cursor()
+        return self._is_initiated(self._get_cursor())
+
+    def _is_initiated(self, c):
         res = c.execute('''
             SELECT name FROM rb.sqlite_master WHERE type='table' AND name='items'
         ''').fetchall()
-        return len(res) > 0
-
-    def _load_hsk_cedict(self):
-        # Load HSK files and cedict
-        sources_dir = os.path.join(os.path.dirname(__file__), 'corpus/sources')
-        self.hsk = {}
-        for lvl in range(1, 7):
-            hsk_file = os.path.join(sources_dir, 'HSK%i.txt' % lvl)
-            lvl_words = set(open(hsk_file, 'r', encoding='utf-8').read().splitlines())
-            # Split up words and add individual characters
-            chars = set()
-            for word in lvl_words:
-                chars = chars | set(word)
-            self.hsk[lvl] = lvl_words | chars
-
-        # Load the cedict file
-        cedict_file = os.path.join(sources_dir, 'cedict_ts.u8')
-        user_files = os.path.join(os.path.dirname(__file__), 'user_files')
-        cedict_cache_file = os.path.join(user_files, 'cedict_cache.pickle')
-        if os.path.exists(cedict_cache_file):
-            with open(cedict_cache_file, 'rb') as f:
-                self.cedict = pickle.load(f)
-        else:
-            self.cedict = _load_cedict(cedict_file, self.hsk)
-            with open(cedict_cache_file, 'wb') as f:
-                pickle.dump(self.cedict, f)
+        if len(res) == 0:
+            return False
+        return self._get_meta(c, 'schema_version') == SCHEMA_VERSION
 
+    def _check_initiated(self, c):
+        # Imports need the tables init() creates, and detach commits whatever
+        # was written before a missing one is hit
+        if not self._is_initiated(c):
+            raise RuntimeError('The database %s has not been initiated, run '
+                               'init() before importing' % self.db_filename)
 
     def _get_cursor(self):
-        return self.col.db._db.cursor()
+        return self.profiler.wrap_cursor(self.col.conn.cursor())
+
+    def _get_hsk_lvl(self, hz):
+        for lvl in range(1, 7):
+            if hz in self.hsk[lvl]:
+                return lvl
+        return 9 # unknown
+
+    def bump_version(self):
+        self.version += 1
+
+    def _refresh_collection_info(self):
+        # Anki bumps col.mod whenever decks or note types change
+        mod = self.col.mod()
+        if mod != self.col_mod:
+            self.col.refresh()
+            self.decks = self.col.decks()
+            self.models = self.col.models()
+            self.col_mod = mod
 
     def _get_did_from_name(self, deck_name):
+        self._refresh_collection_info()
         dids = [deck_id for (deck_id, deck_info) in self.decks.items()
                if deck_info['name'] == deck_name]
         if len(dids) == 0:
             return None
         return dids[0]
 
-    def _iter_notes(self, deck_name, filter_linked=False):
+    def _iter_notes(self, deck_name, filter_linked=False, nids_table=None):
+        # nids_table is a temp table with a nid column, which limits the
+        # notes to those in it, and is then looked up instead of the deck
         did = self._get_did_from_name(deck_name)
         if did is None:
             return
-        filter_str = '''
+        filter_str = ''
+        if filter_linked:
+            filter_str += '''
             AND NOT EXISTS
-            (SELECT * FROM rb.note_links WHERE rb.note_links.nid == nid)'''
+            (SELECT * FROM rb.note_links WHERE rb.note_links.nid == cards.nid)'''
+        if nids_table is None:
+            tables = 'cards'
+        else:
+            # CROSS JOIN keeps the temp table as the outer loop
+            tables = 'temp.%s AS selected CROSS JOIN cards ON cards.nid=selected.nid' % (
+                nids_table)
+        query = '''
+           SELECT notes.id, notes.mid, notes.flds, max(reps-lapses), cards.data
+           FROM %s JOIN notes ON notes.id=cards.nid
+           WHERE did=? %s
+           GROUP BY cards.nid
+           ''' % (tables, filter_str)
         c = self._get_cursor()
-        res = c.execute('''
-           SELECT nid, max(reps-lapses), data FROM cards
-           WHERE did=? %sGROUP BY nid
-           ''' % (filter_str if filter_linked else '', ), (did,)).fetchall()
-        other = {nid: _ for nid, *_ in res}
-        ids_str = ', '.join(str(nid) for nid, *_ in res)
-        note_fields = c.execute(
-                "SELECT id, flds, mid FROM notes WHERE id in (%s)" % ids_str).fetchall()
-        for nid, fields, mid in note_fields:
-            yield (nid, mid, fields.split('\x1f'), *other[nid])
+        for nid, mid, fields, *other in c.execute(query, (did,)):
+            yield (nid, mid, fields.split('\x1f'), *other)
+
+    @attach_detach
+    def get_marked_items(self, mark_type):
+        """Returns (hash, simplified) of the items marked with mark_type"""
+        c = self._get_cursor()
+        self._create_marks(c)
+        return c.execute('''
+            SELECT rb.items.hash, data_simplified FROM rb.marks
+            JOIN rb.items ON rb.items.hash=rb.marks.hash
+            WHERE mark=? ORDER BY date
+        ''', (mark_type,)).fetchall()
 
     def _get_field_from_name(self, mid, fields, valid_names):
-        for i, f in enumerate(self.col.models.get(mid)['flds']):
-            if f['name'].lower() in valid_names:
+        for i, name in enumerate(self.col.field_names(mid)):
+            if name.lower() in valid_names:
                 return fields[i]
         return None
 
@@ -173,12 +350,27 @@ class RememberberryDatabase:
                 max_field = f
         return f
 
-    def _iter_notes_cedicts(self, decks, filter_linked=False):
+    def _iter_notes_cedicts(self, decks, filter_linked=False, nids_table=None):
+        for nid, hanzi_field, pinyin_field, english_field in self._iter_notes_fields(
+                decks, filter_linked, nids_table):
+            yield (nid, hanzi_field, pinyin_field, english_field,
+                   self._segment(hanzi_field))
+
+    def _segment(self, hanzi):
+        with self.profiler.phase('segment') as phase:
+            # The words of the database, which may be from another cedict
+            # than the one on disk, and need not be loaded
+            cedict_tokens = segment_cedict(hanzi, self._get_cedict_hashes())
+            phase.rows = len(cedict_tokens)
+        return cedict_tokens
+
+    def _iter_notes_fields(self, decks, filter_linked=False, nids_table=None):
+        # Yields (nid, hanzi, pinyin, english) of the notes in decks
         hanzi_names = set(['hanzi', 'characters', 'simplified'])
         pinyin_names = set(['pinyin'])
         english_names = set(['english', 'translation'])
         for deck in decks:
-            for nid, mid, fields, *_ in self._iter_notes(deck, filter_linked):
+            for nid, mid, fields, *_ in self._iter_notes(deck, filter_linked, nids_table):
                 hanzi_field = self._get_field_from_name(mid, fields, hanzi_names)
                 if hanzi_field == None:
                     # As a fall back, find the field with the most hanzi characters
@@ -186,29 +378,11 @@ class RememberberryDatabase:
 
                 pinyin_field = self._get_field_from_name(mid, fields, pinyin_names)
                 english_field = self._get_field_from_name(mid, fields, english_names)
-
-                tokens = list(jieba.tokenize(hanzi_field))
-
-                # tokens can contain compounds which are not in cedict
-                # if that is the case, then break it down into its parts and
-                # add them separately (if in cedict)
-                cedict_tokens = []
-                for t in tokens:
-                    if t[0] in self.cedict:
-                        cedict_tokens.append(t)
-                        continue
-
-                    parts = list(jieba.tokenize(t[0], mode='search'))
-                    for tc in parts:
-                        if tc[0] in self.cedict:
-                            # Correct the indices for the sentence
-                            cedict_tokens.append((tc[0], t[1]+tc[1], t[2]+tc[2]))
-
-                yield nid, hanzi_field, pinyin_field, english_field, cedict_tokens
+                yield nid, hanzi_field, pinyin_field, english_field
 
     def attach(self):
         c = self._get_cursor()
-        self.col.db._db.commit()
+        self.col.conn.commit()
         try:
             c.execute("ATTACH DATABASE ? AS rb", (self.db_filename,))
         except sqlite3.OperationalError:
@@ -216,21 +390,67 @@ class RememberberryDatabase:
 
     def detach(self):
         c = self._get_cursor()
-        self.col.db._db.commit()
+        self.col.conn.commit()
         try:
             c.execute("DETACH DATABASE rb")
         except sqlite3.OperationalError:
             print("Database already detached, it's fine")
 
-    @attach_detach
     def init(self, word_decks, sentence_decks):
-        self.attach()
+        """Creates the database from the notes in word_decks and
+        sentence_decks. The dictionary layer is copied from the pre-built
+        base database if there is a current one, see build_base()"""
+        # Marks are by item hash, which stay the same as long as the content
+        # does, so they are carried over, also from older schema versions
+        marks = self._get_all_marks() if os.path.exists(self.db_filename) else []
+        has_base = self._copy_base()
+        self._init(word_decks, sentence_decks, has_base, marks)
+
+    @attach_detach
+    def _get_all_marks(self):
         c = self._get_cursor()
+        self._create_marks(c)
+        return c.execute('SELECT * FROM rb.marks').fetchall()
 
-        # 1. Create tables
-        tables = ['rb.items', 'rb.item_links', 'rb.item_search', 'rb.note_links',
-                  'rb.last_updated', 'rb.hsk']
-        for table in tables:
+    def _copy_base(self):
+        # The base holds the CEDICT items and links, which also get per user
+        # scores, so it is copied rather than attached read-only
+        if not os.path.exists(BASE_FILENAME):
+            return False
+        try:
+            conn = sqlite3.connect(BASE_FILENAME)
+            info = dict(conn.execute('SELECT key, value FROM meta'))
+            conn.close()
+        except sqlite3.Error:
+            return False
+        if (info.get('base_version') != BASE_VERSION or
+                info.get('sources') != _get_sources_digest()):
+            return False
+        tmp_filename = self.db_filename + '.tmp'
+        shutil.copyfile(BASE_FILENAME, tmp_filename)
+        os.replace(tmp_filename, self.db_filename)
+        return True
+
+    @attach_detach
+    def build_base(self):
+        """Creates only the dictionary layer, the same for every user, to be
+        distributed as BASE_FILENAME (see build.py)"""
+        c = self._get_cursor()
+        self._create_dictionary(c)
+        # The words of the knowledge index, which init() starts from
+        c.executescript('DROP TABLE IF EXISTS rb.base_index;')
+        c.execute('CREATE TABLE rb.base_index (data BLOB)')
+        c.execute('INSERT INTO rb.base_index VALUES (?)', (pickle.dumps(
+            self._create_word_index(c), protocol=pickle.HIGHEST_PROTOCOL),))
+        c.executescript('DROP TABLE IF EXISTS rb.meta;')
+        self._create_meta(c)
+        self._set_meta(c, 'base_version', BASE_VERSION)
+        self._set_meta(c, 'sources', _get_sources_digest())
+
+    def _create_dictionary(self, c):
+        # 1. Create the dictionary tables
+        for table in ['rb.items', 'rb.item_links', 'rb.hsk', 'rb.zdict',
+                      'rb.pinyin_index', 'rb.gloss_index']:
             c.executescript('DROP TABLE IF EXISTS %s;' % table)
 
         c.execute('''
@@ -244,10 +464,9 @@ class RememberberryDatabase:
                 data_translation VARCHAR,
 
                 max_correct INTEGER,
-                num_known INTEGER,
-                num_memorizing INTEGER,
-                num_learning INTEGER,
-                num_unknown INTEGER,
+                memorizing_hist INTEGER,
+                learning_hist INTEGER,
+                unknown_hist INTEGER,
                 num_links INTEGER
             )
         ''')
@@ -270,6 +489,137 @@ class RememberberryDatabase:
         c.execute('''
             CREATE INDEX rb.search_hashes ON items (hash);
         ''')
+        c.execute('''
+            CREATE TABLE rb.hsk (
+                hash CHARACTER(16),
+                hsk_lvl INTEGER,
+                PRIMARY KEY(hash),
+                FOREIGN KEY(hash) REFERENCES items(hash)
+            )
+        ''')
+
+        # 2. Load cedict into items
+        # 2.1. Create json content for each and hash it
+        cedict_hash_json = {}
+        cedict_hsk = []
+        for hz, word in self.cedict.items():
+            entries = word.entries
+            traditional = json.dumps([tr for tr, _, _ in entries])
+            pinyin = json.dumps([py for _, py, _ in entries])
+            translation = json.dumps([transl for _, _, transl in entries])
+            h_64 = _get_content_hash((hz, entries))
+            word_level = self._get_hsk_lvl(hz)
+            cedict_hash_json[hz] = (h_64, traditional, hz, pinyin, translation)
+            cedict_hsk.append((h_64, word_level))
+        self.cedict_hashes = {hz: v[0] for hz, v in cedict_hash_json.items()}
+
+        # 2.2. Train the zdict payloads are compressed with, see codec.py
+        zdict = train_zdict(v[4] for v in cedict_hash_json.values())
+        c.execute('CREATE TABLE rb.zdict (zdict BLOB)')
+        c.execute('INSERT INTO rb.zdict VALUES (?)', (zdict,))
+        self.codec = codec = PayloadCodec(zdict)
+        encode = codec.encode
+        with self.profiler.phase('encode'):
+            items = [(h_64, encode(tr), hz, encode(py), encode(transl))
+                     for h_64, tr, hz, py, transl in cedict_hash_json.values()]
+
+        # 2.3. Insert into items table with hash as id
+        c.executemany('''INSERT OR REPLACE INTO rb.items VALUES (
+                         ?, NULL, "cedict", ?, ?, ?, ?, 0, 0, 0, 0, 0)''', items)
+
+        # 2.4. Insert into hsk table
+        c.executemany('''INSERT OR REPLACE INTO rb.hsk VALUES (?, ?)''', cedict_hsk)
+
+        # 3. Add links between compound cedict words and their parts
+        links = []
+        for sm, word in self.cedict.items():
+            compound_hash = cedict_hash_json[sm][0]
+            for part_sm, start, end in word.compound_parts:
+                if part_sm not in cedict_hash_json:
+                    continue
+                part_hash = cedict_hash_json[part_sm][0]
+                link_pointer = '%i-%i' % (start, end)
+                links.append((compound_hash, part_hash, link_pointer))
+        c.executemany('''INSERT OR REPLACE INTO rb.item_links VALUES (?, ?, ?)''', links)
+
+        # 4. Index the pinyin and definitions for lookup()
+        with self.profiler.phase('lookup_index'):
+            self._create_lookup_index(c)
+        return len(cedict_hsk)
+
+    def _create_word_index(self, c):
+        # Knowledge index of the cedict words, without sentences or scores
+        index = KnowledgeIndex()
+        for h_64, word_level in c.execute('SELECT hash, hsk_lvl FROM rb.hsk').fetchall():
+            index.add_word(h_64, word_level)
+        return index
+
+    def _create_lookup_index(self, c):
+        # Pinyin keys and definition words of the cedict items, see lookup.py.
+        # Built from the in-memory cedict, the payloads in rb.items are
+        # compressed
+        c.execute('''
+            CREATE TABLE rb.pinyin_index (
+                key VARCHAR,
+                hash CHARACTER(16),
+                PRIMARY KEY(key, hash)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('''
+            CREATE TABLE rb.gloss_index (
+                word VARCHAR,
+                hash CHARACTER(16),
+                def_len INTEGER,
+                PRIMARY KEY(word, hash)
+            ) WITHOUT ROWID
+        ''')
+        cedict_hashes = self._get_cedict_hashes()
+        pinyin_rows = set()
+        gloss_rows = {}
+        for hz, word in self.cedict.items():
+            # The database may be from an older cedict, when built by lookup()
+            h = cedict_hashes.get(hz)
+            if h is None:
+                continue
+            for _, py, transl in word.entries:
+                pinyin_rows.update((key, h) for key in pinyin_keys(py))
+                # Keep the shortest definition a word is in
+                for gloss, def_len in gloss_words(transl):
+                    if def_len < gloss_rows.get((gloss, h), def_len + 1):
+                        gloss_rows[gloss, h] = def_len
+        c.executemany('INSERT INTO rb.pinyin_index VALUES (?, ?)', sorted(pinyin_rows))
+        c.executemany('INSERT INTO rb.gloss_index VALUES (?, ?, ?)',
+                      sorted((w, h, l) for (w, h), l in gloss_rows.items()))
+
+    @attach_detach
+    def _init(self, word_decks, sentence_decks, has_base, marks=()):
+        self.attach()
+        c = self._get_cursor()
+        lap = self.profiler.laps('init')
+
+        # 1. Create the dictionary layer, unless it was copied from the base
+        index = None
+        if has_base:
+            self.cedict_hashes = None
+            self.codec = None
+            index = pickle.loads(c.execute('SELECT data FROM rb.base_index').fetchone()[0])
+            if getattr(index, 'format_version', None) != KnowledgeIndex.format_version:
+                index = None
+        else:
+            lap('cedict', self._create_dictionary(c))
+
+        # 2. Create the user tables
+        tables = ['rb.item_search', 'rb.note_links', 'rb.last_updated',
+                  'rb.word_stats', 'rb.word_only_unknown', 'rb.meta',
+                  'rb.sentence_notes', 'rb.hash_updates', 'rb.marks',
+                  'rb.duplicates', 'rb.sentence_bands']
+        for table in tables:
+            c.executescript('DROP TABLE IF EXISTS %s;' % table)
+
+        self._create_marks(c)
+        self._create_duplicates(c)
+        c.executemany('INSERT INTO rb.marks VALUES (?, ?, ?)', marks)
+
         c.execute('''
             CREATE TABLE rb.note_links (
                 hash CHARACTER(16),
@@ -285,6 +635,18 @@ class RememberberryDatabase:
         c.execute('''
             CREATE INDEX rb.note_link_hashes ON note_links (hash);
         ''')
+        c.execute('''
+            CREATE TABLE rb.sentence_notes (
+                nid INTEGER,
+                hash CHARACTER(16),
+                PRIMARY KEY (nid),
+                FOREIGN KEY(hash) REFERENCES items(hash)
+            )
+        ''')
+        c.execute('''
+            CREATE INDEX rb.sentence_note_hashes ON sentence_notes (hash);
+        ''')
+        self._create_hash_updates(c)
         c.execute('''
             CREATE TABLE rb.last_updated (
                 cid INTEGER,
@@ -296,168 +658,883 @@ class RememberberryDatabase:
         ''')
 
         c.execute('''
-            CREATE TABLE rb.hsk (
+            CREATE TABLE rb.word_stats (
                 hash CHARACTER(16),
                 hsk_lvl INTEGER,
+                num_sentences INTEGER,
                 PRIMARY KEY(hash),
                 FOREIGN KEY(hash) REFERENCES items(hash)
             )
         ''')
+        c.execute('''
+            CREATE TABLE rb.word_only_unknown (
+                lvl INTEGER,
+                hash CHARACTER(16),
+                num_sentences INTEGER,
+                PRIMARY KEY(lvl, hash),
+                FOREIGN KEY(hash) REFERENCES items(hash)
+            )
+        ''')
+        c.execute('''
+            CREATE INDEX rb.word_only_unknown_hashes ON word_only_unknown (hash);
+        ''')
+        # suggest_words() reads words in the order of these two
+        c.execute('''
+            CREATE INDEX rb.word_only_unknown_rank ON word_only_unknown (
+                lvl, num_sentences DESC);
+        ''')
+        c.execute('''
+            CREATE INDEX rb.word_stats_rank ON word_stats (num_sentences DESC);
+        ''')
 
 
-        # 2. Load cedict into items
-        # 2.1. Create json content for each and hash it
-        self.cedict_hash_json = {}
-        self.cedict_hsk = []
-        for hz, (_, entries, _) in self.cedict.items():
-            traditional = json.dumps([tr for tr, _, _ in entries])
-            pinyin = json.dumps([py for _, py, _ in entries])
-            translation = json.dumps([transl for _, _, transl in entries])
-            h_64 = _get_content_hash((hz, entries))
-            word_level = 9 # unknown
-            for lvl in range(1, 7):
-                if hz in self.hsk[lvl]:
-                    word_level = lvl
-                    break
-            self.cedict_hash_json[hz] = (h_64, traditional, hz, pinyin, translation)
-            self.cedict_hsk.append((h_64, word_level))
-
-        # 2.2. Insert into items table with hash as id
-        c.executemany('''INSERT OR REPLACE INTO rb.items VALUES (
-                         ?, NULL, "cedict", ?, ?, ?, ?, 0, 0, 0, 0, 0, 0)''',
-                      list(self.cedict_hash_json.values()))
-
-        # 2.3. Insert into hsk table
-        c.executemany('''INSERT OR REPLACE INTO rb.hsk VALUES (?, ?)''', self.cedict_hsk)
-
-        # 3. Add links
+        lap('tables')
 
-        # 3.1. Add links between compound cedict words and their parts
+        # 3. Load sentences into items and cross reference cedict and add item links
+        # Edits made after this are picked up by update(), from the high
+        # water marks of notes
+        self._create_meta(c)
+        self._set_meta(c, 'sentence_decks', json.dumps(sentence_decks))
+        self._move_marks(c, 'notes', 'SELECT id, mod, usn FROM notes')
+        cedict_hashes = self._get_cedict_hashes()
+        encode = self._get_codec().encode
         links = []
-        for sm, (*_, compound_parts) in self.cedict.items():
-            compound_hash = self.cedict_hash_json[sm][0]
-            for part_sm, start, end in compound_parts:
-                if part_sm not in self.cedict_hash_json:
-                    continue
-                part_hash = self.cedict_hash_json[part_sm][0]
-                link_pointer = '%i-%i' % (start, end)
-                links.append((compound_hash, part_hash, link_pointer))
-
-        # 3.2. Load sentences into items and cross reference cedict and add item links
         sentences = []
-        for nid, *content, cedicts in self._iter_notes_cedicts(sentence_decks):
-            h_64 = _get_content_hash([None, *content])
-            sentences.append((h_64, *content))
+        sentence_notes = []
+        sentence_words = []
+        for nid, hz, py, transl, cedicts in self._iter_notes_cedicts(sentence_decks):
+            with self.profiler.phase('hash'):
+                h_64 = _get_content_hash([None, hz, py, transl])
+            sentences.append((h_64, hz, encode(py), encode(transl)))
+            sentence_notes.append((nid, h_64))
+            word_hashes = []
             for hz, start, end in cedicts:
                 link_pointer = '%i-%i' % (start, end)
-                cedict_hash = self.cedict_hash_json[hz][0]
+                cedict_hash = cedict_hashes[hz]
                 links.append((h_64, cedict_hash, link_pointer))
+                word_hashes.append(cedict_hash)
+            sentence_words.append((h_64, word_hashes))
+
+        # Sentence notes stay items, but near-duplicates are left out of
+        # searches and the index
+        duplicates = self._find_duplicates(c, sentence_words)
+        lap('duplicates', len(duplicates))
 
         c.executemany('''INSERT OR REPLACE INTO rb.items VALUES (
-                           ?, NULL, 'user_sentence', NULL, ?, ?, ?, 0, 0, 0, 0, 0, 0
+                           ?, NULL, 'user_sentence', NULL, ?, ?, ?, 0, 0, 0, 0, 0
                          )''', sentences)
         c.executemany('''INSERT OR REPLACE INTO rb.item_links VALUES (?, ?, ?)''', links)
+        c.executemany('INSERT OR REPLACE INTO rb.sentence_notes VALUES (?, ?)', sentence_notes)
+        lap('sentences', len(sentences))
+
+        # 3.1. Count words of all sentences and build the word statistics,
+        # update() then patches the ones affected by user notes
+        self._update_counts(c, "SELECT hash FROM rb.items WHERE type='user_sentence'")
+        self._update_word_stats(c)
+        lap('counts')
+
+        # 3.2. Build the knowledge index, scores are filled in by update()
+        self.index = self._create_word_index(c) if index is None else index
+        for h_64, word_hashes in sentence_words:
+            if h_64 not in duplicates:
+                self.index.add_sentence(h_64, word_hashes)
+        # Written whole, replacing the log of the previous index
+        self.index.save(self.index_filename)
+        self.index_dirty = False
+        lap('index')
 
         # 4. Populate/update user words and the scores table
         self.update(word_decks)
+        lap('update')
 
-    @attach_detach
-    def update(self, word_decks):
-        c = self._get_cursor()
+        # Only now is the database initiated, update() has detached it
+        self.attach()
+        self._set_meta(self._get_cursor(), 'schema_version', SCHEMA_VERSION)
+        # Everything was rebuilt, whether or not update() found changes
+        self.bump_version()
+
+    def _create_temp_table(self, c, name, query, params=()):
+        c.execute('DROP TABLE IF EXISTS temp.%s' % name)
+        c.execute('CREATE TEMP TABLE %s AS %s' % (name, query), params)
+
+    def _create_temp_ids(self, c, name, column, ids):
+        # Temp table instead of an inlined IN (...) list, which gets slow and
+        # eventually too large with many ids
+        c.execute('DROP TABLE IF EXISTS temp.%s' % name)
+        c.execute('CREATE TEMP TABLE %s (%s PRIMARY KEY)' % (name, column))
+        c.executemany('INSERT OR IGNORE INTO temp.%s VALUES (?)' % name,
+                      [(i,) for i in ids])
+
+    def _create_hash_updates(self, c):
+        # Maps old item hashes to current ones, see _log_hash_update
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rb.hash_updates (
+                from_hash CHARACTER(16),
+                to_hash CHARACTER(16),
+                date DATETIME,
+                PRIMARY KEY (from_hash)
+            )
+        ''')
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS rb.hash_updates_to ON hash_updates (to_hash);
+        ''')
 
-        # 1. Load user words and cross reference cedict and add note links
-        # but only for cards that have not been inserted yet, or not updated
+    def _create_marks(self, c):
+        # Items marked as 'known' or 'ignore', which search() and
+        # suggest_words() leave out
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rb.marks (
+                hash CHARACTER(16) PRIMARY KEY,
+                mark VARCHAR,
+                date DATETIME
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS rb.marks_by_mark ON marks (mark)')
+
+    def _create_duplicates(self, c):
+        # Near-duplicate sentences and the LSH band keys of the sentences
+        # they were compared to, see dedup.py
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rb.duplicates (
+                hash CHARACTER(16) PRIMARY KEY,
+                rep_hash CHARACTER(16),
+                similarity REAL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS rb.duplicates_by_rep ON duplicates (rep_hash)')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rb.sentence_bands (
+                band INTEGER,
+                hash CHARACTER(16),
+                PRIMARY KEY(band, hash)
+            ) WITHOUT ROWID
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS rb.sentence_bands_hashes ON sentence_bands (hash)')
+
+    def _iter_sentence_words(self, hashes):
+        # Yields (hash, word hashes in sentence order) of stored sentences
+        words = defaultdict(list)
+        for from_hash, to_hash, pointer in iter_chunked(self._get_cursor(), '''
+                SELECT from_hash, to_hash, pointer FROM rb.item_links
+                WHERE from_hash IN ({ids})
+                ''', hashes):
+            words[from_hash].append((int(pointer.split('-')[0]), to_hash))
+        for h, sentence_words in words.items():
+            yield h, [to_hash for _, to_hash in sorted(sentence_words)]
+
+    def _find_duplicates(self, c, sentences, exclude=()):
+        # Compares sentences [(hash, word hashes), ...], in order, to each
+        # other and to the sentences in rb.sentence_bands, keeping the first
+        # of every group of near-duplicates. Call before inserting the
+        # sentences, which may then be left out. The hashes in exclude, e.g.
+        # earlier versions of edited sentences, are never representatives.
+        # Returns {hash: rep_hash} of the near-duplicates, which are also
+        # added to rb.duplicates
+        self._create_duplicates(c)
+        sentences = [(h, words) for h, words in sentences if len(words) > 0]
+        self._create_temp_ids(c, 'rb_dedup_sentences', 'hash', [h for h, _ in sentences])
+        # Sentences compared before, e.g. imported again, keep their place
+        known = set(h for h, in c.execute('''
+            SELECT hash FROM temp.rb_dedup_sentences WHERE hash IN
+            (SELECT hash FROM rb.items UNION ALL SELECT hash FROM rb.duplicates)
+        '''))
+
+        new = []
+        for h, words in sentences:
+            if h not in known:
+                known.add(h)
+                new.append((h, shingles(words)))
+        prepared = [(h, sentence_shingles, keys) for (h, sentence_shingles), keys
+                    in zip(new, band_keys([s for _, s in new]))]
+
+        # Earlier sentences sharing a band
+        c.execute('DROP TABLE IF EXISTS temp.rb_dedup_bands')
+        c.execute('CREATE TEMP TABLE rb_dedup_bands (band INTEGER, hash CHARACTER(16))')
+        c.executemany('INSERT INTO temp.rb_dedup_bands VALUES (?, ?)',
+                      [(key, h) for h, _, keys in prepared for key in keys])
+        exclude = set(exclude)
+        candidates = defaultdict(set)
+        for h, rep in c.execute('''
+                SELECT DISTINCT new.hash, old.hash FROM temp.rb_dedup_bands AS new
+                JOIN rb.sentence_bands AS old ON old.band=new.band
+                '''):
+            if rep != h and rep not in exclude:
+                candidates[h].add(rep)
+        candidate_shingles = {rep: shingles(words) for rep, words in self._iter_sentence_words(
+            set(rep for reps in candidates.values() for rep in reps))}
+
+        finder = DuplicateFinder()
+        duplicates = {}
+        bands = []
+        for h, sentence_shingles, keys in prepared:
+            match = finder.add(h, sentence_shingles, keys, {
+                rep: candidate_shingles[rep] for rep in candidates.get(h, ())
+                if rep in candidate_shingles})
+            if match is None:
+                bands.extend((key, h) for key in keys)
+            else:
+                duplicates[h] = match
+        c.executemany('INSERT OR IGNORE INTO rb.sentence_bands VALUES (?, ?)', bands)
+        c.executemany('INSERT OR REPLACE INTO rb.duplicates VALUES (?, ?, ?)',
+                      [(h, rep, similarity) for h, (rep, similarity) in duplicates.items()])
+        return {h: rep for h, (rep, _) in duplicates.items()}
+
+    def _migrate_marks(self, c):
+        # Marks used to be written to cards.data of the notes, move them to
+        # the items of the notes, once. Scans all cards, unlike the table
+        if self._get_meta(c, 'marks_migrated'):
+            return
+        self._create_marks(c)
+        self._create_temp_table(c, 'rb_marked_notes', '''
+            SELECT DISTINCT nid, data AS mark FROM cards WHERE data IN ('known', 'ignore')
+        ''')
+        c.execute('''
+            INSERT OR IGNORE INTO rb.marks
+            SELECT hash, mark, datetime('now') FROM temp.rb_marked_notes
+            JOIN rb.sentence_notes ON rb.sentence_notes.nid=temp.rb_marked_notes.nid
+            UNION ALL
+            SELECT hash, mark, datetime('now') FROM temp.rb_marked_notes
+            JOIN rb.note_links ON rb.note_links.nid=temp.rb_marked_notes.nid
+        ''')
+        c.execute('''
+            UPDATE cards SET data='' WHERE nid IN (SELECT nid FROM temp.rb_marked_notes)
+            AND data IN ('known', 'ignore')
+        ''')
+        self._set_meta(c, 'marks_migrated', 1)
+
+    def _create_meta(self, c):
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rb.meta (
+                key VARCHAR PRIMARY KEY,
+                value
+            )
+        ''')
+
+    def _get_meta(self, c, key, default=None):
+        self._create_meta(c)
+        res = c.execute('SELECT value FROM rb.meta WHERE key=?', (key,)).fetchone()
+        return default if res is None else res[0]
+
+    def _set_meta(self, c, key, value):
+        c.execute('INSERT OR REPLACE INTO rb.meta VALUES (?, ?)', (key, value))
+
+    def _update_counts(self, c, hashes_query):
+        # Recount the memorizing/learning/unknown words of the items selected
+        # by hashes_query, per HSK level (see _hist_count). Known words are
+        # the rest of num_links
+        properties = [('memorizing_hist', _hist_sum(_MEMORIZING_SQL)),
+                      ('learning_hist', _hist_sum(_LEARNING_SQL)),
+                      ('unknown_hist', _hist_sum(_UNKNOWN_SQL)),
+                      ('num_links', 'COUNT(*)')]
+        for prop in properties:
+            c.execute('''
+                UPDATE rb.items SET
+                    %s=(
+                        SELECT IFNULL(%s, 0) FROM rb.item_links
+                        JOIN rb.items AS words ON words.hash=rb.item_links.to_hash
+                        JOIN rb.hsk ON words.hash=rb.hsk.hash
+                        WHERE from_hash=rb.items.hash
+                    )
+                WHERE hash IN (%s)
+            ''' % (*prop, hashes_query))
+
+    def _num_unknown_sql(self, table='rb.items'):
+        # Number of unknown words of a sentence at the current completed_hsk_lvl
+        return _hist_count('unknown_hist', self.completed_hsk_lvl, table)
+
+    def _update_word_stats(self, c):
+        # Recounts the word statistics of all sentences
+        c.execute('DELETE FROM rb.word_stats')
+        c.execute('DELETE FROM rb.word_only_unknown')
+        self._start_word_stats(c)
+        self._collect_word_stats(c, None, 1)
+        self._apply_word_stats(c)
+
+    def _start_word_stats(self, c):
+        # Changes of the word statistics are collected as signed counts in
+        # temp.rb_word_stats_delta, so that only the sentences which changed
+        # are counted, once as they were and once as they are now
+        c.execute('DROP TABLE IF EXISTS temp.rb_word_stats_delta')
+        c.execute('''
+            CREATE TEMP TABLE rb_word_stats_delta (
+                lvl INTEGER, hash CHARACTER(16), hsk_lvl INTEGER, n INTEGER)
+        ''')
+
+    def _collect_word_stats(self, c, sentences_query, sign, num_sentences=True):
+        # Adds sign times what the sentences selected by sentences_query (all
+        # if None) currently count: the number of sentences containing each
+        # word (lvl -1), and for each completed HSK level the ones where it is
+        # the only unknown word. Near-duplicates aren't searchable, so they
+        # aren't counted either
+        self._create_duplicates(c)
+        sentences_clause = '''sentences.type IN (%s) AND NOT EXISTS
+            (SELECT * FROM rb.duplicates WHERE rb.duplicates.hash=sentences.hash)
+        ''' % SENTENCE_TYPES_SQL
+        if sentences_query is not None:
+            sentences_clause += 'AND sentences.hash IN (%s)' % sentences_query
+
+        if num_sentences:
+            c.execute('''
+                INSERT INTO temp.rb_word_stats_delta
+                SELECT -1, to_hash, hsk_lvl, %i * COUNT(*)
+                FROM rb.items AS sentences
+                JOIN rb.item_links ON from_hash = sentences.hash
+                JOIN rb.hsk ON rb.hsk.hash = to_hash
+                WHERE %s
+                GROUP BY to_hash
+            ''' % (sign, sentences_clause))
+
+        # Only sentences with exactly one unknown word at a level are joined,
+        # and that word is the only one that can match
+        for l in range(HIST_LEVELS):
+            c.execute('''
+                INSERT INTO temp.rb_word_stats_delta
+                SELECT %i, to_hash, hsk_lvl, %i * COUNT(*)
+                FROM rb.items AS sentences
+                JOIN rb.item_links ON from_hash = sentences.hash
+                JOIN rb.items AS words ON words.hash = to_hash
+                JOIN rb.hsk ON rb.hsk.hash = to_hash
+                WHERE %s AND %s = 1 AND %s AND hsk_lvl > %i
+                GROUP BY to_hash
+            ''' % (l, sign, sentences_clause,
+                   _hist_count('unknown_hist', l, 'sentences'),
+                   _UNKNOWN_SQL.replace('max_correct', 'words.max_correct'), l))
+
+    def _apply_word_stats(self, c):
+        # Adds the counts collected since _start_word_stats to rb.word_stats
+        # and rb.word_only_unknown, dropping words which reach zero
+        c.execute('DROP TABLE IF EXISTS temp.rb_word_stats_sum')
+        c.execute('''
+            CREATE TEMP TABLE rb_word_stats_sum (
+                lvl INTEGER, hash CHARACTER(16), hsk_lvl INTEGER, n INTEGER,
+                PRIMARY KEY (lvl, hash))
+        ''')
+        c.execute('''
+            INSERT INTO temp.rb_word_stats_sum
+            SELECT lvl, hash, hsk_lvl, SUM(n) FROM temp.rb_word_stats_delta
+            GROUP BY lvl, hash HAVING SUM(n) != 0
+        ''')
+
+        c.execute('''
+            INSERT OR IGNORE INTO rb.word_stats
+            SELECT hash, hsk_lvl, 0 FROM temp.rb_word_stats_sum WHERE lvl = -1
+        ''')
+        c.execute('''
+            UPDATE rb.word_stats SET num_sentences = num_sentences + (
+                SELECT n FROM temp.rb_word_stats_sum AS d
+                WHERE d.lvl = -1 AND d.hash = rb.word_stats.hash)
+            WHERE hash IN (SELECT hash FROM temp.rb_word_stats_sum WHERE lvl = -1)
+        ''')
+        c.execute('''
+            DELETE FROM rb.word_stats WHERE num_sentences <= 0
+            AND hash IN (SELECT hash FROM temp.rb_word_stats_sum WHERE lvl = -1)
+        ''')
+
+        c.execute('''
+            INSERT OR IGNORE INTO rb.word_only_unknown
+            SELECT lvl, hash, 0 FROM temp.rb_word_stats_sum WHERE lvl >= 0
+        ''')
+        c.execute('''
+            UPDATE rb.word_only_unknown SET num_sentences = num_sentences + (
+                SELECT n FROM temp.rb_word_stats_sum AS d
+                WHERE d.lvl = rb.word_only_unknown.lvl
+                AND d.hash = rb.word_only_unknown.hash)
+            WHERE (lvl, hash) IN (SELECT lvl, hash FROM temp.rb_word_stats_sum WHERE lvl >= 0)
+        ''')
+        c.execute('''
+            DELETE FROM rb.word_only_unknown WHERE num_sentences <= 0
+            AND (lvl, hash) IN (SELECT lvl, hash FROM temp.rb_word_stats_sum WHERE lvl >= 0)
+        ''')
+
+    def _get_cedict_hashes(self):
+        # Maps simplified hanzi to cedict item hashes, read back from the
+        # database when init() has not run in this session
+        if self.cedict_hashes is None:
+            c = self._get_cursor()
+            self.cedict_hashes = dict(c.execute(
+                "SELECT data_simplified, hash FROM rb.items WHERE type='cedict'"))
+        return self.cedict_hashes
+
+    def _get_codec(self):
+        # Databases from before payloads were compressed have no zdict, and
+        # store everything as text
+        if self.codec is None:
+            c = self._get_cursor()
+            zdict = None
+            if c.execute('''
+                    SELECT name FROM rb.sqlite_master WHERE type='table' AND name='zdict'
+                    ''').fetchone() is not None:
+                zdict = c.execute('SELECT zdict FROM rb.zdict').fetchone()[0]
+            self.codec = PayloadCodec(zdict)
+        return self.codec
+
+    def decode(self, value):
+        """Decodes a data_traditional, data_pinyin or data_translation value
+        of an item, e.g. of the words of search results, see codec.py"""
+        if not isinstance(value, bytes):
+            return value
+        if self.codec is None:
+            self.attach()
+            try:
+                self._get_codec()
+            finally:
+                self.detach()
+        return self.codec.decode(value)
+
+    def _save_index(self):
+        # Only the changes are appended to the log of the index, rewriting
+        # all of it is left for flush_index()
+        if self.index is not None and self.index_dirty:
+            if os.path.exists(self.index_filename):
+                self.index.save_changes(self.index_filename)
+            else:
+                self.index.save(self.index_filename)
+            self.index_dirty = False
+
+    def flush_index(self):
+        """Writes the whole knowledge index, replacing its log of changes.
+        Takes a moment with many sentences, e.g. call it when the profile is
+        closed"""
+        if self.index is not None and (self.index_dirty or os.path.exists(
+                log_filename(self.index_filename))):
+            self.index.save(self.index_filename)
+            self.index_dirty = False
+
+    def _link_notes(self, c, word_decks, nids_table):
+        # Load the user words of the notes in temp table nids_table and cross
+        # reference cedict and add note links, but only for notes that have
+        # not been linked yet
+        cedict_hashes = self._get_cedict_hashes()
         note_links = []
-        for nid, *content, cedicts in self._iter_notes_cedicts(word_decks, True):
+        for nid, *content, cedicts in self._iter_notes_cedicts(
+                word_decks, True, nids_table):
             for hz, start, length in cedicts:
-                cedict_hash = self.cedict_hash_json[hz][0]
-                note_links.append((cedict_hash, nid))
+                note_links.append((cedict_hashes[hz], nid))
 
         c.executemany('''
             INSERT OR IGNORE INTO rb.note_links VALUES (?, ?, date('now'))
         ''', note_links)
 
+        if self.index is not None:
+            for cedict_hash, nid in note_links:
+                self.index_dirty |= self.index.link_note(nid, cedict_hash)
+        return note_links
+
+    def _update_scores(self, c):
+        # Updates the scores of everything linked to the notes in
+        # temp.rb_updated_notes, and returns the number of recounted parents
+
+        # 1. Find item hashes that should be updated via note_links, and
+        # compute their new scores next to the current ones
+        self._create_temp_table(c, 'rb_updated_items', '''
+            SELECT hash, max_correct AS score FROM rb.items WHERE hash IN (
+                SELECT hash FROM rb.note_links
+                WHERE nid IN (SELECT nid FROM temp.rb_updated_notes))
+        ''')
+        if self._get_meta(c, 'scoring', 'reps') == 'strength':
+            self._update_strengths(c)
+        else:
+            c.execute('''
+                UPDATE temp.rb_updated_items SET score=IFNULL((
+                    SELECT MAX(reps-lapses)
+                    FROM rb.note_links JOIN cards ON rb.note_links.nid = cards.nid
+                    WHERE rb.note_links.hash = temp.rb_updated_items.hash
+                ), 0)
+            ''')
+
+        # 2. Only sentences with words which change bucket are recounted,
+        # and only the ones with words becoming (or no longer) unknown can
+        # change which words are their only unknown one. Those are
+        # uncounted before the scores change, and counted again after
+        self._create_temp_table(c, 'rb_rebucketed_items', '''
+            SELECT rb.items.hash AS hash,
+                   (%s) IS NOT (%s) AS unknown_changed
+            FROM temp.rb_updated_items AS updated
+            JOIN rb.items ON rb.items.hash = updated.hash
+            WHERE %s
+        ''' % (_UNKNOWN_SQL.replace('max_correct', 'rb.items.max_correct'),
+               _UNKNOWN_SQL.replace('max_correct', 'updated.score'),
+               _buckets_differ_sql('rb.items.max_correct', 'updated.score')))
+        self._create_temp_table(c, 'rb_unknown_changed_sentences', '''
+            SELECT DISTINCT(from_hash) AS hash FROM rb.item_links
+            WHERE to_hash IN (
+                SELECT hash FROM temp.rb_rebucketed_items WHERE unknown_changed)
+        ''')
+        self._start_word_stats(c)
+        self._collect_word_stats(
+            c, 'SELECT hash FROM temp.rb_unknown_changed_sentences', -1, False)
+
+        c.execute('''
+            UPDATE rb.items SET max_correct=(
+                SELECT score FROM temp.rb_updated_items
+                WHERE temp.rb_updated_items.hash = rb.items.hash
+            )
+            WHERE hash IN (SELECT hash FROM temp.rb_updated_items)
+        ''')
+
+        # 3. Find linked items (parents) via item_links and update those
+        # parents
+        self._create_temp_table(c, 'rb_parent_items', '''
+            SELECT DISTINCT(from_hash) AS hash FROM rb.item_links
+            WHERE to_hash IN (SELECT hash FROM temp.rb_rebucketed_items)
+        ''')
+        self._update_counts(c, 'SELECT hash FROM temp.rb_parent_items')
+
+        # 4. Count the only unknown words of the changed sentences again.
+        # Sentences are neither added nor removed, so the numbers of
+        # sentences of the words stay the same
+        self._collect_word_stats(
+            c, 'SELECT hash FROM temp.rb_unknown_changed_sentences', 1, False)
+        self._apply_word_stats(c)
+
+        # 5. Patch the knowledge index with the new scores
+        if self.index is not None:
+            for h, max_correct in c.execute('''
+                    SELECT hash, score FROM temp.rb_updated_items
+                    ''').fetchall():
+                self.index_dirty |= self.index.set_max_correct(h, max_correct)
+
+        return c.execute('SELECT COUNT(*) FROM temp.rb_parent_items').fetchone()[0]
+
+    def _update_strengths(self, c):
+        # Scores the items in temp.rb_updated_items by the strongest card of
+        # all their linked notes, computed from the revlog in one pass
+        self._create_temp_table(c, 'rb_strength_cards', '''
+            SELECT id, nid, ivl, reps, mod FROM cards WHERE nid IN (
+                SELECT nid FROM rb.note_links
+                WHERE hash IN (SELECT hash FROM temp.rb_updated_items))
+        ''')
+        cards = c.execute('SELECT * FROM temp.rb_strength_cards ORDER BY id').fetchall()
+        reviews = c.execute('''
+            SELECT cid, id, ivl FROM revlog
+            WHERE cid IN (SELECT id FROM temp.rb_strength_cards)
+        ''').fetchall()
+        with self.profiler.phase('strength') as phase:
+            scores = note_scores(cards, reviews)
+            phase.rows = len(reviews)
+
+        c.execute('DROP TABLE IF EXISTS temp.rb_note_scores')
+        c.execute('CREATE TEMP TABLE rb_note_scores (nid INTEGER PRIMARY KEY, score INTEGER)')
+        c.executemany('INSERT INTO temp.rb_note_scores VALUES (?, ?)', scores)
+        c.execute('''
+            UPDATE temp.rb_updated_items SET score=IFNULL((
+                SELECT MAX(temp.rb_note_scores.score)
+                FROM rb.note_links JOIN temp.rb_note_scores
+                ON rb.note_links.nid = temp.rb_note_scores.nid
+                WHERE rb.note_links.hash = temp.rb_updated_items.hash
+            ), 0)
+        ''')
+
+    def _update_last_updated(self, c, move_mark):
+        # Store reps/lapses of the cards in temp.rb_changed_cards, and move
+        # the high water marks of cards forward if all cards modified since
+        # the last update were processed
+        c.execute('''
+            INSERT OR REPLACE INTO rb.last_updated (cid, nid, reps, lapses)
+            SELECT cid, nid, reps, lapses FROM temp.rb_changed_cards
+        ''')
+        if not move_mark:
+            return
+        self._move_marks(c, 'cards', 'SELECT cid AS id, mod, usn FROM temp.rb_changed_cards')
+
+    def _move_marks(self, c, kind, query):
+        # Moves the (mod, id) and usn high water marks of kind, 'cards' or
+        # 'notes', forward to the largest ones of the rows of query
+        row = c.execute('SELECT mod, id FROM (%s) ORDER BY mod DESC, id DESC LIMIT 1'
+                        % query).fetchone()
+        if row is not None and tuple(row) > (self._get_meta(c, kind + '_mod', 0),
+                                             self._get_meta(c, kind + '_id', 0)):
+            self._set_meta(c, kind + '_mod', row[0])
+            self._set_meta(c, kind + '_id', row[1])
+        max_usn, = c.execute('SELECT MAX(usn) FROM (%s)' % query).fetchone()
+        if max_usn is not None and max_usn > self._get_meta(c, kind + '_usn', -1):
+            self._set_meta(c, kind + '_usn', max_usn)
+
+    def _update_sentence_notes(self, c):
+        # Re-hashes sentence notes edited (or added) since the last update.
+        # Items whose content changed get a new hash, the old one is kept as
+        # prev_hash and in rb.hash_updates, and note links are re-pointed, so
+        # that nothing has to be rebuilt with init(). Returns the number of
+        # changed sentences
+        sentence_decks = json.loads(self._get_meta(c, 'sentence_decks', '[]'))
+        if len(sentence_decks) == 0:
+            # Created before sentence notes were tracked, see init()
+            return 0
+        self._compact_hash_updates(c)
+        # Like cards, notes are selected by a (mod, id) high water mark, and
+        # synced notes by their new usn. Notes whose cards were imported or
+        # moved into a sentence deck, see update(), aren't sentence notes yet
+        self._create_temp_table(c, 'rb_changed_notes', '''
+            SELECT id AS nid, mod, usn FROM notes WHERE (mod, id) > (?, ?)
+            UNION
+            SELECT id AS nid, mod, usn FROM notes WHERE usn > ?
+            UNION
+            SELECT id AS nid, mod, usn FROM temp.rb_changed_card_notes AS changed
+            CROSS JOIN notes ON notes.id=changed.nid
+            WHERE changed.nid NOT IN (SELECT nid FROM rb.sentence_notes)
+        ''', (self._get_meta(c, 'notes_mod', 0), self._get_meta(c, 'notes_id', 0),
+              self._get_meta(c, 'notes_usn', -1)))
+        if c.execute('SELECT 1 FROM temp.rb_changed_notes LIMIT 1').fetchone() is None:
+            return 0
+        prev_hashes = dict(c.execute('''
+            SELECT nid, hash FROM rb.sentence_notes
+            WHERE nid IN (SELECT nid FROM temp.rb_changed_notes)
+        '''))
+
+        cedict_hashes = self._get_cedict_hashes()
+        encode = self._get_codec().encode
+        sentences = []
+        links = []
+        moved = []
+        sentence_words = []
+        # Only sentences whose content changed are segmented, notes are also
+        # selected when e.g. only their cards were touched
+        for nid, hz, py, transl in list(self._iter_notes_fields(
+                sentence_decks, nids_table='rb_changed_notes')):
+            h_64 = _get_content_hash([None, hz, py, transl])
+            prev_hash = prev_hashes.get(nid)
+            if h_64 == prev_hash:
+                continue
+            sentences.append((h_64, prev_hash, hz, encode(py), encode(transl)))
+            word_hashes = []
+            for hz, start, end in self._segment(hz):
+                links.append((h_64, cedict_hashes[hz], '%i-%i' % (start, end)))
+                word_hashes.append(cedict_hashes[hz])
+            sentence_words.append((h_64, word_hashes))
+            moved.append((nid, prev_hash, h_64))
+
+        # The changed sentences, old and new, are uncounted from the word
+        # statistics as they were, and counted again once they are replaced
+        self._create_temp_ids(c, 'rb_changed_sentences', 'hash',
+                              [h_64 for h_64, _ in sentence_words] +
+                              [prev_hash for _, prev_hash, _ in moved
+                               if prev_hash is not None])
+        self._start_word_stats(c)
+        self._collect_word_stats(c, 'SELECT hash FROM temp.rb_changed_sentences', -1)
+
+        # Not with the previous versions of the sentences, which are replaced
+        duplicates = self._find_duplicates(
+            c, sentence_words, [prev_hash for _, prev_hash, _ in moved])
+        c.executemany('''INSERT OR IGNORE INTO rb.items VALUES (
+                           ?, ?, 'user_sentence', NULL, ?, ?, ?, 0, 0, 0, 0, 0
+                         )''', sentences)
+        c.executemany('INSERT OR IGNORE INTO rb.item_links VALUES (?, ?, ?)', links)
+        c.executemany('INSERT OR REPLACE INTO rb.sentence_notes VALUES (?, ?)',
+                      [(nid, h_64) for nid, _, h_64 in moved])
+
+        # Old hashes which no other sentence note shares are replaced
+        orphaned = [(prev_hash, h_64) for _, prev_hash, h_64 in moved
+                    if prev_hash is not None and c.execute(
+                        'SELECT 1 FROM rb.sentence_notes WHERE hash=?',
+                        (prev_hash,)).fetchone() is None]
+        for prev_hash, h_64 in orphaned:
+            self._log_hash_update(c, prev_hash, h_64)
+            c.execute('DELETE FROM rb.item_links WHERE from_hash=?', (prev_hash,))
+            c.execute('DELETE FROM rb.items WHERE hash=?', (prev_hash,))
+
+        # Recount the changed sentences, and count them in the statistics of
+        # their words
+        self._update_counts(c, 'SELECT hash FROM temp.rb_changed_sentences')
+        self._collect_word_stats(c, 'SELECT hash FROM temp.rb_changed_sentences', 1)
+        self._apply_word_stats(c)
+
+        if self.index is not None:
+            for prev_hash, _ in orphaned:
+                self.index_dirty |= self.index.remove_sentence(prev_hash)
+            for h_64, word_hashes in sentence_words:
+                if h_64 not in duplicates:
+                    self.index.add_sentence(h_64, word_hashes)
+                    self.index_dirty = True
+            for h_64, in c.execute('''
+                    SELECT DISTINCT(hash) FROM rb.note_links
+                    WHERE hash IN (SELECT hash FROM temp.rb_changed_sentences)
+                    '''):
+                self.index.link_sentence(h_64)
+
+        self._move_marks(c, 'notes', 'SELECT nid AS id, mod, usn FROM temp.rb_changed_notes')
+        return len(moved)
+
+    def _log_hash_update(self, c, from_hash, to_hash):
+        # Entries are compacted as they are added, so that resolving a hash is
+        # always a single lookup: earlier hashes of the item now point to the
+        # new hash, and a hash which is current again no longer resolves
+        c.execute('DELETE FROM rb.hash_updates WHERE from_hash=?', (to_hash,))
+        c.execute('UPDATE rb.hash_updates SET to_hash=? WHERE to_hash=?', (to_hash, from_hash))
+        c.execute('''
+            INSERT OR REPLACE INTO rb.hash_updates VALUES (?, ?, datetime('now'))
+        ''', (from_hash, to_hash))
+        c.execute('UPDATE OR IGNORE rb.note_links SET hash=? WHERE hash=?', (to_hash, from_hash))
+        c.execute('DELETE FROM rb.note_links WHERE hash=?', (from_hash,))
+        self._create_marks(c)
+        c.execute('UPDATE OR IGNORE rb.marks SET hash=? WHERE hash=?', (to_hash, from_hash))
+        c.execute('DELETE FROM rb.marks WHERE hash=?', (from_hash,))
+        self._create_duplicates(c)
+        c.execute('UPDATE rb.duplicates SET rep_hash=? WHERE rep_hash=?', (to_hash, from_hash))
+        # The new text may be that of one of its own duplicates
+        c.execute('DELETE FROM rb.duplicates WHERE hash=?', (from_hash,))
+        c.execute('DELETE FROM rb.duplicates WHERE hash=? AND rep_hash=?', (to_hash, to_hash))
+        c.execute('DELETE FROM rb.sentence_bands WHERE hash=?', (from_hash,))
+
+    def _compact_hash_updates(self, c, max_age_days=HASH_UPDATES_MAX_AGE_DAYS):
+        c.execute('''
+            DELETE FROM rb.hash_updates WHERE date < datetime('now', ?)
+        ''', ('-%i days' % max_age_days,))
+
+    def _resolve_hash(self, c, item_hash):
+        self._create_hash_updates(c)
+        res = c.execute('SELECT to_hash FROM rb.hash_updates WHERE from_hash=?',
+                        (item_hash,)).fetchone()
+        return item_hash if res is None else res[0]
+
+    @attach_detach
+    def resolve_hash(self, item_hash):
+        """Returns the current hash of an item, which may have changed since
+        item_hash was stored if the content of the item was edited"""
+        return self._resolve_hash(self._get_cursor(), item_hash)
+
+    @attach_detach
+    def update(self, word_decks):
+        """Full reconciliation, finds all notes whose cards changed since the
+        last update"""
+        c = self._get_cursor()
+        lap = self.profiler.laps('update')
+
+        # 1. Find cards modified since the last update. Anki bumps cards.mod
+        # on every review and sets it when cards are added, imported or
+        # moved, (mod, id) is the high water mark since several changes can
+        # share a second. Synced cards keep the mod of the other device, but
+        # get a new usn, which is indexed
+        self._create_temp_table(c, 'rb_changed_cards', '''
+            SELECT id AS cid, nid, mod, usn, reps, lapses FROM cards
+            WHERE (mod, id) > (?, ?)
+            UNION
+            SELECT id AS cid, nid, mod, usn, reps, lapses FROM cards
+            WHERE usn > ?
+        ''', (self._get_meta(c, 'cards_mod', 0), self._get_meta(c, 'cards_id', 0),
+              self._get_meta(c, 'cards_usn', -1)))
+        self._create_temp_table(c, 'rb_changed_card_notes', '''
+            SELECT DISTINCT(nid) AS nid FROM temp.rb_changed_cards
+        ''')
+
+        # 1.1. Re-hash edited sentence notes
+        num_sentences = self._update_sentence_notes(c)
+        lap('sentence_notes', num_sentences)
+
+        # 1.2. Load user words of the notes of those cards, cross reference
+        # cedict and add note links
+        note_links = self._link_notes(c, word_decks, 'rb_changed_card_notes')
+        lap('link_notes', len(note_links))
+        self._migrate_marks(c)
+
         # 2. Update sum_reps and sum_lapses in rb.items
-        # 2.1. Find cards where a card's reps or lapses changed
+        # 2.1. Of the changed cards, find notes with cards where reps or
+        # lapses changed, and notes with cards that are new (not yet in
+        # rb.last_updated)
         changed = [r[0] for r in c.execute('''
-            SELECT DISTINCT(cards.nid) FROM cards
-            JOIN rb.last_updated ON cards.id=rb.last_updated.cid
-            WHERE (cards.reps != rb.last_updated.reps OR
-                   cards.lapses != rb.last_updated.lapses)
+            SELECT DISTINCT(changed.nid) FROM temp.rb_changed_cards AS changed
+            JOIN rb.last_updated ON changed.cid=rb.last_updated.cid
+            WHERE (changed.reps != rb.last_updated.reps OR
+                   changed.lapses != rb.last_updated.lapses)
         ''').fetchall()]
-
-        # 2.2. Find cards that are new (not yet present in rb.last_updated)
         new = [r[0] for r in c.execute('''
-            SELECT DISTINCT(nid) FROM cards
-            WHERE cards.id NOT IN (SELECT cid FROM rb.last_updated)
+            SELECT DISTINCT(changed.nid) FROM temp.rb_changed_cards AS changed
+            LEFT JOIN rb.last_updated ON changed.cid=rb.last_updated.cid
+            WHERE rb.last_updated.cid IS NULL
         ''').fetchall()]
 
-        # 2.3. Finally update the scores that have changed
-        # 2.3.1. Find item hashes that should be updated via note_links
-        updated_notes = changed+new
-
-        updated_item_hashes = c.execute(
-            'SELECT DISTINCT(hash) FROM rb.note_links WHERE nid IN (%s)'
-            % ','.join(str(n) for n in updated_notes)
-        ).fetchall()
-        updated_item_hashes = [h[0] for h in updated_item_hashes]
-        
-        # 2.3.2. Update the items with changed notes
-        c.executemany('''
-            UPDATE rb.items SET max_correct=(
-                SELECT MAX(reps-lapses)
-                FROM rb.note_links JOIN cards ON rb.note_links.nid = cards.nid
-                WHERE rb.note_links.hash = ?
-            )
-            WHERE hash = ?
-        ''', [2*(h,) for h in updated_item_hashes])
+        lap('changed_cards', len(changed) + len(new))
 
-        # 2.3.3. Find linked items (parents) via item_links and update those
-        # parents
-        parent_hashes = c.execute(
-            'SELECT DISTINCT(from_hash) FROM rb.item_links WHERE to_hash IN (%s)' %
-            ','.join('"%s"' % s for s in updated_item_hashes)).fetchall()
-        parent_hashes = [h[0] for h in parent_hashes]
-
-        l = self.completed_hsk_lvl
-        properties = [('num_known', 'AND (max_correct > 8 OR hsk_lvl <= %i)' % l),
-                      ('num_memorizing', 'AND (max_correct BETWEEN 5 AND 8 AND hsk_lvl > %i)' % l),
-                      ('num_learning', 'AND (max_correct BETWEEN 1 AND 4 AND hsk_lvl > %i)' % l),
-                      ('num_unknown', 'AND (max_correct = 0 AND hsk_lvl > %i)' % l),
-                      ('num_links', '')]
-        for prop in properties:
-            c.executemany('''
-                UPDATE rb.items SET
-                    %s=(
-                        SELECT COUNT(*) FROM rb.item_links
-                        JOIN rb.items ON rb.items.hash=rb.item_links.to_hash
-                        JOIN rb.hsk ON rb.items.hash=rb.hsk.hash
-                        WHERE from_hash=? %s
-                    )
-                WHERE hash = ?
-            ''' % prop, [2*(h,) for h in parent_hashes])
+        # 2.2. Strength decays without reviews, so then all linked notes are
+        # rescored once a day
+        updated = changed + new
+        rescored = False
+        day = int(time() // 86400)
+        if (self._get_meta(c, 'scoring', 'reps') == 'strength' and
+                self._get_meta(c, 'scoring_day') != day):
+            updated += [r[0] for r in c.execute('SELECT DISTINCT(nid) FROM rb.note_links')]
+            self._set_meta(c, 'scoring_day', day)
+            rescored = True
+
+        # 2.3. Finally update the scores that have changed
+        self._create_temp_ids(c, 'rb_updated_notes', 'nid', updated)
+        num_parents = self._update_scores(c)
+        lap('scores', num_parents)
 
         # 2.4. Update the rb.last_updated table with the changed and new values
-        # 2.4.1 Update the rb.last_updated table by first updating changes
-        c.execute('''
-            UPDATE rb.last_updated
-            SET reps=(SELECT reps FROM cards WHERE rb.last_updated.cid=cards.id),
-                lapses=(SELECT lapses FROM cards WHERE rb.last_updated.cid=cards.id)
-            WHERE rb.last_updated.nid IN (%s)
-        ''' % ', '.join(str(c) for c in changed))
+        self._update_last_updated(c, True)
 
-        # 2.4.2 Then inserting new
-        c.execute('''
-            INSERT INTO rb.last_updated (cid, nid, reps, lapses)
-            SELECT id, nid, reps, lapses FROM cards
-            WHERE nid IN (%s)
-        ''' % ', '.join(str(n) for n in new))
+        self._save_index()
+        lap('save')
+        if num_sentences or note_links or changed or new or rescored:
+            self.bump_version()
+
+        return len(new), len(changed), num_parents
 
-        return len(new), len(changed), len(parent_hashes)
+    @property
+    @attach_detach
+    def scoring(self):
+        return self._get_meta(self._get_cursor(), 'scoring', 'reps')
+
+    @attach_detach
+    def set_scoring(self, scoring):
+        """Scores words by 'reps', the highest reps-lapses of their cards, or
+        by 'strength', which accounts for the interval and the time since the
+        last review (see strength.py), and rescores all linked words"""
+        if scoring not in SCORINGS:
+            raise ValueError('Unknown scoring %r' % scoring)
+        c = self._get_cursor()
+        self._set_meta(c, 'scoring', scoring)
+        self._set_meta(c, 'scoring_day', int(time() // 86400))
+        self._create_temp_table(c, 'rb_updated_notes', '''
+            SELECT DISTINCT(nid) AS nid FROM rb.note_links
+        ''')
+        self._update_scores(c)
+        self._save_index()
+        self.bump_version()
 
     @attach_detach
+    def update_notes(self, nids, word_decks):
+        """Updates only the given notes, e.g. ones that were just reviewed or
+        added, without scanning the rest of the collection"""
+        nids = sorted(set(nids))
+        if len(nids) == 0:
+            return 0
+        c = self._get_cursor()
+        lap = self.profiler.laps('update_notes')
+
+        self._create_temp_ids(c, 'rb_updated_notes', 'nid', nids)
+        self._link_notes(c, word_decks, 'rb_updated_notes')
+        num_parents = self._update_scores(c)
+        lap('scores', num_parents)
+        self._create_temp_table(c, 'rb_changed_cards', '''
+            SELECT id AS cid, nid, mod, usn, reps, lapses FROM cards
+            WHERE nid IN (SELECT nid FROM temp.rb_updated_notes)
+        ''')
+        self._update_last_updated(c, False)
+
+        self._save_index()
+        lap('save')
+        self.bump_version()
+        return num_parents
+
     def search(self, filter_text=None, limit=-1, num_unknown=-1):
+        key = (filter_text, num_unknown, limit, self.completed_hsk_lvl, self.version)
+        results = self.search_cache.get(key)
+        if results is None:
+            results = self._search(filter_text, limit, num_unknown)
+            self.search_cache[key] = results
+            if len(self.search_cache) > self.search_cache_size:
+                self.search_cache.popitem(last=False)
+        else:
+            self.search_cache.move_to_end(key)
+        return list(results)
+
+    @attach_detach
+    def _search(self, filter_text, limit, num_unknown):
         c = self._get_cursor()
+        lap = self.profiler.laps('search')
+        self._create_marks(c)
+        self._create_duplicates(c)
 
         filter_clause = ''
         if filter_text is not None:
@@ -465,7 +1542,7 @@ class RememberberryDatabase:
 
         unknown_clause = ''
         if num_unknown >= 0:
-            unknown_clause = 'AND num_unknown=%i' % num_unknown
+            unknown_clause = 'AND %s=%i' % (self._num_unknown_sql(), num_unknown)
 
         limit_clause = ''
         if limit >= 0:
@@ -473,34 +1550,389 @@ class RememberberryDatabase:
 
         items = c.execute('''
             SELECT hash, data_simplified, data_pinyin, data_translation FROM rb.items
-            WHERE rb.items.type = 'user_sentence' AND NOT EXISTS
+            WHERE rb.items.type IN (%s) AND NOT EXISTS
             (SELECT * FROM rb.note_links WHERE rb.note_links.hash=rb.items.hash)
+            AND NOT EXISTS (SELECT * FROM rb.marks WHERE rb.marks.hash=rb.items.hash)
+            AND NOT EXISTS (SELECT * FROM rb.duplicates WHERE rb.duplicates.hash=rb.items.hash)
             %s %s %s
-        ''' % (unknown_clause, filter_clause, limit_clause)).fetchall()
-
+        ''' % (SENTENCE_TYPES_SQL, unknown_clause, filter_clause, limit_clause)).fetchall()
+        # Sentences are displayed, the pinyin and translation of the words
+        # are left encoded until they are used, see decode()
+        decode = self._get_codec().decode
+        items = [(h, hz, decode(py), decode(transl)) for h, hz, py, transl in items]
+        lap('items', len(items))
+
+        # Words come with their bucket (BUCKET_*) for highlighting
+        words_query = '''
+            SELECT rb.items.hash, pointer, max_correct, hsk_lvl, data_pinyin,
+                   data_translation, %s
+            FROM rb.item_links
+            JOIN rb.items ON rb.item_links.to_hash = rb.items.hash
+            JOIN rb.hsk ON rb.hsk.hash=rb.items.hash
+            WHERE rb.item_links.from_hash=?
+        ''' % _bucket_sql(self.completed_hsk_lvl)
         item_words = []
         for h, *_ in items:
-            words = c.execute('''
-                SELECT rb.items.hash, pointer, max_correct, hsk_lvl, data_pinyin, data_translation
-                FROM rb.item_links
-                JOIN rb.items ON rb.item_links.to_hash = rb.items.hash
-                JOIN rb.hsk ON rb.hsk.hash=rb.items.hash
-                WHERE rb.item_links.from_hash=?
-            ''', (h,)).fetchall()
+            words = c.execute(words_query, (h,)).fetchall()
 
             # Conver the pointer to int tuple
             words = [(h, [int(p) for p in ptr.split('-')], *r)
                      for (h, ptr, *r) in words]
             item_words.append(words)
-            
+        lap('words', sum(len(words) for words in item_words))
+
         return list(zip(items, item_words))
 
+    def find_sentences(self, max_unknown=1, word_hash=None, limit=-1, exact=False):
+        """Finds sentences with at most max_unknown unknown words (exactly
+        max_unknown if exact is set), optionally containing word_hash, using
+        the in-memory knowledge index"""
+        if self.index is None:
+            return []
+        results = []
+        for h in self.index.find_sentences(max_unknown, word_hash,
+                                           self.completed_hsk_lvl, exact):
+            if len(results) == limit:
+                break
+            results.append(h)
+        return results
+
     @attach_detach
+    def suggest_words(self, limit=50):
+        """Ranks unknown words by how many sentences they would complete,
+        i.e. sentences where it is the only unknown word, and then by the total
+        number of sentences containing it"""
+        c = self._get_cursor()
+        self._create_marks(c)
+        decode = self._get_codec().decode
+        # Words completing sentences, and then the rest, are each read in
+        # the order of an index (word_only_unknown_rank and word_stats_rank)
+        # and stop at the limit, only the two short lists are sorted
+        words_sql = '''
+            SELECT rb.word_stats.hash, data_simplified, data_pinyin,
+                   data_translation, rb.word_stats.hsk_lvl,
+                   rb.word_stats.num_sentences, %s AS num_only_unknown
+            FROM %s
+            JOIN rb.items ON rb.items.hash=rb.word_stats.hash
+            WHERE %s AND rb.word_stats.hsk_lvl > :completed AND ''' + _UNKNOWN_SQL + '''
+            AND NOT EXISTS
+            (SELECT * FROM rb.note_links WHERE rb.note_links.hash=rb.word_stats.hash)
+            AND NOT EXISTS (SELECT * FROM rb.marks WHERE rb.marks.hash=rb.word_stats.hash)
+            ORDER BY %s
+            LIMIT :limit
+        '''
+        rows = c.execute('''
+            SELECT * FROM (%s) UNION ALL SELECT * FROM (%s)
+            ORDER BY num_only_unknown DESC, num_sentences DESC
+            LIMIT :limit
+        ''' % (words_sql % (
+                   'only.num_sentences',
+                   '''rb.word_only_unknown AS only
+                      JOIN rb.word_stats ON rb.word_stats.hash=only.hash''',
+                   'only.lvl=:lvl',
+                   'only.num_sentences DESC, rb.word_stats.num_sentences DESC'),
+               words_sql % (
+                   '0', 'rb.word_stats',
+                   '''NOT EXISTS (SELECT * FROM rb.word_only_unknown AS only
+                                  WHERE only.lvl=:lvl AND only.hash=rb.word_stats.hash)''',
+                   'rb.word_stats.num_sentences DESC')),
+            {'lvl': min(self.completed_hsk_lvl, HIST_LEVELS - 1),
+             'completed': self.completed_hsk_lvl, 'limit': limit}).fetchall()
+        return [(h, hz, decode(py), decode(tr), *rest) for h, hz, py, tr, *rest in rows]
+
+    @attach_detach
+    def lookup(self, query, limit=20):
+        """Looks up cedict words by hanzi, pinyin (with tone numbers, tone
+        marks or without tones) or English words of their definitions.
+        Returns [(hash, simplified, pinyin, translation, hsk_lvl,
+        num_sentences), ...], best matches first: exact hanzi and pinyin,
+        then definitions, shortest first, then pinyin prefixes"""
+        c = self._get_cursor()
+        query = query.strip()
+        if query == '':
+            return []
+        # Databases from before BASE_VERSION 4 have no index yet
+        if c.execute('''
+                SELECT name FROM rb.sqlite_master WHERE type='table' AND name='pinyin_index'
+                ''').fetchone() is None:
+            self._create_lookup_index(c)
+
+        # Ranks of the matching hashes, lower is better
+        ranks = {}
+        def _add(h, rank):
+            if h not in ranks or rank < ranks[h]:
+                ranks[h] = rank
+
+        if has_hanzi(query):
+            h = self._get_cedict_hashes().get(filter_text_hanzi(query))
+            if h is not None:
+                _add(h, (0, 0))
+        else:
+            key = query_pinyin_key(query)
+            if key is not None:
+                for h, in c.execute('SELECT hash FROM rb.pinyin_index WHERE key=?', (key,)):
+                    _add(h, (0, 0))
+                # Keys starting with the query, a range scan of the primary key
+                end = key[:-1] + chr(ord(key[-1]) + 1)
+                for prefix_key, h in c.execute('''
+                        SELECT key, hash FROM rb.pinyin_index
+                        WHERE key > ? AND key < ? ORDER BY key LIMIT ?
+                        ''', (key, end, limit * 10)):
+                    _add(h, (2, len(prefix_key)))
+
+            # Items with all the words of the query in their definitions
+            gloss_ranks = None
+            for word in query_gloss_words(query):
+                word_ranks = dict(c.execute('''
+                    SELECT hash, def_len FROM rb.gloss_index WHERE word=?
+                    ''', (word,)))
+                if gloss_ranks is None:
+                    gloss_ranks = word_ranks
+                else:
+                    gloss_ranks = {h: l + word_ranks[h] for h, l in gloss_ranks.items()
+                                   if h in word_ranks}
+            for h, def_len in (gloss_ranks or {}).items():
+                _add(h, (1, def_len))
+
+        if len(ranks) == 0:
+            return []
+        self._create_temp_ids(c, 'rb_lookup_hashes', 'hash', ranks)
+        rows = c.execute('''
+            SELECT rb.items.hash, data_simplified, data_pinyin, data_translation,
+                   rb.hsk.hsk_lvl, IFNULL(rb.word_stats.num_sentences, 0)
+            FROM temp.rb_lookup_hashes
+            JOIN rb.items ON rb.items.hash=temp.rb_lookup_hashes.hash
+            JOIN rb.hsk ON rb.hsk.hash=rb.items.hash
+            LEFT JOIN rb.word_stats ON rb.word_stats.hash=rb.items.hash
+        ''').fetchall()
+        rows.sort(key=lambda r: (ranks[r[0]], -r[5], r[4]))
+        decode = self._get_codec().decode
+        return [(h, hz, decode(py), decode(tr), *rest)
+                for h, hz, py, tr, *rest in rows[:limit]]
+
     def add_note_link(self, item_hash, nid):
+        self.add_note_links([(item_hash, nid)])
+
+    @attach_detach
+    def add_note_links(self, pairs):
+        """Links (item_hash, nid) pairs in a single transaction"""
+        pairs = list(pairs)
+        if len(pairs) == 0:
+            return
         c = self._get_cursor()
-        c.execute('''
+        # The hashes may come from search results from before an edit
+        pairs = [(self._resolve_hash(c, item_hash), nid) for item_hash, nid in pairs]
+        c.executemany('''
             INSERT OR IGNORE INTO rb.note_links VALUES (?, ?, date('now'))
-        ''', (item_hash, nid))
+        ''', pairs)
+        self.bump_version()
+
+        if self.index is not None:
+            for item_hash, nid in pairs:
+                if self.index.link_sentence(item_hash):
+                    self.index_dirty = True
+                else:
+                    self.index_dirty |= self.index.link_note(nid, item_hash)
+            self._save_index()
+
+    @attach_detach
+    def set_marks(self, hashes, mark_type):
+        """Marks the items with mark_type, 'known' or 'ignore' ('' to unmark),
+        in a single transaction"""
+        hashes = list(hashes)
+        if len(hashes) == 0:
+            return
+        c = self._get_cursor()
+        self._create_marks(c)
+        # The hashes may come from search results from before an edit
+        hashes = [self._resolve_hash(c, h) for h in hashes]
+        if mark_type == '':
+            c.executemany('DELETE FROM rb.marks WHERE hash=?', [(h,) for h in hashes])
+        else:
+            c.executemany('''
+                INSERT OR REPLACE INTO rb.marks VALUES (?, ?, datetime('now'))
+            ''', [(h, mark_type) for h in hashes])
+        self.bump_version()
+
+    def sentence_count(self, nid):
+        """Number of sentences available (not yet added) for a note"""
+        if self.index is None:
+            return 0
+        return self.index.note_sentence_count(nid)
+
+    @attach_detach
+    def export_corpus(self, filename, types=('cedict',) + SENTENCE_TYPES, license=None):
+        """Writes items of the given types with their links to a flat file
+        corpus, see flatfile.py"""
+        c = self._get_cursor()
+        links_c = self._get_cursor()
+
+        decode = self._get_codec().decode
+
+        def _items():
+            # cedict items first, so that links point backwards in the file
+            for h, item_type, sm, tr, py, transl in c.execute('''
+                    SELECT hash, type, data_simplified, data_traditional,
+                           data_pinyin, data_translation
+                    FROM rb.items WHERE type IN (%s)
+                    ORDER BY type != 'cedict'
+                    ''' % ', '.join('?' * len(types)), types):
+                links = links_c.execute('''
+                    SELECT pointer, to_hash FROM rb.item_links WHERE from_hash=?
+                ''', (h,)).fetchall()
+                yield (h, item_type, sm, decode(tr), decode(py), decode(transl)), links
+
+        return write_corpus(filename, _items(), license)
+
+    @attach_detach
+    def import_corpus(self, filename, batch_size=10000):
+        """Adds the items and links of a flat file corpus, e.g. a shared
+        sentence corpus, without segmenting anything. Returns the number of
+        items read"""
+        c = self._get_cursor()
+        self._check_initiated(c)
+        self._create_temp_ids(c, 'rb_imported_items', 'hash', [])
+
+        num = 0
+        items, links = [], []
+        def _flush():
+            # Near-duplicate sentences are left out, see dedup.py
+            words = defaultdict(list)
+            for h, to_hash, pointer in links:
+                words[h].append((int(pointer.split('-')[0]), to_hash))
+            duplicates = self._find_duplicates(c, [
+                (item[0], [to_hash for _, to_hash in sorted(words[item[0]])])
+                for item in items if item[1] in SENTENCE_TYPES])
+            if duplicates:
+                items[:] = [item for item in items if item[0] not in duplicates]
+                links[:] = [link for link in links if link[0] not in duplicates]
+            # Items already in the database are counted already
+            existing = set(h for h, in iter_chunked(c, '''
+                SELECT hash FROM rb.items WHERE hash IN ({ids})
+            ''', [item[0] for item in items]))
+            c.executemany('''INSERT OR IGNORE INTO rb.items VALUES (
+                               ?, NULL, ?, ?, ?, ?, ?, 0, 0, 0, 0, 0
+                             )''', items)
+            c.executemany('INSERT OR IGNORE INTO rb.item_links VALUES (?, ?, ?)', links)
+            c.executemany('INSERT OR IGNORE INTO temp.rb_imported_items VALUES (?)',
+                          [(item[0],) for item in items if item[0] not in existing])
+            del items[:], links[:]
+
+        encode = self._get_codec().encode
+        for (h, item_type, sm, tr, py, transl), item_links in iter_corpus(filename):
+            items.append((h, item_type, encode(tr), sm, encode(py), encode(transl)))
+            links.extend((h, to_hash, pointer) for pointer, to_hash in item_links)
+            num += 1
+            if len(items) >= batch_size:
+                _flush()
+        _flush()
+
+        # Words which were not in our cedict need an hsk level
+        new_words = c.execute('''
+            SELECT hash, data_simplified FROM rb.items
+            WHERE type = 'cedict' AND hash IN (SELECT hash FROM temp.rb_imported_items)
+            AND hash NOT IN (SELECT hash FROM rb.hsk)
+        ''').fetchall()
+        new_words = [(h, self._get_hsk_lvl(hz)) for h, hz in new_words]
+        c.executemany('INSERT OR IGNORE INTO rb.hsk VALUES (?, ?)', new_words)
+        if len(new_words) > 0:
+            self.cedict_hashes = None
+
+        # Count the words of the new items, and add the new sentences to the
+        # statistics of the words they contain
+        self._create_temp_table(c, 'rb_imported_parents', '''
+            SELECT DISTINCT(from_hash) AS hash FROM rb.item_links
+            WHERE from_hash IN (SELECT hash FROM temp.rb_imported_items)
+        ''')
+        self._update_counts(c, 'SELECT hash FROM temp.rb_imported_parents')
+        self._start_word_stats(c)
+        self._collect_word_stats(c, 'SELECT hash FROM temp.rb_imported_parents', 1)
+        self._apply_word_stats(c)
+
+        if self.index is not None:
+            for h, word_level in new_words:
+                self.index.add_word(h, word_level)
+                self.index_dirty = True
+        self._index_sentences(c, '''
+            SELECT hash FROM rb.items WHERE type != 'cedict'
+            AND hash IN (SELECT hash FROM temp.rb_imported_items)
+        ''')
+        self._save_index()
+
+        self.bump_version()
+        return num
+
+    def _index_sentences(self, c, hashes_query):
+        # Adds the sentences selected by hashes_query which are not in the
+        # knowledge index yet
+        if self.index is None:
+            return
+        hashes = [h for h, in c.execute(hashes_query)
+                  if h not in self.index.sentence_ids]
+        sentence_words = defaultdict(list)
+        for from_hash, to_hash in iter_chunked(self._get_cursor(), '''
+                SELECT from_hash, to_hash FROM rb.item_links
+                WHERE from_hash IN ({ids})
+                ''', hashes):
+            sentence_words[from_hash].append(to_hash)
+        for h in hashes:
+            self.index.add_sentence(h, sentence_words[h])
+            self.index_dirty = True
+
+    @attach_detach
+    def import_sentences(self, filename, batch_size=5000, processes=1):
+        """Imports sentences from a TSV or JSONL file as corpus sentences, see
+        importer.py. An interrupted import of the same file continues where it
+        stopped. Returns the number of new sentences, which are neither
+        duplicates nor near-duplicates (see dedup.py)"""
+        c = self._get_cursor()
+        self._check_initiated(c)
+        progress_key = 'import:%s' % os.path.abspath(filename)
+        offset = self._get_meta(c, progress_key, 0)
+        cedict_hashes = self._get_cedict_hashes()
+
+        encode = self._get_codec().encode
+        num_added = 0
+        batches = importer.iter_batches(filename, offset, batch_size)
+        for end_offset, segmented in importer.iter_segmented(
+                batches, set(cedict_hashes), processes):
+            # Sentences are content addressed, so duplicates (also of
+            # sentences from Anki notes) are ignored on insert, and
+            # near-duplicates are left out altogether
+            hashed = [(_get_content_hash([None, hz, py, transl]), (hz, py, transl), tokens)
+                      for (hz, py, transl), tokens in segmented]
+            duplicates = self._find_duplicates(c, [
+                (h_64, [cedict_hashes[word] for word, _, _ in tokens])
+                for h_64, _, tokens in hashed])
+            items, links = [], []
+            for h_64, (hz, py, transl), tokens in hashed:
+                if h_64 in duplicates:
+                    continue
+                items.append((h_64, hz, encode(py), encode(transl)))
+                for word, start, end in tokens:
+                    links.append((h_64, cedict_hashes[word], '%i-%i' % (start, end)))
+
+            c.executemany('''INSERT OR IGNORE INTO rb.items VALUES (
+                               ?, NULL, '%s', NULL, ?, ?, ?, 0, 0, 0, 0, 0
+                             )''' % importer.ITEM_TYPE, items)
+            num_added += c.rowcount
+            c.executemany('INSERT OR IGNORE INTO rb.item_links VALUES (?, ?, ?)', links)
+
+            # Count the words of the batch and commit it together with the
+            # progress, so that a resumed import starts after this batch
+            self._create_temp_ids(c, 'rb_imported_items', 'hash', [i[0] for i in items])
+            self._update_counts(c, 'SELECT hash FROM temp.rb_imported_items')
+            self._set_meta(c, progress_key, end_offset)
+            self.col.conn.commit()
+
+        # Word statistics and the index also cover batches of earlier,
+        # interrupted runs
+        self._update_word_stats(c)
+        self._index_sentences(c, "SELECT hash FROM rb.items WHERE type='%s'"
+                              % importer.ITEM_TYPE)
+        self._save_index()
+        self.bump_version()
+        return num_added
 
     @attach_detach
     def get_note_links(self, limit=-1):
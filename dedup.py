@@ -0,0 +1,142 @@
+"""
+Near-duplicate sentences
+
+Corpora are full of sentences which only differ in punctuation or a word.
+Sentences are compared by their segmented words (the cedict item hashes of
+their links, in order), so punctuation and other non-words are already left
+out. The shingles of a sentence are its words and pairs of adjacent words,
+and two sentences are near-duplicates when the Jaccard similarity of their
+shingles is at least THRESHOLD.
+
+Candidates are found with MinHash and LSH: the NUM_PERM minimum hashes of a
+sentence are split into BANDS bands of ROWS, and sentences sharing any band
+are compared. With 16 bands of 4 rows, sentences at THRESHOLD are found 89%
+of the time and at 0.7 99% of the time. Candidates are verified on their
+actual shingles, so a band collision never makes a false duplicate.
+
+Signatures of a batch of sentences are computed in one numpy pass, or in
+plain Python when numpy isn't available. Shingles are hashed with zlib.crc32
+rather than hash(), which is salted per process, since band keys are kept in
+the database (see RememberberryDatabase._find_duplicates).
+"""
+import zlib
+from random import Random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+THRESHOLD = 0.6
+
+# A Mersenne prime, small enough that a*x+b fits in 64 bits
+_PRIME = (1 << 31) - 1
+_rng = Random(7)
+_A = [_rng.randrange(1, _PRIME) for _ in range(NUM_PERM)]
+_B = [_rng.randrange(0, _PRIME) for _ in range(NUM_PERM)]
+# Odd multipliers which mix the rows (and the number) of a band into its key
+_MIX = [_rng.getrandbits(64) | 1 for _ in range(ROWS + 1)]
+_MASK = (1 << 64) - 1
+# Sentences per numpy pass, bounds the NUM_PERM x shingles matrix
+_CHUNK = 1000
+if np is not None:
+    _A_ARRAY = np.array(_A, dtype=np.int64)[:, None]
+    _B_ARRAY = np.array(_B, dtype=np.int64)[:, None]
+    _MIX_ARRAY = np.array(_MIX[:ROWS], dtype=np.uint64)
+    _BAND_OFFSETS = (np.arange(1, BANDS + 1, dtype=np.uint64) *
+                     np.uint64(_MIX[ROWS]))
+
+
+def shingles(words):
+    """Returns the set of shingles of a sentence with the words (item hashes)
+    words, in order"""
+    result = set(words)
+    result.update(a + ' ' + b for a, b in zip(words, words[1:]))
+    return result
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _shingle_hashes(sentence_shingles):
+    return [zlib.crc32(s.encode('utf-8')) % _PRIME for s in sentence_shingles]
+
+
+def signature(sentence_shingles):
+    """Returns the NUM_PERM minimum hashes of a non-empty set of shingles"""
+    hashes = _shingle_hashes(sentence_shingles)
+    return [min((a * x + b) % _PRIME for x in hashes) for a, b in zip(_A, _B)]
+
+
+def _band_keys_python(sig):
+    keys = []
+    for band in range(BANDS):
+        key = (band + 1) * _MIX[ROWS]
+        for row in range(ROWS):
+            key += sig[band*ROWS + row] * _MIX[row]
+        key &= _MASK
+        keys.append(key - (1 << 64) if key >= (1 << 63) else key)
+    return keys
+
+
+def _band_keys_numpy(shingle_sets):
+    hashes = [_shingle_hashes(s) for s in shingle_sets]
+    offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+    x = np.fromiter((h for sentence in hashes for h in sentence), dtype=np.int64)
+    sigs = np.minimum.reduceat((_A_ARRAY * x[None, :] + _B_ARRAY) % _PRIME,
+                               offsets, axis=1).T
+    # uint64 arithmetic wraps around, like the masking in Python
+    rows = sigs.astype(np.uint64).reshape(len(hashes), BANDS, ROWS)
+    keys = (rows * _MIX_ARRAY).sum(axis=2, dtype=np.uint64) + _BAND_OFFSETS
+    return keys.view(np.int64).tolist()
+
+
+def band_keys(shingle_sets):
+    """Returns the BANDS LSH keys of each of a list of non-empty sets of
+    shingles, as signed 64 bit integers so that they can be stored in
+    SQLite"""
+    if np is None:
+        return [_band_keys_python(signature(s)) for s in shingle_sets]
+    keys = []
+    for i in range(0, len(shingle_sets), _CHUNK):
+        keys.extend(_band_keys_numpy(shingle_sets[i:i+_CHUNK]))
+    return keys
+
+
+class DuplicateFinder:
+    """Assigns sentences, one at a time, to the most similar earlier
+    sentence they are a near-duplicate of. Earlier sentences outside of the
+    finder, e.g. in the database, are passed as candidates"""
+    def __init__(self):
+        # Band key -> representative hashes, and their shingles
+        self.buckets = {}
+        self.representatives = {}
+
+    def add(self, h, sentence_shingles, keys, candidates=()):
+        """Returns (representative hash, similarity) if the sentence h is a
+        near-duplicate of one of the candidates ({hash: shingles}) or an
+        earlier added sentence, otherwise adds it as a representative and
+        returns None"""
+        candidates = dict(candidates)
+        for key in keys:
+            for rep in self.buckets.get(key, ()):
+                candidates[rep] = self.representatives[rep]
+
+        best, best_similarity = None, THRESHOLD
+        for rep, rep_shingles in candidates.items():
+            similarity = jaccard(sentence_shingles, rep_shingles)
+            if similarity >= best_similarity:
+                best, best_similarity = rep, similarity
+        if best is not None:
+            return best, best_similarity
+
+        self.representatives[h] = sentence_shingles
+        for key in keys:
+            self.buckets.setdefault(key, []).append(h)
+        return None
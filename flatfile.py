@@ -0,0 +1,153 @@
+"""
+Flat file corpus format (see NOTES.md, 2018-07-10)
+
+A corpus is a text file with one item per line,
+
+    hash/type/simplified/traditional/pinyin/translation/1-2:hash2/3-4:hash3
+
+where the trailing fields are links to other items, each a pointer (as stored
+in rb.item_links) and the hash of the linked item. '%', '/' and newlines in
+fields (including the base64 hashes) are escaped as %25, %2F and %0A, and NULL
+is written as %00. Lines starting with '#' are comments, e.g. the format
+version and a license which applies to the whole file.
+
+Next to the data file there are two memory mapped indexes with fixed size
+records, so that lookups are binary searches without loading the corpus:
+  <corpus>.idx        (hash, offset of the line) sorted by hash
+  <corpus>.links.idx  (linked hash, offset of the linking line) sorted by
+                      linked hash, i.e. a word to sentence index
+"""
+import os
+import mmap
+import struct
+
+FORMAT_VERSION = 1
+HASH_LEN = 16
+RECORD = struct.Struct('<%isQ' % HASH_LEN)
+
+
+def _escape(value):
+    if value is None:
+        return '%00'
+    return str(value).replace('%', '%25').replace('/', '%2F').replace('\n', '%0A')
+
+
+def _unescape(value):
+    if value == '%00':
+        return None
+    return value.replace('%0A', '\n').replace('%2F', '/').replace('%25', '%')
+
+
+def format_line(item, links):
+    """item is (hash, type, simplified, traditional, pinyin, translation) and
+    links a list of (pointer, to_hash)"""
+    fields = [_escape(v) for v in item]
+    fields += ['%s:%s' % (_escape(pointer), _escape(to_hash)) for pointer, to_hash in links]
+    return '/'.join(fields) + '\n'
+
+
+def parse_line(line):
+    fields = line.rstrip('\n').split('/')
+    item = tuple(_unescape(v) for v in fields[:6])
+    links = []
+    for field in fields[6:]:
+        pointer, to_hash = field.rsplit(':', 1)
+        links.append((_unescape(pointer), _unescape(to_hash)))
+    return item, links
+
+
+def _write_index(filename, records):
+    records.sort()
+    with open(filename, 'wb') as f:
+        for h, offset in records:
+            f.write(RECORD.pack(h, offset))
+
+
+def write_corpus(filename, items, license=None):
+    """Writes (item, links) pairs to filename and builds the indexes"""
+    hash_records = []
+    link_records = []
+    with open(filename, 'wb') as f:
+        f.write(('# rememberberry corpus %i\n' % FORMAT_VERSION).encode('utf-8'))
+        if license is not None:
+            for line in license.splitlines():
+                f.write(('# license: %s\n' % line).encode('utf-8'))
+        for item, links in items:
+            offset = f.tell()
+            f.write(format_line(item, links).encode('utf-8'))
+            hash_records.append((item[0].encode('ascii'), offset))
+            for _, to_hash in links:
+                link_records.append((to_hash.encode('ascii'), offset))
+
+    _write_index(filename + '.idx', hash_records)
+    _write_index(filename + '.links.idx', link_records)
+    return len(hash_records)
+
+
+def iter_corpus(filename):
+    """Streams (item, links) pairs from a corpus file"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            yield parse_line(line)
+
+
+class FlatCorpus:
+    """Random access to a corpus through its memory mapped indexes"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = open(filename, 'rb')
+        self.hash_index = self._map(filename + '.idx')
+        self.link_index = self._map(filename + '.links.idx')
+
+    def _map(self, filename):
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        for index in (self.hash_index, self.link_index):
+            if isinstance(index, mmap.mmap):
+                index.close()
+        self.data.close()
+
+    def __len__(self):
+        return len(self.hash_index) // RECORD.size
+
+    def _lower_bound(self, index, h):
+        lo, hi = 0, len(index) // RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(index, mid*RECORD.size)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _iter_offsets(self, index, h):
+        h = h.encode('ascii')
+        i = self._lower_bound(index, h)
+        while i*RECORD.size < len(index):
+            record_hash, offset = RECORD.unpack_from(index, i*RECORD.size)
+            if record_hash != h:
+                return
+            yield offset
+            i += 1
+
+    def _read_line(self, offset):
+        self.data.seek(offset)
+        return parse_line(self.data.readline().decode('utf-8'))
+
+    def get(self, h):
+        """Returns (item, links) for a hash, or None"""
+        for offset in self._iter_offsets(self.hash_index, h):
+            return self._read_line(offset)
+        return None
+
+    def linking_items(self, h):
+        """Yields (item, links) of all items linking to h, e.g. the sentences
+        containing a word"""
+        for offset in self._iter_offsets(self.link_index, h):
+            yield self._read_line(offset)
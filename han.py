@@ -14,8 +14,6 @@ import os
 import sys
 import logging
 
-from aqt.utils import showInfo
-
 sys.path.append(os.path.join(os.path.dirname(__file__), 'jieba'))
 import jieba
 
@@ -28,12 +26,8 @@ def is_hanzi(char):
               ('\u3400', '\u4DBF'),
               ('\uF900', '\uFAFF')]
     for start, end in ranges:
-        try:
-            if ord(char) >= ord(start) and ord(char) <= ord(end):
-                return True
-        except:
-            showInfo('%s %s %s' % (len(char), len(start), len(end)))
-            raise
+        if ord(char) >= ord(start) and ord(char) <= ord(end):
+            return True
     return False
 
 
@@ -49,3 +43,23 @@ def has_hanzi(text):
 
 def split_hanzi(text):
     return [w for w in jieba.cut(text, cut_all=True) if has_hanzi(w)]
+
+
+def segment_cedict(text, cedict):
+    """Splits text into (word, start, end) tokens of words in cedict (anything
+    supporting `in`), breaking up compounds which are not in cedict"""
+    # tokens can contain compounds which are not in cedict
+    # if that is the case, then break it down into its parts and
+    # add them separately (if in cedict)
+    cedict_tokens = []
+    for t in jieba.tokenize(text):
+        if t[0] in cedict:
+            cedict_tokens.append(t)
+            continue
+
+        parts = list(jieba.tokenize(t[0], mode='search'))
+        for tc in parts:
+            if tc[0] in cedict:
+                # Correct the indices for the sentence
+                cedict_tokens.append((tc[0], t[1]+tc[1], t[1]+tc[2]))
+    return cedict_tokens
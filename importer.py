@@ -0,0 +1,85 @@
+"""
+Streaming import of external sentence corpora
+
+Sentences are read from TSV files (hanzi, pinyin and translation columns) or
+JSONL files (objects with "hanzi", "pinyin" and "translation" keys) and go
+straight into rb.items and rb.item_links as 'corpus_sentence' items, without
+becoming Anki notes first. See RememberberryDatabase.import_sentences.
+
+Lines are read in batches, segmented (optionally in a pool of worker
+processes) and written one transaction per batch, together with the byte
+offset reached in the file, so an interrupted import continues where it left
+off.
+"""
+import json
+from multiprocessing import Pool
+
+from .han import segment_cedict
+
+ITEM_TYPE = 'corpus_sentence'
+
+
+def _parse_line(line, is_jsonl):
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+        return None
+    if is_jsonl:
+        d = json.loads(line)
+        return d.get('hanzi'), d.get('pinyin'), d.get('translation')
+    fields = line.split('\t')
+    fields += [None] * (3 - len(fields))
+    return tuple(fields[:3])
+
+
+def iter_batches(filename, offset=0, batch_size=5000):
+    """Yields (end_offset, [(hanzi, pinyin, translation), ...]) where
+    end_offset is the byte offset after the last line of the batch"""
+    is_jsonl = filename.endswith('.jsonl') or filename.endswith('.json')
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        batch = []
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            sentence = _parse_line(line.decode('utf-8'), is_jsonl)
+            if sentence is not None and sentence[0]:
+                batch.append(sentence)
+            if len(batch) >= batch_size:
+                yield f.tell(), batch
+                batch = []
+        if batch:
+            yield f.tell(), batch
+
+
+_worker_words = None
+
+def _init_worker(words):
+    global _worker_words
+    _worker_words = words
+
+
+def _segment_batch(batch):
+    return [(sentence, segment_cedict(sentence[0], _worker_words))
+            for sentence in batch]
+
+
+def iter_segmented(batches, words, processes=1):
+    """Yields (end_offset, [(sentence, tokens), ...]) for each batch,
+    segmenting in processes worker processes if more than one"""
+    if processes <= 1:
+        _init_worker(words)
+        for end_offset, batch in batches:
+            yield end_offset, _segment_batch(batch)
+        return
+
+    # Batches are segmented in order, so the offsets stay correct for resuming
+    offsets = []
+    def _batches():
+        for end_offset, batch in batches:
+            offsets.append(end_offset)
+            yield batch
+
+    with Pool(processes, initializer=_init_worker, initargs=(words,)) as pool:
+        for segmented in pool.imap(_segment_batch, _batches()):
+            yield offsets.pop(0), segmented
@@ -0,0 +1,329 @@
+"""
+In-memory index for "i+1" sentence queries (operation 1.5 in db.py)
+
+Every cedict word gets a small integer id, and its state is kept in a single
+byte: the knowledge bucket derived from max_correct in the low two bits and
+the hsk level above them. Sentences are stored as compact arrays of word ids.
+
+The effective bucket of every word for a given completed hsk level is then a
+single bytes.translate() of the state table, and counting unknown words in a
+sentence is a C level gather and count, so no python branching per word is
+needed. The index is pickled next to the rememberberry database and patched
+from RememberberryDatabase.update() as max_correct values change. Changes
+are appended to a log next to the pickle (see save_changes), which load()
+replays, so that only the occasional save() writes the whole index. The
+cached buckets and unknown counts are patched along with the changes rather
+than rebuilt.
+
+For operation 3 in db.py, each word also has a posting list of the sentences
+containing it, stored as delta encoded varints, together with a cached count
+of the sentences which are not yet linked to a note.
+"""
+import os
+import pickle
+from array import array
+from functools import lru_cache
+from operator import itemgetter
+
+KNOWN, MEMORIZING, LEARNING, UNKNOWN = 0, 1, 2, 3
+
+
+def correct_bucket(max_correct):
+    if max_correct is None or max_correct <= 0:
+        return UNKNOWN
+    if max_correct <= 4:
+        return LEARNING
+    if max_correct <= 8:
+        return MEMORIZING
+    return KNOWN
+
+
+def index_filename(db_filename):
+    return os.path.splitext(db_filename)[0] + '_index.pickle'
+
+
+def log_filename(filename):
+    return filename + '.log'
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_postings(data):
+    ids = array('I')
+    last, value, shift = -1, 0, 0
+    for b in data:
+        value |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        last += value
+        ids.append(last)
+        value, shift = 0, 0
+    return ids
+
+
+@lru_cache(maxsize=None)
+def _bucket_table(completed_hsk_lvl):
+    # Maps a state byte to the effective bucket, words at or below the
+    # completed hsk level are always known
+    table = bytearray(256)
+    for state in range(256):
+        hsk_lvl, bucket = state >> 2, state & 3
+        table[state] = KNOWN if hsk_lvl <= completed_hsk_lvl else bucket
+    return bytes(table)
+
+
+class KnowledgeIndex:
+    format_version = 2
+
+    def __init__(self):
+        self.word_ids = {}
+        self.word_hashes = []
+        self.state = bytearray()
+        self.sentence_ids = {}
+        self.sentence_hashes = []
+        self.sentence_words = []
+        self.linked = bytearray()
+        self.postings = []
+        self.posting_last = array('l')
+        self.available = array('I')
+        self.note_words = {}
+        self._buckets = {}
+        self._unknown_counts = {}
+        # Changes since the last save() or save_changes()
+        self._journal = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buckets'] = {}
+        state['_unknown_counts'] = {}
+        state['_journal'] = []
+        return state
+
+    def __setstate__(self, state):
+        # Indexes pickled before the log have no journal
+        state.setdefault('_journal', [])
+        self.__dict__.update(state)
+
+    @classmethod
+    def load(cls, filename):
+        if not os.path.exists(filename):
+            return None
+        with open(filename, 'rb') as f:
+            index = pickle.load(f)
+        if getattr(index, 'format_version', None) != cls.format_version:
+            return None
+        index._replay(log_filename(filename))
+        return index
+
+    def _replay(self, filename):
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb') as f:
+            while True:
+                try:
+                    changes = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    # The end, or a batch cut short by a crash
+                    break
+                for name, *args in changes:
+                    getattr(self, name)(*args)
+        self._journal = []
+
+    def save(self, filename):
+        """Writes the whole index, replacing the log of changes"""
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        # Replaying a log on top of the index it was already applied to
+        # gives the same index, so a crash before this is harmless
+        if os.path.exists(log_filename(filename)):
+            os.remove(log_filename(filename))
+        self._journal = []
+
+    def save_changes(self, filename):
+        """Appends the changes since the last save to the log of the index
+        saved as filename"""
+        if len(self._journal) == 0:
+            return
+        with open(log_filename(filename), 'ab') as f:
+            pickle.dump(self._journal, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal = []
+
+    def _set_state(self, wid, state):
+        # Patches the cached buckets, and the unknown counts of the
+        # sentences containing the word if it became (or stopped being)
+        # unknown at a cached level
+        old = self.state[wid]
+        if state == old:
+            return False
+        self.state[wid] = state
+        for lvl, buckets in self._buckets.items():
+            table = _bucket_table(lvl)
+            buckets[wid] = table[state]
+            counts = self._unknown_counts.get(lvl)
+            if counts is None or (table[old] == UNKNOWN) == (table[state] == UNKNOWN):
+                continue
+            delta = 1 if table[state] == UNKNOWN else -1
+            for sid in _decode_postings(self.postings[wid]):
+                counts[sid] += delta
+        return True
+
+    def add_word(self, word_hash, hsk_lvl, max_correct=0):
+        state = (min(hsk_lvl, 63) << 2) | correct_bucket(max_correct)
+        wid = self.word_ids.get(word_hash)
+        if wid is None:
+            wid = len(self.word_hashes)
+            self.word_ids[word_hash] = wid
+            self.word_hashes.append(word_hash)
+            self.state.append(state)
+            self.postings.append(bytearray())
+            self.posting_last.append(-1)
+            self.available.append(0)
+            for lvl, buckets in self._buckets.items():
+                buckets.append(_bucket_table(lvl)[state])
+        elif not self._set_state(wid, state):
+            return wid
+        self._journal.append(('add_word', word_hash, hsk_lvl, max_correct))
+        return wid
+
+    def add_sentence(self, sentence_hash, word_hashes):
+        # Sentences are content addressed, the same hash has the same words
+        sid = self.sentence_ids.get(sentence_hash)
+        if sid is not None:
+            return sid
+        word_hashes = list(word_hashes)
+        ids = array('I', sorted(set(self.word_ids[h] for h in word_hashes
+                                    if h in self.word_ids)))
+        sid = len(self.sentence_hashes)
+        self.sentence_ids[sentence_hash] = sid
+        self.sentence_hashes.append(sentence_hash)
+        self.sentence_words.append(ids)
+        self.linked.append(0)
+        for wid in ids:
+            _encode_varint(sid - self.posting_last[wid], self.postings[wid])
+            self.posting_last[wid] = sid
+            self.available[wid] += 1
+        for lvl, counts in self._unknown_counts.items():
+            counts.append(self._sentence_buckets(ids, self._buckets[lvl]).count(UNKNOWN))
+        self._journal.append(('add_sentence', sentence_hash, word_hashes))
+        return sid
+
+    def link_sentence(self, sentence_hash):
+        """Marks a sentence as linked to a note, returns False if the hash is
+        not a known sentence or it was already linked"""
+        sid = self.sentence_ids.get(sentence_hash)
+        if sid is None or self.linked[sid]:
+            return False
+        self.linked[sid] = 1
+        for wid in self.sentence_words[sid]:
+            self.available[wid] -= 1
+        self._journal.append(('link_sentence', sentence_hash))
+        return True
+
+    def remove_sentence(self, sentence_hash):
+        """Removes a sentence, e.g. one whose content was edited. Ids are
+        never reused, so the sentence is only marked as linked and forgotten,
+        adding the same hash again gives it a new id"""
+        if sentence_hash not in self.sentence_ids:
+            return False
+        self.link_sentence(sentence_hash)
+        del self.sentence_ids[sentence_hash]
+        self._journal.append(('remove_sentence', sentence_hash))
+        return True
+
+    def link_note(self, nid, word_hash):
+        wid = self.word_ids.get(word_hash)
+        if wid is None:
+            return False
+        wids = self.note_words.setdefault(nid, array('I'))
+        if wid in wids:
+            return False
+        wids.append(wid)
+        self._journal.append(('link_note', nid, word_hash))
+        return True
+
+    def sentences_with(self, word_hash):
+        wid = self.word_ids.get(word_hash)
+        if wid is None:
+            return array('I')
+        return _decode_postings(self.postings[wid])
+
+    def sentence_count(self, word_hash):
+        """Number of sentences containing the word which are not linked yet"""
+        wid = self.word_ids.get(word_hash)
+        return 0 if wid is None else self.available[wid]
+
+    def note_sentence_count(self, nid):
+        """Number of unlinked sentences containing all the words of a note"""
+        wids = self.note_words.get(nid)
+        if not wids:
+            return 0
+        if len(wids) == 1:
+            return self.available[wids[0]]
+        wids = sorted(wids, key=lambda wid: self.available[wid])
+        sids = set(_decode_postings(self.postings[wids[0]]))
+        for wid in wids[1:]:
+            if not sids:
+                break
+            sids.intersection_update(_decode_postings(self.postings[wid]))
+        return sum(1 for sid in sids if not self.linked[sid])
+
+    def set_max_correct(self, word_hash, max_correct):
+        """Returns True if the bucket of the word changed"""
+        wid = self.word_ids.get(word_hash)
+        if wid is None:
+            return False
+        if not self._set_state(wid, (self.state[wid] & ~3) | correct_bucket(max_correct)):
+            return False
+        self._journal.append(('set_max_correct', word_hash, max_correct))
+        return True
+
+    def buckets(self, completed_hsk_lvl=0):
+        buckets = self._buckets.get(completed_hsk_lvl)
+        if buckets is None:
+            buckets = bytearray(bytes(self.state).translate(_bucket_table(completed_hsk_lvl)))
+            self._buckets[completed_hsk_lvl] = buckets
+        return buckets
+
+    def _sentence_buckets(self, ids, buckets):
+        if len(ids) == 0:
+            return b''
+        if len(ids) == 1:
+            return bytes((buckets[ids[0]],))
+        return bytes(itemgetter(*ids)(buckets))
+
+    def unknown_counts(self, completed_hsk_lvl=0):
+        counts = self._unknown_counts.get(completed_hsk_lvl)
+        if counts is None:
+            buckets = self.buckets(completed_hsk_lvl)
+            unknown = bytes((UNKNOWN,))
+            counts = array('H', (self._sentence_buckets(ids, buckets).count(unknown)
+                                 for ids in self.sentence_words))
+            self._unknown_counts[completed_hsk_lvl] = counts
+        return counts
+
+    def find_sentences(self, max_unknown, word_hash=None, completed_hsk_lvl=0,
+                       exact=False):
+        """Yields hashes of sentences with at most (or exactly) max_unknown
+        unknown words, optionally only those containing word_hash"""
+        counts = self.unknown_counts(completed_hsk_lvl)
+        if word_hash is None:
+            sids = range(len(counts))
+        else:
+            sids = self.sentences_with(word_hash)
+        for sid in sids:
+            count = counts[sid]
+            if count > max_unknown or (exact and count != max_unknown):
+                continue
+            sentence_hash = self.sentence_hashes[sid]
+            if self.sentence_ids.get(sentence_hash) != sid:
+                # Removed
+                continue
+            yield sentence_hash
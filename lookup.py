@@ -0,0 +1,57 @@
+"""
+Keys for looking up CEDICT words by pinyin or English
+
+CEDICT pinyin ("Zhong1 guo2", "lu:4") is indexed twice, numbered and without
+tones, lowercased and without spaces ("zhong1guo2", "zhongguo"), so that
+queries match however they are typed: with or without spaces, with tone
+numbers, tone marks ("zhōngguó", looked up without tones) or none. ü is
+written v. Numbered keys always contain a digit and toneless ones never do,
+so both kinds share one index.
+
+Definitions are indexed by their lowercased words, leaving out the most
+common ones. See RememberberryDatabase.lookup.
+"""
+import re
+import unicodedata
+
+STOP_WORDS = frozenset(['a', 'an', 'the', 'to', 'of', 'and', 'or', 'in', 'on',
+                        'at', 'for', 'by', 'be', 'is', 'sb', 'sth', 'etc'])
+
+_GLOSS_WORD_RE = re.compile(r"[a-z0-9']+")
+# Combining macron, acute, caron and grave
+_TONE_MARKS = frozenset('\u0304\u0301\u030c\u0300')
+
+
+def pinyin_keys(pinyin):
+    """Returns the (numbered, toneless) keys of a CEDICT pinyin string"""
+    numbered = re.sub(r'[^a-z0-9]', '', pinyin.lower().replace('u:', 'v'))
+    return numbered, re.sub(r'[0-9]', '', numbered)
+
+
+def query_pinyin_key(query):
+    """Returns the key a query would match as pinyin, or None if it can't be
+    pinyin"""
+    query = unicodedata.normalize('NFD', query.lower().replace('u:', 'v'))
+    query = query.replace('u\u0308', 'v')
+    has_tone_marks = any(c in _TONE_MARKS for c in query)
+    key = ''.join(c for c in query if not unicodedata.combining(c))
+    key = re.sub(r"[\s'\-]", '', key)
+    if has_tone_marks:
+        key = re.sub(r'[0-9]', '', key)
+    if re.fullmatch(r'[a-z]+[a-z0-9]*', key) is None:
+        return None
+    return key
+
+
+def gloss_words(translation):
+    """Yields (word, length of the definition) for the words of the
+    '/'-separated definitions of an entry"""
+    for definition in translation.split('/'):
+        words = _GLOSS_WORD_RE.findall(definition.lower())
+        for word in words:
+            if word not in STOP_WORDS:
+                yield word, len(words)
+
+
+def query_gloss_words(query):
+    return [w for w in _GLOSS_WORD_RE.findall(query.lower()) if w not in STOP_WORDS]
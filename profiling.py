@@ -0,0 +1,235 @@
+"""
+Opt-in timing instrumentation
+
+A Profiler records the time and row count of named phases (segmentation,
+hashing, the steps of init/update/search, rendering) and, through
+ProfiledCursor, of every SQL statement. Disabled, which is the default, a
+phase costs a method call and the cursor isn't wrapped at all.
+
+Recorded phases are kept as totals, as a rolling window of recent samples for
+percentiles and histograms (shown in the Debug tab of the widget), and are
+written as one JSON object per phase to the 'rememberberry.profile' logger.
+cProfile and an SQL statement trace can additionally be dumped to files.
+"""
+import re
+import json
+import logging
+import cProfile
+from time import time
+from collections import deque, OrderedDict
+
+logger = logging.getLogger('rememberberry.profile')
+
+
+class _NullPhase:
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_phase = _NullPhase()
+
+
+def _null_lap(name, rows=None):
+    pass
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.rows = None
+
+    def __enter__(self):
+        self.t0 = time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, time() - self.t0, self.rows)
+        return False
+
+
+class _Stats:
+    def __init__(self, window):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.max = 0.0
+        self.samples = deque(maxlen=window)
+
+
+class Profiler:
+    def __init__(self, enabled=False, window=500, log_phases=True):
+        self.enabled = enabled
+        self.window = window
+        self.log_phases = log_phases
+        self.stats = OrderedDict()
+        self.cprofile = None
+        self.trace_file = None
+
+    def phase(self, name):
+        """Context manager timing a phase, set .rows on it to record a row
+        count, e.g. with profiler.phase('init.links') as p: p.rows = n"""
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name)
+
+    def laps(self, prefix):
+        """Returns a function which records the time since it was last called
+        (or since laps() was called) as the phase prefix.name, for timing the
+        steps of a longer method"""
+        if not self.enabled:
+            return _null_lap
+        last = [time()]
+        def _lap(name, rows=None):
+            now = time()
+            self.record('%s.%s' % (prefix, name), now - last[0], rows)
+            last[0] = now
+        return _lap
+
+    def record(self, name, seconds, rows=None):
+        if not self.enabled:
+            return
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = _Stats(self.window)
+        stats.count += 1
+        stats.seconds += seconds
+        stats.max = max(stats.max, seconds)
+        stats.samples.append(seconds)
+        if rows is not None and rows >= 0:
+            stats.rows += rows
+        if self.log_phases and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps({'phase': name, 'seconds': seconds, 'rows': rows}))
+
+    def reset(self):
+        self.stats.clear()
+
+    def summary(self):
+        """Returns {phase: {count, seconds, rows, mean, p50, p90, max}}, with
+        the percentiles over the recent samples"""
+        summary = OrderedDict()
+        for name, stats in self.stats.items():
+            samples = sorted(stats.samples)
+            summary[name] = {
+                'count': stats.count,
+                'seconds': stats.seconds,
+                'rows': stats.rows,
+                'mean': stats.seconds / stats.count,
+                'p50': samples[len(samples) // 2],
+                'p90': samples[min(len(samples) - 1, int(len(samples) * 0.9))],
+                'max': stats.max,
+            }
+        return summary
+
+    def histogram(self, name, num_bins=10):
+        """Counts of the recent samples of a phase in num_bins logarithmic
+        bins, as [(upper bound in seconds, count), ...]"""
+        stats = self.stats.get(name)
+        if stats is None or len(stats.samples) == 0:
+            return []
+        lo = max(min(stats.samples), 1e-6)
+        hi = max(max(stats.samples), lo * 1.0001)
+        ratio = (hi / lo) ** (1.0 / num_bins)
+        bounds = [lo * ratio ** (i + 1) for i in range(num_bins)]
+        counts = [0] * num_bins
+        for sample in stats.samples:
+            for i, bound in enumerate(bounds):
+                if sample <= bound or i == num_bins - 1:
+                    counts[i] += 1
+                    break
+        return list(zip(bounds, counts))
+
+    def wrap_cursor(self, cursor):
+        if not self.enabled:
+            return cursor
+        return ProfiledCursor(self, cursor)
+
+    def start_cprofile(self):
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def stop_cprofile(self, filename):
+        """Stops cProfile and dumps the stats, readable with pstats"""
+        if self.cprofile is None:
+            return
+        self.cprofile.disable()
+        self.cprofile.dump_stats(filename)
+        self.cprofile = None
+
+    def start_sql_trace(self, conn, filename):
+        """Writes every statement SQLite runs on conn to filename, including
+        the ones of triggers and Anki itself"""
+        self.stop_sql_trace(conn)
+        self.trace_file = open(filename, 'a', encoding='utf-8')
+        conn.set_trace_callback(lambda sql: self.trace_file.write(
+            '%f %s\n' % (time(), sql)))
+
+    def stop_sql_trace(self, conn):
+        if self.trace_file is None:
+            return
+        conn.set_trace_callback(None)
+        self.trace_file.close()
+        self.trace_file = None
+
+
+def _statement_name(sql):
+    return 'sql: ' + re.sub(r'\s+', ' ', sql).strip()[:80]
+
+
+class ProfiledCursor:
+    """Wraps a sqlite3 cursor and records every statement as a phase. SQLite
+    runs SELECTs lazily, so the time spent fetching rows is added to the
+    statement as they are read"""
+    def __init__(self, profiler, cursor):
+        self.profiler = profiler
+        self.cursor = cursor
+        self.name = None
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def _run(self, method, sql, *args):
+        self.name = _statement_name(sql)
+        t0 = time()
+        method(sql, *args)
+        rows = self.cursor.rowcount
+        self.profiler.record(self.name, time() - t0, rows)
+        return self
+
+    def execute(self, sql, *args):
+        return self._run(self.cursor.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(self.cursor.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._run(self.cursor.executescript, sql)
+
+    def _fetch(self, method, *args):
+        t0 = time()
+        res = method(*args)
+        self.profiler.record(self.name + ' (fetch)', time() - t0,
+                             len(res) if isinstance(res, list) else None)
+        return res
+
+    def fetchone(self):
+        return self._fetch(self.cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(self.cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(self.cursor.fetchall)
+
+    def __iter__(self):
+        t0 = time()
+        num = 0
+        for row in self.cursor:
+            num += 1
+            yield row
+        # Includes the time spent by the caller between rows
+        self.profiler.record(self.name + ' (fetch)', time() - t0, num)
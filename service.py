@@ -0,0 +1,81 @@
+"""
+Process-wide databases
+
+Widgets and the background updates share one RememberberryDatabase per
+database file, instead of each constructing their own. The HSK lists and
+CEDICT are loaded once per process (see db.load_dictionary), and decks and
+note types are only re-read when col.mod changes.
+"""
+import sys
+from array import array
+
+from .db import RememberberryDatabase, load_dictionary
+
+_databases = {}
+
+
+def get_database(filename, col=None):
+    """Returns the shared database for filename, creating it on first use.
+    col is only used then, by default it's whatever collection Anki has open"""
+    db = _databases.get(filename)
+    if db is None:
+        db = RememberberryDatabase(filename, col)
+        _databases[filename] = db
+    return db
+
+
+def find_database(filename):
+    """Returns the shared database for filename if it was created, without
+    loading anything"""
+    return _databases.get(filename)
+
+
+def close_database(filename):
+    """Forgets the shared database for filename, e.g. when its profile is
+    closed, writing its knowledge index whole first"""
+    db = _databases.pop(filename, None)
+    if db is not None:
+        db.flush_index()
+
+
+def _deep_size(obj, seen):
+    # Approximate size of obj and everything it contains
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, (type, array)):
+        size += _deep_size(vars(obj), seen)
+    return size
+
+
+def memory_stats():
+    """Approximate memory used by the shared dictionary and the databases, in
+    bytes. Walks every object, so it takes a moment with the full CEDICT"""
+    hsk, cedict = load_dictionary()
+    seen = set()
+    stats = {
+        'cedict_entries': len(cedict),
+        'cedict_bytes': _deep_size(cedict, seen),
+        'hsk_bytes': _deep_size(hsk, seen),
+        'databases': {},
+    }
+    for filename, db in _databases.items():
+        stats['databases'][filename] = {
+            'index_bytes': _deep_size(db.index, seen),
+            'cedict_hashes_bytes': _deep_size(db.cedict_hashes, seen),
+            'search_cache_entries': len(db.search_cache),
+            'search_cache_bytes': _deep_size(db.search_cache, seen),
+        }
+    try:
+        import resource
+        # Kilobytes on Linux, bytes on macOS
+        stats['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        # Not available on Windows
+        pass
+    return stats
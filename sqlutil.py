@@ -0,0 +1,30 @@
+"""
+Helpers for queries over large sets of ids
+
+Inlining ids with "IN (%s)" % ', '.join(...) creates a new statement for every
+call, which SQLite can't cache, and with enough ids hits the statement size
+limits. iter_chunked instead binds the ids in fixed size chunks, so the same
+prepared statement is reused, and yields rows lazily as they are read.
+"""
+from itertools import islice
+
+# Below SQLITE_MAX_VARIABLE_NUMBER (999) of older SQLite versions
+CHUNK_SIZE = 500
+
+
+def iter_chunked(cursor, query, ids, params=(), chunk_size=CHUNK_SIZE):
+    """Runs query once per chunk of ids, where {ids} in the query is replaced
+    by the bound parameters, e.g. "SELECT * FROM notes WHERE id IN ({ids})".
+    params are bound before the ids. Rows are yielded as they are read"""
+    ids = iter(ids)
+    chunk_query = query.replace('{ids}', ', '.join('?' * chunk_size))
+    while True:
+        chunk = list(islice(ids, chunk_size))
+        if len(chunk) == 0:
+            return
+        if len(chunk) < chunk_size:
+            # Pad with the last id so that the statement stays the same, a
+            # repeated value in IN (...) doesn't change the result
+            chunk += [chunk[-1]] * (chunk_size - len(chunk))
+        for row in cursor.execute(chunk_query, (*params, *chunk)):
+            yield row
@@ -0,0 +1,123 @@
+"""
+Knowledge strength from the review log
+
+By default an item is scored by the highest reps-lapses of the cards of its
+linked notes, which never goes down as a card is forgotten. Strength instead
+estimates how well a card is known now, from the time since its last review
+and the interval Anki gave it at that review,
+
+    retrievability = 1 / (1 + elapsed / (9 * interval))
+    maturity = min(1, log(1 + interval) / log(1 + MATURE_INTERVAL))
+    strength = retrievability * maturity
+
+so a mature card is at 0.9 when it's due, and young or overdue cards are
+weaker. Strengths are put on the max_correct scale (see SCORE_MAX), so the
+unknown/learning/memorizing/known buckets work as before.
+
+All cards are computed in one pass over numpy arrays, or in plain Python
+when numpy isn't available (it isn't bundled with Anki).
+"""
+import math
+from time import time
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DAY = 86400
+# Anki calls cards with intervals of 21 days or more mature
+MATURE_INTERVAL = 21
+# Strengths are scaled to 0-9, where 0 is unknown and 9 known (max_correct > 8)
+SCORE_MAX = 9
+# Intervals of learning cards are negative and in seconds, cap them at a minute
+MIN_INTERVAL = 60 / DAY
+
+
+def _interval_days(ivl):
+    if ivl < 0:
+        return max(-ivl / DAY, MIN_INTERVAL)
+    return max(ivl, MIN_INTERVAL)
+
+
+def card_strength(ivl, last_review, reps, now):
+    """Strength of a card with Anki interval ivl, last reviewed at
+    last_review (seconds)"""
+    if reps == 0:
+        return 0.0
+    days = _interval_days(ivl)
+    elapsed = max(now - last_review, 0) / DAY
+    retrievability = 1 / (1 + elapsed / (9 * days))
+    maturity = min(1.0, math.log1p(days) / math.log1p(MATURE_INTERVAL))
+    return retrievability * maturity
+
+
+def note_scores(cards, reviews, now=None):
+    """Returns [(nid, score), ...] with the score of the strongest card of
+    each note. cards are (cid, nid, ivl, reps, mod) rows sorted by cid and
+    reviews (cid, id, ivl) rows of the revlog. Cards without reviews in the
+    log, e.g. imported ones, use their own ivl and mod"""
+    if now is None:
+        now = time()
+    if np is not None:
+        return _note_scores_numpy(cards, reviews, now)
+    return _note_scores_python(cards, reviews, now)
+
+
+def _note_scores_python(cards, reviews, now):
+    last_reviews = {}
+    for cid, review_id, ivl in reviews:
+        last = last_reviews.get(cid)
+        if last is None or review_id > last[0]:
+            last_reviews[cid] = (review_id, ivl)
+
+    scores = {}
+    for cid, nid, ivl, reps, mod in cards:
+        last = last_reviews.get(cid)
+        if last is not None:
+            mod, ivl = last[0] / 1000, last[1]
+        score = math.ceil(card_strength(ivl, mod, reps, now) * SCORE_MAX)
+        if score > scores.get(nid, -1):
+            scores[nid] = score
+    return list(scores.items())
+
+
+def _to_array(rows, width):
+    # Quicker than np.array() on a list of tuples
+    rows = list(rows)
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64,
+                       count=len(rows) * width).reshape(-1, width)
+
+
+def _note_scores_numpy(cards, reviews, now):
+    cards = _to_array(cards, 5)
+    reviews = _to_array(reviews, 3)
+    if len(cards) == 0:
+        return []
+    cids, nids, reps = cards[:, 0], cards[:, 1], cards[:, 3]
+    ivl = cards[:, 2].astype(np.float64)
+    last_review = cards[:, 4].astype(np.float64)
+
+    if len(reviews) > 0:
+        # The last review of each card, revlog ids are timestamps in ms
+        reviews = reviews[np.lexsort((reviews[:, 1], reviews[:, 0]))]
+        is_last = np.append(reviews[1:, 0] != reviews[:-1, 0], True)
+        reviews = reviews[is_last]
+        pos = np.minimum(np.searchsorted(cids, reviews[:, 0]), len(cids) - 1)
+        found = cids[pos] == reviews[:, 0]
+        last_review[pos[found]] = reviews[found, 1] / 1000
+        ivl[pos[found]] = reviews[found, 2]
+
+    days = np.where(ivl < 0, -ivl / DAY, ivl)
+    days = np.maximum(days, MIN_INTERVAL)
+    elapsed = np.maximum(now - last_review, 0) / DAY
+    strength = 1 / (1 + elapsed / (9 * days))
+    strength *= np.minimum(1.0, np.log1p(days) / math.log1p(MATURE_INTERVAL))
+    strength[reps == 0] = 0
+    scores = np.ceil(strength * SCORE_MAX).astype(np.int64)
+
+    unique_nids, inverse = np.unique(nids, return_inverse=True)
+    best = np.zeros(len(unique_nids), dtype=np.int64)
+    np.maximum.at(best, inverse, scores)
+    return list(zip(unique_nids.tolist(), best.tolist()))
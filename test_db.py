@@ -1,54 +1,542 @@
+"""
+Tests of the database, against synthetic collections (see
+bench.make_collection) of sentences made up of HSK 1 words, so that words are
+shared between sentences. Need corpus/sources/cedict_ts.u8, but not Anki. Run
+with run_tests() like test_modules, or with pytest
+"""
 import os
+import random
 import shutil
-from anki import Collection as aopen
-
-import rememberberry
-from rememberberry import db
+import sqlite3
+import tempfile
 from time import time
 
-def run_tests():
-    col_filename = os.path.join(os.path.dirname(__file__), 'test_collection.anki2')
-    tmp_filename = os.path.join(os.path.dirname(__file__), 'tmp.anki2')
-    shutil.copy(col_filename, tmp_filename)
-    col = aopen(tmp_filename)
-    rbd = db.RememberberryDatabase('rb.db', col, completed_hsk_lvl=4)
-    t0 = time()
-    rbd.init(['all::chinese'], ['SpoonFedChinese'])
-    t1 = time()
-    print('Initialization took %f s' % (t1-t0))
-
-    # Find an nid with several items which links to it
+from rememberberry import db, bench, index
+from rememberberry.collection import SqliteCollection
+
+
+def _tmp_dir():
+    return tempfile.mkdtemp(prefix='rememberberry_test_')
+
+
+def _init_database(tmp_dir, num_sentences=300, num_notes=100, seed=0):
+    # An initiated database of a new synthetic collection in tmp_dir
+    filename = os.path.join(tmp_dir, 'tmp.anki2')
+    hsk, cedict = db.load_dictionary()
+    words = sorted(w for w in hsk[1] if w in cedict)
+    bench.make_collection(filename, words, num_sentences, num_notes, seed)
+    col = SqliteCollection(filename)
+    rbd = db.RememberberryDatabase(os.path.join(tmp_dir, 'rb.db'), col)
+    rbd.init([bench.WORD_DECK], [bench.SENTENCE_DECK])
+    return rbd, col
+
+
+def _word_stats(rbd, recount=False):
+    # The word statistics as they were kept up to date, or recounted in full
     rbd.attach()
     c = rbd._get_cursor()
-    c.execute('''
-        SELECT nid, from_hash, to_hash, COUNT(*) FROM rb.item_links
-        JOIN rb.note_links ON to_hash=hash
-        GROUP BY to_hash
-        HAVING COUNT(*) > 1
-    ''')
-    res = c.fetchone()
-    nid, form_hash, to_hash, count = res
-
-    # Update the reps parameter
-    c.execute('''
-        UPDATE cards SET reps=reps+1 WHERE nid=?
-    ''', (nid,))
-
-    # Update the rememberberry database
-    t0 = time()
-    new, changed, parents = rbd.update(['all::chinese'])
-    t1 = time()
-    print('Update took %f s' % (t1-t0))
-
-    # Make sure the item corresponding to the card was updated, and all sentences
-    assert new == 0
-    assert changed == 1
-    assert parents == count
-    
-    results = rbd.search(limit=10, num_unknown=1)
-    for i in range(10):
-        print(results[i][0])
-        print('------------')
-        for w in results[i][1]:
-            print(w)
-        print('=================')
+    if recount:
+        rbd._update_word_stats(c)
+    stats = (sorted(c.execute('SELECT * FROM rb.word_stats')),
+             sorted(c.execute('SELECT * FROM rb.word_only_unknown')))
+    rbd.detach()
+    return stats
+
+
+def _duplicates(rbd):
+    rbd.attach()
+    duplicates = set(h for h, in rbd._get_cursor().execute('SELECT hash FROM rb.duplicates'))
+    rbd.detach()
+    return duplicates
+
+
+def test_update():
+    tmp_dir = _tmp_dir()
+    try:
+        t0 = time()
+        rbd, col = _init_database(tmp_dir)
+        t1 = time()
+        print('Initialization took %f s' % (t1-t0))
+
+        # Find an nid with several items which links to it, whose words are not
+        # known yet. Only sentences with words which change bucket are recounted
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('''
+            SELECT nid, COUNT(DISTINCT from_hash) FROM rb.item_links
+            JOIN rb.note_links ON to_hash=rb.note_links.hash
+            JOIN rb.items ON rb.items.hash=to_hash
+            GROUP BY nid
+            HAVING COUNT(DISTINCT from_hash) > 1 AND MAX(max_correct) <= 8
+        ''')
+        res = c.fetchone()
+        nid, count = res
+
+        # Update the reps parameter so that the words become known, Anki also
+        # bumps mod on each review
+        c.execute('''
+            UPDATE cards SET reps=reps+20, mod=mod+1 WHERE nid=?
+        ''', (nid,))
+
+        # Update the rememberberry database
+        t0 = time()
+        new, changed, parents = rbd.update([bench.WORD_DECK])
+        t1 = time()
+        print('Update took %f s' % (t1-t0))
+
+        # Make sure the item corresponding to the card was updated, and all sentences
+        assert new == 0
+        assert changed == 1
+        assert parents == count
+
+        # Nothing changed since, so nothing should be updated
+        assert rbd.update([bench.WORD_DECK]) == (0, 0, 0)
+
+        # Another review keeps the words known, nothing is recounted
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('UPDATE cards SET reps=reps+1, mod=mod+2 WHERE nid=?', (nid,))
+        assert rbd.update([bench.WORD_DECK]) == (0, 1, 0)
+
+        # A review synced from another device keeps its mod, but gets a new usn
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('''
+            UPDATE cards SET reps=reps+5, usn=(SELECT MAX(usn)+1 FROM cards) WHERE nid=?
+        ''', (nid,))
+        assert rbd.update([bench.WORD_DECK])[1] == 1
+
+        results = rbd.search(limit=10, num_unknown=1)
+        assert len(results) > 0
+        for item, item_words in results:
+            print(item)
+            print('------------')
+            for w in item_words:
+                print(w)
+            print('=================')
+
+        # Edit a sentence note, the item should get a new hash which the old one
+        # resolves to, without a new init()
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('SELECT nid, hash FROM rb.sentence_notes LIMIT 1')
+        sentence_nid, old_hash = c.fetchone()
+        c.execute('''
+            UPDATE notes SET flds='我'||flds, mod=(SELECT MAX(mod)+1 FROM notes)
+            WHERE id=?
+        ''', (sentence_nid,))
+        rbd.update([bench.WORD_DECK])
+        rbd.attach()
+        c = rbd._get_cursor()
+        new_hash, prev_hash = c.execute('''
+            SELECT hash, prev_hash FROM rb.items WHERE hash=(
+                SELECT hash FROM rb.sentence_notes WHERE nid=?)
+        ''', (sentence_nid,)).fetchone()
+        assert new_hash != old_hash
+        assert prev_hash == old_hash
+        assert rbd.resolve_hash(old_hash) == new_hash
+        # The edited sentence is a near-duplicate of its previous version, which
+        # it replaces, so it stays searchable
+        assert new_hash in [item[0] for item, _ in rbd.search()]
+
+        # Words are found by hanzi, pinyin with or without tones, and English
+        for query in ['你好', 'ni3 hao3', 'nihao', 'nǐhǎo', 'hello']:
+            assert '你好' in [hz for _, hz, *_ in rbd.lookup(query)], query
+
+        # Near-duplicate sentences are left out of searches
+        rbd.attach()
+        c = rbd._get_cursor()
+        duplicates = set(h for h, in c.execute('SELECT hash FROM rb.duplicates'))
+        assert not duplicates & set(item[0] for item, _ in rbd.search())
+        rbd.detach()
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_search_cache():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 100, 50)
+        searches = []
+        search = rbd._search
+        def _search(*args):
+            searches.append(args)
+            return search(*args)
+        rbd._search = _search
+
+        # Repeated searches are served from the cache, as copies
+        results = rbd.search(limit=10)
+        assert len(results) > 0
+        results.pop()
+        assert len(rbd.search(limit=10)) == len(results) + 1
+        assert len(searches) == 1
+
+        # An update without changes keeps the cache
+        version = rbd.version
+        assert rbd.update([bench.WORD_DECK]) == (0, 0, 0)
+        assert rbd.version == version
+        rbd.search(limit=10)
+        assert len(searches) == 1
+
+        # Marks, reviews and a new init() all change the results
+        rbd.set_marks([results[0][0][0]], 'known')
+        assert results[0][0][0] not in [item[0] for item, _ in rbd.search(limit=10)]
+        assert len(searches) == 2
+        rbd.attach()
+        rbd._get_cursor().execute('UPDATE cards SET reps=reps+20, mod=mod+1')
+        rbd.update([bench.WORD_DECK])
+        rbd.search(limit=10)
+        assert len(searches) == 3
+        rbd.init([bench.WORD_DECK], [bench.SENTENCE_DECK])
+        rbd.search(limit=10)
+        assert len(searches) == 4
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_suggest_words():
+    tmp_dir = _tmp_dir()
+    try:
+        # Few word notes, so that most words have none yet
+        rbd, col = _init_database(tmp_dir, 100, 5)
+        words = rbd.suggest_words(limit=1000)
+        assert len(words) > 0
+        rbd.attach()
+        linked = set(h for h, in rbd._get_cursor().execute('SELECT hash FROM rb.note_links'))
+        rbd.detach()
+        for h, hz, py, tr, hsk_lvl, num_sentences, num_only_unknown in words:
+            assert h not in linked
+            assert hsk_lvl > rbd.completed_hsk_lvl
+            assert num_sentences >= num_only_unknown
+        # Words completing the most sentences first, then the most frequent
+        ranks = [(-num_only_unknown, -num_sentences)
+                 for *_, num_sentences, num_only_unknown in words]
+        assert ranks == sorted(ranks)
+        assert len(rbd.suggest_words(limit=2)) == min(2, len(words))
+
+        # Marked words are left out
+        rbd.set_marks([words[0][0]], 'ignore')
+        assert words[0][0] not in [w[0] for w in rbd.suggest_words(limit=1000)]
+
+        # The statistics are updated by what changed, reviews and an edited
+        # sentence, and match a full recount
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('UPDATE cards SET reps=reps+20, mod=mod+1 WHERE did=?', (bench.WORD_DID,))
+        rbd.update([bench.WORD_DECK])
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        rbd.attach()
+        c = rbd._get_cursor()
+        c.execute('''
+            UPDATE notes SET flds='我'||flds, mod=mod+1
+            WHERE id=(SELECT MIN(nid) FROM rb.sentence_notes)
+        ''')
+        rbd.update([bench.WORD_DECK])
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_note_links_and_marks():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 100, 50)
+        # Sentences of a single note each, so that an edit replaces them
+        rbd.attach()
+        single = set(h for h, in rbd._get_cursor().execute(
+            'SELECT hash FROM rb.sentence_notes GROUP BY hash HAVING COUNT(*) = 1'))
+        rbd.detach()
+        hashes = [item[0] for item, _ in rbd.search() if item[0] in single][:4]
+        assert len(hashes) == 4
+
+        # Empty batches change nothing
+        version = rbd.version
+        rbd.add_note_links([])
+        rbd.set_marks([], 'known')
+        assert rbd.version == version
+
+        # Sentences added as notes are left out of searches
+        num_links = len(rbd.get_note_links())
+        rbd.add_note_links([(hashes[0], 1), (hashes[1], 2)])
+        assert len(rbd.get_note_links()) == num_links + 2
+        assert not set(hashes[:2]) & set(item[0] for item, _ in rbd.search())
+
+        # So are marked ones, until they are unmarked
+        rbd.set_marks(hashes[2:], 'known')
+        assert sorted(h for h, _ in rbd.get_marked_items('known')) == sorted(hashes[2:])
+        assert not set(hashes[2:]) & set(item[0] for item, _ in rbd.search())
+        rbd.set_marks(hashes[3:], '')
+        assert [h for h, _ in rbd.get_marked_items('known')] == hashes[2:3]
+        assert hashes[3] in [item[0] for item, _ in rbd.search()]
+
+        # Hashes from before an edit are resolved to the current ones
+        rbd.attach()
+        c = rbd._get_cursor()
+        nid, = c.execute('SELECT nid FROM rb.sentence_notes WHERE hash=?',
+                         (hashes[3],)).fetchone()
+        c.execute("UPDATE notes SET flds='我'||flds, mod=mod+1 WHERE id=?", (nid,))
+        rbd.update([bench.WORD_DECK])
+        new_hash = rbd.resolve_hash(hashes[3])
+        assert new_hash != hashes[3]
+        rbd.set_marks([hashes[3]], 'ignore')
+        assert [h for h, _ in rbd.get_marked_items('ignore')] == [new_hash]
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_update_notes():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 100, 20)
+        assert rbd.update_notes([], [bench.WORD_DECK]) == 0
+
+        # A reviewed note whose words become known recounts their sentences
+        rbd.attach()
+        c = rbd._get_cursor()
+        nid, count = c.execute('''
+            SELECT nid, COUNT(DISTINCT from_hash) FROM rb.item_links
+            JOIN rb.note_links ON to_hash=rb.note_links.hash
+            JOIN rb.items ON rb.items.hash=to_hash
+            GROUP BY nid HAVING MAX(max_correct) <= 8
+        ''').fetchone()
+        c.execute('UPDATE cards SET reps=reps+20, mod=mod+1 WHERE nid=?', (nid,))
+        assert rbd.update_notes([nid, nid], [bench.WORD_DECK]) == count
+        # update() then finds nothing left to do
+        assert rbd.update([bench.WORD_DECK]) == (0, 0, 0)
+
+        # An added note is linked, without a full update
+        rbd.attach()
+        c = rbd._get_cursor()
+        hz, word_hash = c.execute('''
+            SELECT data_simplified, hash FROM rb.items WHERE type='cedict'
+            AND hash NOT IN (SELECT hash FROM rb.note_links)
+            AND hash IN (SELECT to_hash FROM rb.item_links)
+        ''').fetchone()
+        new_nid = c.execute('SELECT MAX(id)+1 FROM notes').fetchone()[0]
+        c.execute('''INSERT INTO notes VALUES
+                     (?, ?, ?, ?, -1, '', ?, ?, 0, 0, '')''',
+                  (new_nid, str(new_nid), bench.MODEL_ID, int(time()),
+                   '\x1f'.join([hz, 'pinyin', 'translation']), hz))
+        c.execute('''INSERT INTO cards VALUES
+                     (?, ?, ?, 0, ?, -1, 0, 0, 0, 0, 2500, 0, 0, 0, 0, 0, 0, '')''',
+                  (new_nid, new_nid, bench.WORD_DID, int(time())))
+        rbd.update_notes([new_nid], [bench.WORD_DECK])
+        assert (word_hash, new_nid) in [link[:2] for link in rbd.get_note_links()]
+        assert rbd.update([bench.WORD_DECK])[:2] == (0, 0)
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_import_corpus():
+    tmp_dir = _tmp_dir()
+    try:
+        os.mkdir(os.path.join(tmp_dir, 'a'))
+        os.mkdir(os.path.join(tmp_dir, 'b'))
+        rbd_a, col_a = _init_database(os.path.join(tmp_dir, 'a'), 100, 20)
+        rbd_b, col_b = _init_database(os.path.join(tmp_dir, 'b'), 100, 20, seed=1)
+        filename = os.path.join(tmp_dir, 'corpus.txt')
+        num = rbd_a.export_corpus(filename, types=('user_sentence',))
+        assert num > 0
+
+        # Only a database init() has set up can be imported into
+        empty = db.RememberberryDatabase(os.path.join(tmp_dir, 'empty.db'), col_a)
+        try:
+            empty.import_corpus(filename)
+            assert False
+        except RuntimeError:
+            pass
+
+        # The imported sentences are counted and searchable, and importing
+        # them again changes nothing
+        assert rbd_b.import_corpus(filename, batch_size=7) == num
+        searched = set(item[0] for item, _ in rbd_b.search())
+        assert set(item[0] for item, _ in rbd_a.search()) - _duplicates(rbd_b) <= searched
+        rbd_b.attach()
+        assert rbd_b._get_cursor().execute('''
+            SELECT COUNT(*) FROM rb.items WHERE type='user_sentence' AND num_links != (
+                SELECT COUNT(*) FROM rb.item_links WHERE from_hash=rb.items.hash)
+        ''').fetchone()[0] == 0
+        rbd_b.detach()
+        stats = _word_stats(rbd_b)
+        assert stats == _word_stats(rbd_b, recount=True)
+        assert rbd_b.import_corpus(filename) == num
+        assert _word_stats(rbd_b) == stats
+        col_a.close()
+        col_b.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_import_sentences():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 50, 20)
+        hsk, cedict = db.load_dictionary()
+        words = sorted(w for w in hsk[1] if w in cedict)
+        rnd = random.Random(2)
+        sentences = set(''.join(rnd.choice(words) for _ in range(rnd.randint(3, 8)))
+                        for _ in range(40))
+        filename = os.path.join(tmp_dir, 'sentences.tsv')
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('# hanzi, pinyin, translation\n')
+            for hz in sorted(sentences):
+                f.write('%s\tpinyin\ttranslation\n' % hz)
+
+        # Near-duplicates aren't added, so at most every distinct sentence is
+        num = rbd.import_sentences(filename, batch_size=7)
+        assert 0 < num <= len(sentences)
+        rbd.attach()
+        c = rbd._get_cursor()
+        imported = set(h for h, in c.execute(
+            "SELECT hash FROM rb.items WHERE type='corpus_sentence'"))
+        assert len(imported) == num
+        assert c.execute('''
+            SELECT COUNT(*) FROM rb.items WHERE type='corpus_sentence' AND num_links != (
+                SELECT COUNT(*) FROM rb.item_links WHERE from_hash=rb.items.hash)
+        ''').fetchone()[0] == 0
+        rbd.detach()
+        assert imported & set(item[0] for item, _ in rbd.search())
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+
+        # The import continues where it stopped, with lines added since
+        assert rbd.import_sentences(filename) == 0
+        with open(filename, 'a', encoding='utf-8') as f:
+            f.write('%s\tpinyin\ttranslation\n' % ''.join(words[:9]))
+        assert rbd.import_sentences(filename) == 1
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_scoring():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 100, 20)
+        assert rbd.scoring == 'reps'
+        try:
+            rbd.set_scoring('ease')
+            assert False
+        except ValueError:
+            pass
+
+        def _scores():
+            rbd.attach()
+            scores = dict(rbd._get_cursor().execute('''
+                SELECT hash, max_correct FROM rb.items
+                WHERE hash IN (SELECT hash FROM rb.note_links)
+            '''))
+            rbd.detach()
+            return scores
+        scores = _scores()
+
+        # A note reviewed with a mature interval just now is known by strength
+        rbd.attach()
+        c = rbd._get_cursor()
+        cid, word_hash = c.execute('''
+            SELECT cards.id, hash FROM rb.note_links
+            JOIN cards ON cards.nid=rb.note_links.nid WHERE reps > 0
+        ''').fetchone()
+        c.execute('''INSERT INTO revlog VALUES (?, ?, -1, 3, 30, 10, 2500, 1000, 1)''',
+                  (int(time() * 1000), cid))
+        version = rbd.version
+        rbd.set_scoring('strength')
+        assert rbd.scoring == 'strength'
+        assert rbd.version > version
+        strengths = _scores()
+        assert set(strengths) == set(scores)
+        assert all(0 <= score <= 9 for score in strengths.values())
+        assert strengths[word_hash] == 9
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+
+        # Strengths decay, so update() rescores once a day
+        version = rbd.version
+        assert rbd.update([bench.WORD_DECK]) == (0, 0, 0)
+        assert rbd.version == version
+        rbd.attach()
+        rbd._set_meta(rbd._get_cursor(), 'scoring_day', 0)
+        rbd.update([bench.WORD_DECK])
+        assert rbd.version > version
+
+        # Back to reps, the scores are as they were
+        rbd.set_scoring('reps')
+        assert _scores() == scores
+        assert _word_stats(rbd) == _word_stats(rbd, recount=True)
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_marks_migration():
+    tmp_dir = _tmp_dir()
+    try:
+        rbd, col = _init_database(tmp_dir, 100, 20)
+        # Marks used to be kept in cards.data
+        rbd.attach()
+        c = rbd._get_cursor()
+        sentence_nid, sentence_hash = c.execute(
+            'SELECT nid, hash FROM rb.sentence_notes').fetchone()
+        word_nid, = c.execute('SELECT nid FROM rb.note_links').fetchone()
+        word_hashes = sorted(h for h, in c.execute(
+            'SELECT hash FROM rb.note_links WHERE nid=?', (word_nid,)))
+        c.execute("UPDATE cards SET data='known' WHERE nid=?", (sentence_nid,))
+        c.execute("UPDATE cards SET data='ignore' WHERE nid=?", (word_nid,))
+        c.execute("DELETE FROM rb.meta WHERE key='marks_migrated'")
+        rbd.update([bench.WORD_DECK])
+
+        assert [h for h, _ in rbd.get_marked_items('known')] == [sentence_hash]
+        assert sorted(h for h, _ in rbd.get_marked_items('ignore')) == word_hashes
+        assert sentence_hash not in [item[0] for item, _ in rbd.search()]
+        rbd.attach()
+        c = rbd._get_cursor()
+        assert c.execute('''
+            SELECT COUNT(*) FROM cards WHERE data IN ('known', 'ignore')
+        ''').fetchone()[0] == 0
+
+        # Only once, and the marks are kept by a new init()
+        c.execute("UPDATE cards SET data='known' WHERE nid=?", (word_nid,))
+        rbd.update([bench.WORD_DECK])
+        assert len(rbd.get_marked_items('known')) == 1
+        rbd.init([bench.WORD_DECK], [bench.SENTENCE_DECK])
+        assert [h for h, _ in rbd.get_marked_items('known')] == [sentence_hash]
+        assert sorted(h for h, _ in rbd.get_marked_items('ignore')) == word_hashes
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_buckets():
+    # The counts in rb.items, search() and the knowledge index agree on the
+    # bucket of every max_correct, NULL included
+    buckets = {index.UNKNOWN: db.BUCKET_UNKNOWN, index.LEARNING: db.BUCKET_LEARNING,
+               index.MEMORIZING: db.BUCKET_MEMORIZING, index.KNOWN: db.BUCKET_KNOWN}
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE words (max_correct INTEGER, hsk_lvl INTEGER)')
+    conn.executemany('INSERT INTO words VALUES (?, 3)',
+                     [(v,) for v in [None, -1, 0, 1, 4, 5, 8, 9, 20]])
+    rows = conn.execute('SELECT max_correct, %s, %s FROM words' % (
+        db._bucket_sql(0), db._UNKNOWN_SQL)).fetchall()
+    for max_correct, bucket, unknown in rows:
+        assert bucket == buckets[index.correct_bucket(max_correct)], max_correct
+        assert unknown == (bucket == db.BUCKET_UNKNOWN), max_correct
+    # Only a different bucket is a change
+    assert conn.execute('SELECT %s' % db._buckets_differ_sql('NULL', '0')).fetchone()[0] == 0
+    assert conn.execute('SELECT %s' % db._buckets_differ_sql('NULL', '1')).fetchone()[0] == 1
+
+
+def run_tests():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print('%s passed' % name)
+
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,341 @@
+"""
+Tests of the modules which don't need a collection or the dictionary, run
+with run_tests() like test_db, or with pytest
+"""
+import os
+import json
+import pickle
+import shutil
+import sqlite3
+import tempfile
+from time import time
+
+from rememberberry import (sqlutil, flatfile, codec, lookup, strength, dedup,
+                           index, importer, cedict, bench)
+from rememberberry.collection import SqliteCollection, as_collection
+
+
+def _tmp_dir():
+    return tempfile.mkdtemp(prefix='rememberberry_test_')
+
+
+def test_iter_chunked():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER)')
+    conn.executemany('INSERT INTO t VALUES (?, ?)', [(i, i % 3) for i in range(25)])
+    query = 'SELECT id FROM t WHERE v=? AND id IN ({ids})'
+
+    assert list(sqlutil.iter_chunked(conn.cursor(), query, [], (0,))) == []
+    assert list(sqlutil.iter_chunked(conn.cursor(), query, iter([]), (0,))) == []
+    # Padding the last chunk with a repeated id doesn't repeat rows
+    rows = list(sqlutil.iter_chunked(conn.cursor(), query, range(25), (0,), chunk_size=4))
+    assert sorted(i for i, in rows) == list(range(0, 25, 3))
+
+
+def test_flatfile_escaping():
+    item = ('a/b%2F', 'user_sentence', '我/你', None, 'line\nbreak', '100%')
+    links = [('0-1', 'x/y%'), ('1-2', 'z')]
+    line = flatfile.format_line(item, links)
+    assert line.count('\n') == 1
+    assert flatfile.parse_line(line) == (item, links)
+    assert flatfile.parse_line(flatfile.format_line(('%00', '', '', '', '', ''), [])) \
+        == (('%00', '', '', '', '', ''), [])
+
+
+def test_flat_corpus():
+    tmp_dir = _tmp_dir()
+    try:
+        filename = os.path.join(tmp_dir, 'corpus.txt')
+        # Hashes have the fixed length of the index records
+        s1, s2, w1, w2 = [h * flatfile.HASH_LEN for h in 'abcd']
+        items = [((s1, 'corpus_sentence', '我是', None, None, 'I am'),
+                  [('0-1', w1), ('1-2', w2)]),
+                 ((s2, 'corpus_sentence', '我', None, None, 'me'), [('0-1', w1)]),
+                 ((w1, 'cedict', '我', '我', 'wo3', 'I/me'), [])]
+        assert flatfile.write_corpus(filename, items, license='CC\nBY') == 3
+        assert list(flatfile.iter_corpus(filename)) == items
+
+        corpus = flatfile.FlatCorpus(filename)
+        try:
+            assert len(corpus) == 3
+            assert corpus.get(s2) == items[1]
+            assert corpus.get('e' * flatfile.HASH_LEN) is None
+            assert sorted(item[0] for item, _ in corpus.linking_items(w1)) == [s1, s2]
+            assert list(corpus.linking_items(s1)) == []
+        finally:
+            corpus.close()
+
+        # Empty indexes can't be memory mapped
+        flatfile.write_corpus(filename, [])
+        corpus = flatfile.FlatCorpus(filename)
+        assert len(corpus) == 0 and corpus.get(s1) is None
+        corpus.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_codec():
+    samples = ['["to eat/to consume/to have one\'s meal"]'] * 10
+    zdict = codec.train_zdict(samples, size=64)
+    assert 0 < len(zdict) <= 64
+
+    c = codec.PayloadCodec(zdict)
+    text = '["to eat/to have one\'s meal/to consume"]'
+    encoded = c.encode(text)
+    assert isinstance(encoded, bytes) and len(encoded) < len(text.encode('utf-8'))
+    assert c.decode(encoded) == text
+    # Short values, None and values without a zdict are kept as text
+    assert c.encode('["chi1"]') == '["chi1"]'
+    assert c.encode(None) is None
+    assert codec.PayloadCodec().encode(text) == text
+    assert c.decode(text) == text
+
+    # All of a full size zdict is within reach of the window
+    start = b'["the start of the zdict/is still used"]'
+    zdict = start + b'.' * (codec.ZDICT_SIZE - len(start))
+    encoded = codec.PayloadCodec(zdict).encode(start.decode('utf-8'))
+    assert isinstance(encoded, bytes) and len(encoded) < len(start) // 2
+
+
+def test_lookup():
+    assert lookup.pinyin_keys('Zhong1 guo2') == ('zhong1guo2', 'zhongguo')
+    assert lookup.pinyin_keys('lu:4') == ('lv4', 'lv')
+    assert lookup.query_pinyin_key('zhong1 guo2') == 'zhong1guo2'
+    assert lookup.query_pinyin_key('zhōngguó') == 'zhongguo'
+    assert lookup.query_pinyin_key('nǚ') == 'nv'
+    assert lookup.query_pinyin_key("xi'an") == 'xian'
+    assert lookup.query_pinyin_key('中国') is None
+    assert lookup.query_pinyin_key('1') is None
+    assert list(lookup.gloss_words('to eat/a meal of rice')) == \
+        [('eat', 2), ('meal', 4), ('rice', 4)]
+    assert lookup.query_gloss_words('The Apple') == ['apple']
+
+
+def _strength_rows(now):
+    cards = [(1, 10, 30, 5, now - 86400), (2, 10, 1, 2, now),
+             (3, 11, -600, 1, now), (4, 12, 100, 0, now),
+             (5, 13, 5, 3, now - 86400 * 200)]
+    reviews = [(1, (now - 3600) * 1000, 40), (1, (now - 86400 * 50) * 1000, 10),
+               (5, (now - 86400 * 2) * 1000, 21), (99, now * 1000, 1)]
+    return cards, reviews
+
+
+def test_strength():
+    now = int(time())
+    assert strength.card_strength(100, now, 0, now) == 0.0
+    # A mature card is at 0.9 when it's due
+    assert abs(strength.card_strength(30, now - 30 * 86400, 5, now) - 0.9) < 1e-9
+    assert strength.card_strength(1, now - 86400, 1, now) < \
+        strength.card_strength(30, now - 86400, 5, now)
+
+    cards, reviews = _strength_rows(now)
+    scores = dict(strength._note_scores_python(cards, reviews, now))
+    assert scores[12] == 0
+    assert scores[10] == strength.SCORE_MAX
+    # The last review in the log wins over the card's own ivl and mod
+    assert scores[13] > dict(strength._note_scores_python(cards, [], now))[13]
+    assert strength.note_scores([], [], now) == []
+
+
+def test_strength_numpy():
+    if strength.np is None:
+        return
+    now = int(time())
+    cards, reviews = _strength_rows(now)
+    for r in (reviews, []):
+        assert sorted(strength._note_scores_numpy(cards, r, now)) == \
+            sorted(strength._note_scores_python(cards, r, now))
+
+
+def _sentences(num):
+    words = ['w%i' % i for i in range(80)]
+    sentences = [words[i:i+20] for i in range(0, 80, 20)]
+    # Near-duplicates, one word replaced
+    sentences += [s[:10] + ['x%i' % i] + s[11:] for i, s in enumerate(sentences)]
+    return [dedup.shingles(s) for s in sentences[:num]]
+
+
+def test_dedup():
+    assert dedup.shingles(['a', 'b', 'c']) == {'a', 'b', 'c', 'a b', 'b c'}
+    assert dedup.jaccard(set(), set()) == 1.0
+    assert dedup.jaccard({'a', 'b'}, {'b', 'c'}) == 1 / 3
+
+    shingle_sets = _sentences(8)
+    keys = dedup.band_keys(shingle_sets)
+    assert all(len(k) == dedup.BANDS for k in keys)
+    assert all(-(1 << 63) <= key < (1 << 63) for k in keys for key in k)
+
+    finder = dedup.DuplicateFinder()
+    results = [finder.add('s%i' % i, s, k) for i, (s, k) in
+               enumerate(zip(shingle_sets, keys))]
+    assert results[:4] == [None] * 4
+    assert [r[0] for r in results[4:]] == ['s0', 's1', 's2', 's3']
+    assert all(r[1] >= dedup.THRESHOLD for r in results[4:])
+    # Candidates from outside of the finder, e.g. the database
+    finder = dedup.DuplicateFinder()
+    assert finder.add('s4', shingle_sets[4], keys[4],
+                      {'s0': shingle_sets[0]})[0] == 's0'
+
+
+def test_dedup_numpy():
+    if dedup.np is None:
+        return
+    shingle_sets = _sentences(8)
+    python_keys = [dedup._band_keys_python(dedup.signature(s)) for s in shingle_sets]
+    assert dedup.band_keys(shingle_sets) == python_keys
+    assert dedup.band_keys([]) == []
+
+
+def _index():
+    idx = index.KnowledgeIndex()
+    idx.add_word('a', 1, max_correct=9)
+    idx.add_word('b', 1)
+    idx.add_word('c', 5)
+    idx.add_sentence('ab', ['a', 'b'])
+    idx.add_sentence('bc', ['b', 'c', 'unknown word'])
+    idx.add_sentence('a', ['a'])
+    return idx
+
+
+def test_index():
+    idx = _index()
+    assert list(idx.find_sentences(0)) == ['a']
+    assert list(idx.find_sentences(1)) == ['ab', 'a']
+    assert list(idx.find_sentences(1, exact=True)) == ['ab']
+    # Words of completed hsk levels are known
+    assert list(idx.find_sentences(1, completed_hsk_lvl=1)) == ['ab', 'bc', 'a']
+    assert list(idx.find_sentences(2, word_hash='c')) == ['bc']
+
+    # Cached counts are patched as words change bucket
+    assert idx.set_max_correct('b', 9)
+    assert not idx.set_max_correct('b', 12)
+    assert list(idx.find_sentences(0)) == ['ab', 'a']
+    fresh = _index()
+    fresh.set_max_correct('b', 9)
+    for lvl in (0, 1):
+        assert idx.unknown_counts(lvl) == fresh.unknown_counts(lvl)
+
+    assert idx.sentence_count('a') == 2
+    assert idx.link_sentence('ab') and not idx.link_sentence('ab')
+    assert idx.sentence_count('a') == 1
+    assert idx.link_note(1, 'a') and idx.link_note(1, 'b')
+    assert idx.note_sentence_count(1) == 0
+    assert idx.link_note(2, 'a') and idx.note_sentence_count(2) == 1
+
+    assert idx.remove_sentence('a') and not idx.remove_sentence('a')
+    assert list(idx.find_sentences(0)) == ['ab']
+    assert list(idx.sentences_with('missing')) == []
+
+
+def test_index_log():
+    tmp_dir = _tmp_dir()
+    try:
+        filename = index.index_filename(os.path.join(tmp_dir, 'rb.db'))
+        idx = _index()
+        idx.save(filename)
+        idx.set_max_correct('b', 9)
+        idx.add_sentence('abc', ['a', 'b', 'c'])
+        idx.link_sentence('a')
+        idx.save_changes(filename)
+        assert os.path.exists(index.log_filename(filename))
+        idx.remove_sentence('bc')
+        idx.save_changes(filename)
+
+        loaded = index.KnowledgeIndex.load(filename)
+        for max_unknown in range(3):
+            assert list(loaded.find_sentences(max_unknown)) == \
+                list(idx.find_sentences(max_unknown))
+        assert loaded.sentence_count('a') == idx.sentence_count('a')
+
+        # A batch cut short by a crash is left out
+        with open(index.log_filename(filename), 'ab') as f:
+            f.write(pickle.dumps([('link_sentence', 'abc')])[:-3])
+        assert index.KnowledgeIndex.load(filename).sentence_count('c') == 1
+
+        loaded.save(filename)
+        assert not os.path.exists(index.log_filename(filename))
+        assert index.KnowledgeIndex.load(os.path.join(tmp_dir, 'missing')) is None
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_importer():
+    tmp_dir = _tmp_dir()
+    try:
+        tsv = os.path.join(tmp_dir, 'sentences.tsv')
+        with open(tsv, 'w', encoding='utf-8') as f:
+            f.write('# comment\n我是学生\two3 shi4 xue2sheng\tI am a student\n\n'
+                    '你好\n他是老师\tta1\tHe is a teacher\n')
+        batches = list(importer.iter_batches(tsv, batch_size=2))
+        assert [len(batch) for _, batch in batches] == [2, 1]
+        assert batches[0][1][1] == ('你好', None, None)
+        # Resuming from an offset continues with the next batch
+        assert list(importer.iter_batches(tsv, batches[0][0], 2)) == batches[1:]
+        assert list(importer.iter_batches(tsv, batches[-1][0])) == []
+
+        jsonl = os.path.join(tmp_dir, 'sentences.jsonl')
+        with open(jsonl, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'hanzi': '我是学生', 'translation': 'I am a student'}) + '\n')
+            f.write(json.dumps({'pinyin': 'no hanzi'}) + '\n')
+        assert list(importer.iter_batches(jsonl)) == \
+            [(os.path.getsize(jsonl), [('我是学生', None, 'I am a student')])]
+
+        words = {'我', '是', '学生'}
+        (offset, segmented), = importer.iter_segmented(importer.iter_batches(jsonl), words)
+        assert segmented == [(('我是学生', None, 'I am a student'),
+                              [('我', 0, 1), ('是', 1, 2), ('学生', 2, 4)])]
+        assert list(importer.iter_segmented(
+            importer.iter_batches(tsv, batch_size=1), words, processes=2)) == \
+            list(importer.iter_segmented(importer.iter_batches(tsv, batch_size=1), words))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_cedict():
+    records = cedict._parse_lines([
+        '# comment\n',
+        '中國 中国 [Zhong1 guo2] /China/see also 中华/\n',
+        '不是一行\n',
+        '吃 吃 [chi1] /variant of 喫/to eat/\n',
+    ])
+    assert records == [('中國', '中国', 'Zhong1 guo2', 'China'),
+                       ('吃', '吃', 'chi1', 'to eat')]
+
+    words = [('中国', [('中國', 'Zhong1 guo2', 'China')], [('中', 0, 1), ('国', 1, 2)]),
+             ('中', [('中', 'zhong1', 'middle'), ('中', 'zhong4', 'to hit')], []),
+             ('国', [('國', 'guo2', 'country')], [])]
+    store = cedict.CedictStore(words)
+    for s in (store, pickle.loads(pickle.dumps(store))):
+        assert len(s) == 3
+        assert '中国' in s and '吃' not in s
+        assert sorted(s) == sorted(w[0] for w in words)
+        assert [tuple(s[w[0]]) for w in words] == [tuple(w) for w in words]
+        sm, entries, parts = s['中']
+        assert entries == words[1][1] and parts == []
+        assert s.get('吃') is None
+        assert dict(s.items())['国'].entries == words[2][1]
+
+
+def test_sqlite_collection():
+    tmp_dir = _tmp_dir()
+    try:
+        filename = os.path.join(tmp_dir, 'collection.anki2')
+        word_notes = bench.make_collection(filename, ['我', '是'], 3, 2)
+        col = as_collection(filename)
+        assert isinstance(col, SqliteCollection)
+        names = sorted(d['name'] for d in col.decks().values())
+        assert names == sorted([bench.SENTENCE_DECK, bench.WORD_DECK])
+        assert col.field_names(bench.MODEL_ID) == ['Hanzi', 'Pinyin', 'English']
+        assert col.conn.execute('SELECT COUNT(*) FROM notes').fetchone()[0] == 5
+        assert len(word_notes) == 2
+        assert as_collection(col) is col
+        col.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_tests():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print('%s passed' % name)
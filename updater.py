@@ -0,0 +1,114 @@
+"""
+Keeps the rememberberry database up to date in the background
+
+Notes that are reviewed or added are queued from Anki's hooks, and processed
+in small batches with RememberberryDatabase.update_notes() once Anki has been
+idle for a moment. Batches run on the main thread, so their size adapts to
+keep each one under max_batch_ms, and the rest is left for the next round of
+the event loop. Searching then only has to flush whatever is left in the
+queue, instead of running update() which compares every card in the
+collection. A full update() still runs once per profile load on the idle
+timer, to pick up reviews made elsewhere (e.g. synced from mobile).
+"""
+from time import time
+from collections import OrderedDict
+
+from aqt import mw
+from aqt.qt import QTimer
+from aqt.reviewer import Reviewer
+from anki.hooks import addHook, wrap
+
+
+class UpdateQueue:
+    def __init__(self, batch_size=50, idle_ms=2000, max_batch_ms=100):
+        self.max_batch_size = batch_size
+        self.batch_size = batch_size
+        self.idle_ms = idle_ms
+        self.max_batch_ms = max_batch_ms
+        self.pending = OrderedDict()
+        self.full_update = False
+        self.timer = None
+        self.get_db = lambda: None
+        self.get_word_decks = lambda: []
+
+    def _schedule(self, ms):
+        if self.timer is None:
+            self.timer = QTimer(mw)
+            self.timer.setSingleShot(True)
+            self.timer.timeout.connect(self.process_batch)
+        # Restarting the timer for every queued note means that we only run
+        # once the user has stopped reviewing for a while
+        self.timer.start(ms)
+
+    def queue(self, nid):
+        self.pending[nid] = True
+        self._schedule(self.idle_ms)
+
+    def queue_full_update(self):
+        self.full_update = True
+        self._schedule(self.idle_ms)
+
+    def process_batch(self):
+        if self.full_update:
+            self.full_update = False
+            self.pending.clear()
+            db = self._get_initiated_db()
+            if db is not None:
+                db.update(self.get_word_decks())
+            return
+
+        nids = []
+        while self.pending and len(nids) < self.batch_size:
+            nids.append(self.pending.popitem(last=False)[0])
+        t0 = time()
+        self._process(nids)
+        self._adapt_batch_size(len(nids), (time() - t0) * 1000)
+        if self.pending:
+            self._schedule(0)
+
+    def _adapt_batch_size(self, num, ms):
+        # Halve batches which took too long, and grow full ones which were
+        # quick back towards max_batch_size
+        if ms > self.max_batch_ms:
+            self.batch_size = max(1, num // 2)
+        elif ms < self.max_batch_ms / 4 and num == self.batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+
+    def flush(self):
+        """Processes all queued notes right away, e.g. before a search"""
+        nids = list(self.pending)
+        self.pending.clear()
+        self._process(nids)
+
+    def _get_initiated_db(self):
+        db = self.get_db()
+        if db is None or not db.initiated:
+            # init() will pick up everything once the database is created
+            return None
+        return db
+
+    def _process(self, nids):
+        if len(nids) == 0:
+            return
+        db = self._get_initiated_db()
+        if db is not None:
+            db.update_notes(nids, self.get_word_decks())
+
+
+update_queue = UpdateQueue()
+
+
+def setup_hooks(get_db, get_word_decks):
+    update_queue.get_db = get_db
+    update_queue.get_word_decks = get_word_decks
+
+    def _on_answer_card(reviewer, ease):
+        # Runs before the answer so that reviewer.card is still the answered
+        # card, the update itself happens later on the idle timer
+        if reviewer.card is not None:
+            update_queue.queue(reviewer.card.nid)
+
+    Reviewer._answerCard = wrap(Reviewer._answerCard, _on_answer_card, 'before')
+    addHook('AddCards.noteAdded', lambda note: update_queue.queue(note.id))
+    addHook('profileLoaded', update_queue.queue_full_update)
+    addHook('unloadProfile', update_queue.flush)
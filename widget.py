@@ -2,7 +2,7 @@ import os
 import json
 import base64
 import random
-from functools import partial
+from functools import partial, lru_cache
 from aqt import mw
 from aqt.utils import showInfo
 from aqt.qt import *
@@ -10,11 +10,17 @@ from anki.utils import ids2str, fieldChecksum, stripHTML, \
     intTime, splitFields, joinFields, maxID, json, devMode
 from anki.lang import _
 
-from .han import filter_text_hanzi, is_hanzi, split_hanzi
-from .cedict import load_cedict
+from .han import is_hanzi, split_hanzi
 from collections import defaultdict
 
-from .db import RememberberryDatabase
+from .service import get_database, memory_stats
+from .db import BUCKET_UNKNOWN, BUCKET_LEARNING, BUCKET_MEMORIZING, BUCKET_KNOWN
+from .updater import update_queue
+
+def get_db_filename():
+    file_dir = os.path.dirname(__file__)
+    db_name = str(base64.urlsafe_b64encode(bytes(mw.pm.name, 'utf-8')), 'utf-8')
+    return os.path.join(file_dir, 'user_files/%s.sqlite' % db_name)
 
 def addChineseModel():
     model_name = "Rememberberry Chinese"
@@ -50,18 +56,38 @@ def addChineseModel():
     mm.add(m)
     return m
 
+# Highlight colors of the word buckets returned by search()
+BUCKET_COLORS = {
+    BUCKET_UNKNOWN: 'rgb(239, 75, 67)', # red
+    BUCKET_LEARNING: 'orange',
+    BUCKET_MEMORIZING: 'rgb(165, 224, 172)', # light green
+    BUCKET_KNOWN: 'rgb(74, 155, 62)', # green
+}
+
+
+@lru_cache(maxsize=None)
+def _span_template(bucket):
+    # A span highlighting a word (the %s) in the color of its bucket
+    return ('<span style="background: %s; border-color: black">%%s</span><span> </span>'
+            % BUCKET_COLORS[bucket])
+
+
 class ConfigWidget(QWidget):
     def __init__(self):
         QWidget.__init__(self)
 
-    def read_config(self):
+    @classmethod
+    def load_config(cls):
         try:
-            with open(self.config_filename(), 'r') as f:
-                self.config = json.loads(f.read())
+            with open(cls.config_filename(), 'r') as f:
+                return json.loads(f.read())
         except:
-            self.config = {'version': 1,
-                           'sentence_decks': [],
-                           'active_vocabulary_decks': []}
+            return {'version': 1,
+                    'sentence_decks': [],
+                    'active_vocabulary_decks': []}
+
+    def read_config(self):
+        self.config = self.load_config()
 
     @classmethod
     def config_filename(cls):
@@ -170,11 +196,7 @@ class RememberberryWidget(ConfigWidget):
         self.num_columns = 2
         self.editor = editor
         self.redo_search = True
-        file_dir = os.path.dirname(__file__)
-
-        db_name = str(base64.urlsafe_b64encode(bytes(mw.pm.name, 'utf-8')), 'utf-8')
-        db_path = 'user_files/%s.sqlite' % db_name
-        self.db = RememberberryDatabase(os.path.join(file_dir, db_path))
+        self.db = get_database(get_db_filename())
 
         # Try to add the chinese models if they don't exist
         addChineseModel()
@@ -195,16 +217,23 @@ class RememberberryWidget(ConfigWidget):
         # Initialize tab screen
         self.tabs = QTabWidget()
         self.find_tab = QWidget()	
+        self.words_tab = QWidget()
         self.decks_tab = QWidget()
         self.settings_tab = QWidget()
+        self.debug_tab = QWidget()
  
         # Add tabs
         self.tabs.addTab(self.find_tab, 'Find')
+        self.tabs.addTab(self.words_tab, 'Words')
         self.tabs.addTab(self.decks_tab, 'Decks')
         self.tabs.addTab(self.settings_tab, 'Settings')
+        self.tabs.addTab(self.debug_tab, 'Debug')
 
         # Create find tab
         self.create_find_tab()
+
+        # Create words tab
+        self.create_words_tab()
  
         # Create decks tab
         self.create_decks_tab()
@@ -212,6 +241,9 @@ class RememberberryWidget(ConfigWidget):
         # Create settings tab
         self.create_settings_tab()
 
+        # Create debug tab
+        self.create_debug_tab()
+
         self.tabs.currentChanged.connect(self.on_tab_changed)
  
         # Add tabs to widget        
@@ -237,31 +269,11 @@ class RememberberryWidget(ConfigWidget):
     def update_mark_items(self, mark_type):
         if not self.db.initiated:
             return
-        results = self.db.get_note_links(10)
-        #showInfo(str(results))
-
-
-        nids = [c[0] for c in mw.col.db.all('select nid from cards where data="%s"' % mark_type)]
-        nids = set(nids)
-        ids_str = ', '.join(str(nid) for nid in nids)
-        note_fields = mw.col.db.all("select id, flds from notes where id in (%s)" % ids_str)
-        note_fields = {nid: fields.split('\x1f') for nid, fields in note_fields}
-        self.mark_notes[mark_type] = []
-        for nid in nids:
-            fields = note_fields[nid]
-            hanzi = []
-            for i, field in enumerate(fields):
-                h = filter_text_hanzi(field)
-                if len(h) > 0:
-                    hanzi.append(h)
-            self.mark_notes[mark_type].append((nid, '|'.join(hanzi)))
+        self.marked_items[mark_type] = self.db.get_marked_items(mark_type)
 
-        model = QStandardItemModel()
-
-        model.removeRows(0, model.rowCount())
         it = []
         model = QStandardItemModel()
-        for _, label in self.mark_notes[mark_type]:
+        for _, label in self.marked_items[mark_type]:
             item = QStandardItem(label)
             item.setCheckState(Qt.Unchecked)
             item.setCheckable(True)
@@ -272,7 +284,7 @@ class RememberberryWidget(ConfigWidget):
         self.mark_views[mark_type].setModel(model)
 
     def create_settings_tab(self):
-        self.mark_notes, self.mark_items = {}, {}
+        self.marked_items, self.mark_items = {}, {}
         self.settings_tab.layout = QGridLayout(self)
         self.settings_tab.layout.addWidget(QLabel('Ignored:', self), 0, 0)
         self.settings_tab.layout.addWidget(QLabel('Known:', self), 0, 1)
@@ -285,16 +297,16 @@ class RememberberryWidget(ConfigWidget):
         self.update_mark_items('known')
 
         def _remove(mark_type):
-            remove_indices = set()
+            hashes = []
             for i, item in enumerate(self.mark_items[mark_type]):
                 if item.checkState() != Qt.Checked:
                     continue
-                remove_indices.add(i)
-                nid, _ = self.mark_notes[mark_type][i]
-                query = 'update cards set data="" where nid=?'
-                mw.col.db.execute(query, nid)
-                self.redo_search = True
+                item_hash, _ = self.marked_items[mark_type][i]
+                hashes.append(item_hash)
 
+            if len(hashes) > 0:
+                self.db.set_marks(hashes, '')
+                self.redo_search = True
             self.update_mark_items(mark_type)
 
 
@@ -306,14 +318,157 @@ class RememberberryWidget(ConfigWidget):
         remove_known_button.clicked.connect(partial(_remove, 'known'))
         self.settings_tab.layout.addWidget(remove_known_button, 2, 1)
 
+        full_update_button = QPushButton('Full Update')
+        full_update_button.setToolTip('Rescan all cards, e.g. after syncing '
+                                      'reviews from another device')
+        full_update_button.clicked.connect(self.full_update)
+        self.settings_tab.layout.addWidget(full_update_button, 3, 0)
+
+        def _set_scoring(checked):
+            self.read_config()
+            self.config['scoring'] = 'strength' if checked else 'reps'
+            self.write_config()
+            if self.db.initiated:
+                self.db.set_scoring(self.config['scoring'])
+            self.redo_search = True
+
+        strength_box = QCheckBox('Score by review strength')
+        strength_box.setToolTip('Rate words by their interval and the time since '
+                                'they were last reviewed, instead of by the '
+                                'number of correct reviews')
+        strength_box.setChecked(self.load_config().get('scoring', 'reps') == 'strength')
+        strength_box.toggled.connect(_set_scoring)
+        self.settings_tab.layout.addWidget(strength_box, 3, 1)
+
         self.settings_tab.setLayout(self.settings_tab.layout)
 
+    def create_debug_tab(self):
+        self.debug_tab.layout = QGridLayout(self)
+        user_files = os.path.join(os.path.dirname(__file__), 'user_files')
+        profiler = self.db.profiler
+
+        enable_box = QCheckBox('Record timings')
+        enable_box.setChecked(profiler.enabled)
+        def _enable(state):
+            profiler.enabled = state == Qt.Checked
+        enable_box.stateChanged.connect(_enable)
+        self.debug_tab.layout.addWidget(enable_box, 0, 0)
+
+        cprofile_box = QCheckBox('cProfile (user_files/profile.prof)')
+        def _cprofile(state):
+            if state == Qt.Checked:
+                profiler.start_cprofile()
+            else:
+                profiler.stop_cprofile(os.path.join(user_files, 'profile.prof'))
+        cprofile_box.stateChanged.connect(_cprofile)
+        self.debug_tab.layout.addWidget(cprofile_box, 0, 1)
+
+        trace_box = QCheckBox('SQL trace (user_files/sql_trace.log)')
+        def _trace(state):
+            if state == Qt.Checked:
+                profiler.start_sql_trace(self.db.col.conn,
+                                         os.path.join(user_files, 'sql_trace.log'))
+            else:
+                profiler.stop_sql_trace(self.db.col.conn)
+        trace_box.stateChanged.connect(_trace)
+        self.debug_tab.layout.addWidget(trace_box, 0, 2)
+
+        self.debug_text = QPlainTextEdit()
+        self.debug_text.setReadOnly(True)
+        self.debug_text.setFont(QFont('Monospace'))
+        self.debug_text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.debug_tab.layout.addWidget(self.debug_text, 1, 0, 1, 3)
+
+        refresh_button = QPushButton('Refresh')
+        refresh_button.clicked.connect(self.show_timings)
+        self.debug_tab.layout.addWidget(refresh_button, 2, 0)
+
+        def _reset():
+            profiler.reset()
+            self.show_timings()
+        reset_button = QPushButton('Reset')
+        reset_button.clicked.connect(_reset)
+        self.debug_tab.layout.addWidget(reset_button, 2, 1)
+
+        memory_button = QPushButton('Memory')
+        memory_button.clicked.connect(
+            lambda: self.debug_text.setPlainText(json.dumps(memory_stats(), indent=2)))
+        self.debug_tab.layout.addWidget(memory_button, 2, 2)
+
+        self.debug_tab.setLayout(self.debug_tab.layout)
+
+    def show_timings(self, num_histograms=5):
+        profiler = self.db.profiler
+        summary = sorted(profiler.summary().items(),
+                         key=lambda item: item[1]['seconds'], reverse=True)
+        lines = ['%10s %8s %10s %9s %9s %9s  %s' % (
+            'total (s)', 'count', 'rows', 'p50 (ms)', 'p90 (ms)', 'max (ms)', 'phase')]
+        for name, s in summary:
+            lines.append('%10.3f %8i %10i %9.2f %9.2f %9.2f  %s' % (
+                s['seconds'], s['count'], s['rows'], s['p50']*1000,
+                s['p90']*1000, s['max']*1000, name))
+
+        # Histograms of the recent samples of the slowest phases
+        for name, _ in summary[:num_histograms]:
+            histogram = profiler.histogram(name)
+            max_count = max(count for _, count in histogram)
+            lines += ['', name]
+            for bound, count in histogram:
+                lines.append('  <= %9.2f ms %6i %s' % (
+                    bound*1000, count, '#' * (40 * count // max_count)))
+        self.debug_text.setPlainText('\n'.join(lines))
+
 
     @pyqtSlot()
     def on_active_changed(self):
         self.read_config()
         self.config[self.config_key] = self.combo_box.currentText()
 
+    def create_words_tab(self):
+        self.words_tab.layout = QVBoxLayout(self)
+        self.words_tab.setLayout(self.words_tab.layout)
+        self.words_tab.layout.addWidget(QLabel(
+            'Words which would complete the most sentences if learned. '
+            'Double click a word to find sentences containing it.', self), 0)
+
+        suggest_button = QPushButton('Suggest Words')
+        suggest_button.clicked.connect(self.suggest_words)
+        suggest_button.setFixedWidth(110)
+        self.words_tab.layout.addWidget(suggest_button, 1)
+
+        self.words_table = QTableWidget()
+        self.words_table.setColumnCount(6)
+        self.words_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.words_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.words_table.cellDoubleClicked.connect(self.find_word_sentences)
+        self.words_tab.layout.addWidget(self.words_table, 2)
+
+    def suggest_words(self):
+        if self.redo_search:
+            self.prepare_search()
+            self.redo_search = False
+
+        self.suggested_words = self.db.suggest_words(self.max_num_results)
+        self.words_table.clear()
+        self.words_table.setRowCount(len(self.suggested_words))
+        for i, name in enumerate(['Word', 'Pinyin', 'Translation', 'HSK',
+                                  'Sentences', 'Only unknown']):
+            self.words_table.setHorizontalHeaderItem(i, QTableWidgetItem(name))
+
+        for i, (h, hz, py, tr, hsk_lvl, num_sentences, num_only_unknown) in \
+                enumerate(self.suggested_words):
+            hsk = str(hsk_lvl) if hsk_lvl <= 6 else '-'
+            for j, value in enumerate([hz, json.loads(py)[0], json.loads(tr)[0], hsk,
+                                       str(num_sentences), str(num_only_unknown)]):
+                self.words_table.setItem(i, j, QTableWidgetItem(value))
+        self.words_table.resizeColumnsToContents()
+
+    def find_word_sentences(self, row, column):
+        _, hz, *_ = self.suggested_words[row]
+        self.filter_box.setText(hz)
+        self.tabs.setCurrentWidget(self.find_tab)
+        self.search()
+
     def create_decks_tab(self):
         self.decks_tab.layout = QGridLayout(self)
         self.decks_tab.layout.setSpacing(5)
@@ -429,8 +584,8 @@ class RememberberryWidget(ConfigWidget):
         model['did'] = target_did
         mw.col.models.save(model)
         mw.col.models.setCurrent(model)
-        added = 0
         remove = []
+        notes = []
         for row in self.table_widget.selectionModel().selectedRows():
             (item_hash, *item_content), words = self.search_results[row.row()]
             sentence_hz, sentence_py, sentence_transl = item_content
@@ -440,35 +595,38 @@ class RememberberryWidget(ConfigWidget):
             selected_words, joint = self.select_words_dialog(
                     words, sentence_hz, sentence_py, sentence_transl, False)
 
-            for i, (h, (start, end), max_correct, hsk_lvl, py, tr) in enumerate(words):
+            for i, (h, (start, end), max_correct, hsk_lvl, py, tr, _) in enumerate(words):
                 if selected_words is None or i not in selected_words:
                     continue
-                tr = json.loads(tr)[0]
-                py = json.loads(py)[0]
+                tr = json.loads(self.db.decode(tr))[0]
+                py = json.loads(self.db.decode(py))[0]
                 # Add word note
-                n = mw.col.newNote(forDeck=False)
-                n['Hanzi'] = sentence_hz[start:end]
-                n['Translation'] = tr
-                n['Pinyin'] = py
-                mw.col.addNote(n)
-                self.db.add_note_link(h, n.id)
-                added += 1
+                notes.append((h, sentence_hz[start:end], py, tr))
 
-            n = mw.col.newNote(forDeck=False)
-            n['Hanzi'] = sentence_hz
-            n['Translation'] = sentence_transl
-            n['Pinyin'] = sentence_py
-            mw.col.addNote(n)
-            self.db.add_note_link(item_hash, n.id)
-            added += 1
+            notes.append((item_hash, sentence_hz, sentence_py, sentence_transl))
             remove.append(row.row())
 
+        added = self.add_notes(notes)
         self.remove_table_rows(remove)
 
         if added > 0:
             showInfo('Added %i note%s' % (added, 's' if added > 1 else ''))
 
 
+    def add_notes(self, notes):
+        """Adds (item_hash, hanzi, pinyin, translation) notes with the current
+        model, and links all of them to their items in one transaction"""
+        links = []
+        for item_hash, hz, py, tr in notes:
+            n = mw.col.newNote(forDeck=False)
+            n['Hanzi'] = hz
+            n['Translation'] = tr
+            n['Pinyin'] = py
+            mw.col.addNote(n)
+            links.append((item_hash, n.id))
+        self.db.add_note_links(links)
+        return len(links)
+
     def mark_sentences(self):
         selected_rows = self.table_widget.selectionModel().selectedRows()
         if len(selected_rows) == 0:
@@ -483,12 +641,13 @@ class RememberberryWidget(ConfigWidget):
 
         def _mark(mark_type):
             remove = []
+            hashes = []
             for row in self.table_widget.selectionModel().selectedRows():
-                nid, *_ = self.search_results[row.row()]
-                query = 'update cards set data=? where nid=?'
-                mw.col.db.execute(query, mark_type, nid)
+                (item_hash, *_), _ = self.search_results[row.row()]
+                hashes.append(item_hash)
                 remove.append(row.row())
 
+            self.db.set_marks(hashes, mark_type)
             self.update_mark_items(mark_type)
 
             for row in remove:
@@ -528,32 +687,29 @@ class RememberberryWidget(ConfigWidget):
 
         remove = []
         for row in self.table_widget.selectionModel().selectedRows():
-            nid, field_idx, fields, words, _ = self.search_results[row.row()]
-            field = fields[field_idx]
+            (item_hash, sentence_hz, *_), words = self.search_results[row.row()]
 
             # Sort by start index
-            words = sorted(words, key=lambda w: w[1])
-            if not self.select_mark_words_dialog(nid, words, fields, field_idx):
+            words = sorted(words, key=lambda w: w[1][0])
+            if not self.select_mark_words_dialog(words, sentence_hz):
                 # not cancelled
                 remove.append(row.row())
 
         self.remove_table_rows(remove)
 
-    def select_mark_words_dialog(self, nid, words, fields, field_idx):
+    def select_mark_words_dialog(self, words, hz):
         dialog = QDialog()
         dialog.layout = QVBoxLayout(self)
 
-        note = QLabel('Note:\n' + '\n'.join(fields))
+        note = QLabel('Note:\n' + hz)
         dialog.layout.addWidget(note, 0)
 
         model = QStandardItemModel()
         items = []
         word_indices = []
-        for i, (info, start, end, strength) in enumerate(words):
-            if strength < 0:
-                continue
-            item = QStandardItem(fields[field_idx][start:end])
-            item.setCheckState(Qt.Checked if 0 <= strength < 1 else Qt.Unchecked)
+        for i, (h, (start, end), *_, bucket) in enumerate(words):
+            item = QStandardItem(hz[start:end])
+            item.setCheckState(Qt.Checked if bucket == BUCKET_UNKNOWN else Qt.Unchecked)
             item.setCheckable(True)
             model.appendRow(item)
             items.append(item)
@@ -564,16 +720,14 @@ class RememberberryWidget(ConfigWidget):
         dialog.layout.addWidget(view, 1)
 
         def _mark(mark_type):
-            selected = []
+            hashes = []
             for item, i in zip(items, word_indices):
                 if item.checkState() != Qt.Checked:
                     continue
+                word_hash, *_ = words[i]
+                hashes.append(word_hash)
 
-                info_words = sorted(words[i][0], key=lambda w: len(w[1]))
-                nid, _ = info_words[0] # use the shortest info word
-                query = 'update cards set data=? where nid=?'
-                mw.col.db.execute(query, mark_type, nid)
-
+            self.db.set_marks(hashes, mark_type)
             self.update_mark_items(mark_type)
             dialog.close()
 
@@ -609,10 +763,10 @@ class RememberberryWidget(ConfigWidget):
         model = QStandardItemModel()
         items = []
         word_indices = []
-        for i, (h, (start, end), max_correct, hsk_lvl, py, _) in enumerate(words):
-            py = json.loads(py)[0]
+        for i, (h, (start, end), _, _, py, _, bucket) in enumerate(words):
+            py = json.loads(self.db.decode(py))[0]
             item = QStandardItem('%s (%s)' % (hz[start:end], py))
-            is_known = max_correct > 8 or hsk_lvl <= self.db.completed_hsk_lvl
+            is_known = bucket == BUCKET_KNOWN
             item.setCheckState(Qt.Checked if not is_known else Qt.Unchecked)
             item.setCheckable(True)
             model.appendRow(item)
@@ -666,8 +820,13 @@ class RememberberryWidget(ConfigWidget):
             return
 
         target_did = self.decks[self.target_deck.currentText()]
+        cloze_model = mw.col.models.byName("Cloze")
+        cloze_model['did'] = target_did
+        mw.col.models.save(cloze_model)
+        mw.col.models.setCurrent(cloze_model)
         added = 0
         remove = []
+        links = []
         for row in self.table_widget.selectionModel().selectedRows():
             (item_hash, *item_content), words = self.search_results[row.row()]
             sentence_hz, sentence_py, sentence_transl = item_content
@@ -683,8 +842,8 @@ class RememberberryWidget(ConfigWidget):
             cloze = ''
             cloze_words = ''
             next_close_idx = 1
-            for i, (h, (start, end), max_correct, hsk_lvl, py, tr) in enumerate(words):
-                tr = json.loads(tr)
+            for i, (h, (start, end), max_correct, hsk_lvl, py, tr, _) in enumerate(words):
+                tr = json.loads(self.db.decode(tr))
                 if i not in selected_words:
                     cloze += sentence_hz[start:end]
                 elif start > curr_idx:
@@ -699,19 +858,16 @@ class RememberberryWidget(ConfigWidget):
             if curr_idx < len(sentence_hz):
                 cloze += sentence_hz[curr_idx:]
 
-            cloze_model = mw.col.models.byName("Cloze")
-            cloze_model['did'] = target_did
-            mw.col.models.save(cloze_model)
-            mw.col.models.setCurrent(cloze_model)
             f = mw.col.newNote(forDeck=False)
             f['Text'] = cloze
             f['Extra'] = '%s<br/>%s' % (sentence_transl, sentence_py)
             mw.col.addNote(f)
-            self.db.add_note_link(item_hash, f.id)
+            links.append((item_hash, f.id))
 
             added += 1 if joint else next_close_idx - 1
             remove.append(row.row())
 
+        self.db.add_note_links(links)
         self.remove_table_rows(remove)
 
         if added > 0:
@@ -729,8 +885,10 @@ class RememberberryWidget(ConfigWidget):
             self.prepare_search()
             self.redo_search = False
 
+        lap = self.db.profiler.laps('widget')
         self.search_results = self.db.search(
             filter_text=filter_text, limit=self.max_num_results, num_unknown=-1)
+        lap('search', len(self.search_results))
 
         if len(self.search_results) == 0:
             showInfo('No matches')
@@ -745,36 +903,16 @@ class RememberberryWidget(ConfigWidget):
         self.table_widget.setRowCount(len(self.search_results))
 
         for i, ((item_hash, *item_content), words) in enumerate(self.search_results):
-            colors = []
             sentence_hz, sentence_py, sentence_transl = item_content
-            word_ranges = []
-            for word_hash, (start, end), max_correct, hsk_lvl, *_ in words:
-                word_ranges.append((start, end))
-
-                l = self.db.completed_hsk_lvl
-                is_known = max_correct > 8 or hsk_lvl <= l
-                is_memorizing = (5 <= max_correct <= 8) and hsk_lvl > l
-                is_learning = (1 <= max_correct <= 4) and hsk_lvl > l
-                is_unknown = max_correct == 0 and hsk_lvl > l
-
-                if is_unknown:
-                    colors.append('rgb(239, 75, 67)') # red
-                elif is_learning:
-                    colors.append('orange') # orange
-                elif is_memorizing:
-                    colors.append('rgb(165, 224, 172)') # light green
-                elif is_known:
-                    colors.append('rgb(74, 155, 62)') # green
-
-            label = ''.join('<span style="background: %s; border-color: black">%s</span><span> </span>'
-                            % (color, sentence_hz[start:end])
-                            for color, (start, end) in zip(colors, word_ranges))
+            label = ''.join(_span_template(bucket) % sentence_hz[start:end]
+                            for _, (start, end), *_, bucket in words)
 
             self.table_widget.setCellWidget(i, 0, QLabel('%s <br> %s' % (label, sentence_py)))
             self.table_widget.setCellWidget(i, 1, QLabel(sentence_transl))
         self.table_widget.resizeRowsToContents()
         self.table_widget.resizeColumnsToContents()
         self.table_widget.show()
+        lap('render', len(self.search_results))
 
     def prepare_search(self):
         self.read_config()
@@ -783,9 +921,24 @@ class RememberberryWidget(ConfigWidget):
         sentence_decks = self.config['sentence_decks']
 
         if self.db.initiated:
-            self.db.update(user_decks)
+            # Reviews are processed in the background, only make sure that
+            # nothing is left in the queue
+            update_queue.flush()
         else:
             self.db.init(user_decks, sentence_decks)
 
+        # init() starts over with the default scoring
+        scoring = self.config.get('scoring', 'reps')
+        if self.db.scoring != scoring:
+            self.db.set_scoring(scoring)
+
+    def full_update(self):
+        self.read_config()
+        if not self.db.initiated:
+            self.prepare_search()
+            return
+        new, changed, parents = self.db.update(self.config['active_vocabulary_decks'])
+        showInfo('Updated %i new and %i changed notes' % (new, changed))
+
     def get_target_deck(self):
         return self.editor.parentWindow.deckChooser.selectedId()